@@ -0,0 +1,305 @@
+"""Asyncio deploy engine for sites with a very large number of keys.
+
+The engine uses the same planner as :func:`s3_deploy.deploy.deploy` but
+performs the transfers with an asynchronous S3 client so that hundreds of
+requests can be in flight from a single thread. It requires Python 3.5+
+and the optional ``aiobotocore`` package.
+"""
+
+import asyncio
+import functools
+import logging
+import signal
+import sys
+
+from . import config
+from . import deploy as _deploy
+from . import stats
+
+
+DEFAULT_CONCURRENCY = 100
+
+logger = logging.getLogger(__name__)
+
+
+def _create_client_context(endpoint_url):
+    try:
+        from aiobotocore.session import get_session
+    except ImportError:
+        raise RuntimeError(
+            'The asyncio engine requires the aiobotocore package')
+
+    return get_session().create_client('s3', endpoint_url=endpoint_url)
+
+
+class AsyncDeployer(object):
+    """Execute planned actions using an asynchronous S3 client.
+
+    At most ``concurrency`` requests are in flight at any time. Planning
+    and compression run in the default executor so the event loop is only
+    used for network transfers.
+    """
+    def __init__(self, client, bucket_name, cache_rules, dry,
+                 storage_class=None, concurrency=DEFAULT_CONCURRENCY,
+                 bandwidth=None, precompressed=None, storage_class_rules=()):
+        if concurrency < 1:
+            raise ValueError('Concurrency must be at least 1')
+
+        self._client = client
+        self._bucket_name = bucket_name
+        self._cache_rules = cache_rules
+        self._dry = dry
+        self._storage_class = storage_class
+        self._bandwidth = bandwidth
+        self._precompressed = precompressed
+        self._storage_class_rules = storage_class_rules
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+
+    async def _run_in_executor(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(func, *args, **kwargs))
+
+    def _key_storage_class(self, key_name):
+        return config.resolve_storage_class(
+            key_name, self._storage_class_rules, self._storage_class)
+
+    async def _upload(self, action):
+        if self._dry:
+            if stats.enabled():
+                stats.record(stats.PUT, size=await self._run_in_executor(
+                    _deploy.estimate_upload_size, action.path,
+                    precompressed=self._precompressed))
+            logger.info('Uploading {}...'.format(action.key))
+            return
+
+        body, kwargs = await self._run_in_executor(
+            _deploy._prepare_upload, action.key, action.path,
+            self._cache_rules,
+            storage_class=self._key_storage_class(action.key),
+            precompressed=self._precompressed)
+
+        logger.info('Uploading {}...'.format(action.key))
+        if self._bandwidth is not None:
+            await asyncio.sleep(self._bandwidth.reserve(len(body)))
+        await self._client.put_object(
+            Bucket=self._bucket_name, Key=action.key, Body=body, **kwargs)
+        stats.record(stats.PUT, size=len(body))
+
+    async def _transition(self, action):
+        """Change the storage class in place, uploading if that fails."""
+        from botocore.exceptions import ClientError
+
+        storage_class = self._key_storage_class(action.key)
+        logger.info('Changing storage class of {} to {}...'.format(
+            action.key, storage_class))
+        stats.record(stats.COPY)
+        if self._dry:
+            return
+        try:
+            await self._client.copy_object(
+                Bucket=self._bucket_name, Key=action.key,
+                CopySource=dict(Bucket=self._bucket_name, Key=action.key),
+                MetadataDirective='COPY', StorageClass=storage_class)
+        except ClientError:
+            logger.warning('Unable to change storage class of {}'.format(
+                action.key), exc_info=True)
+            await self._upload(action)
+
+    async def _redirect(self, action):
+        logger.info('Redirecting {} to {}...'.format(
+            action.key, action.location))
+        body, kwargs = _deploy._prepare_redirect(
+            action.key, action.location, self._cache_rules)
+        stats.record(stats.PUT, size=len(body))
+        if not self._dry:
+            await self._client.put_object(
+                Bucket=self._bucket_name, Key=action.key, Body=body,
+                **kwargs)
+
+    async def _delete(self, action):
+        logger.info('Deleting {}...'.format(action.key))
+        stats.record(stats.DELETE)
+        if not self._dry:
+            await self._client.delete_object(
+                Bucket=self._bucket_name, Key=action.key)
+
+    async def _execute(self, action):
+        try:
+            if action.kind == _deploy.ACTION_DELETE:
+                await self._delete(action)
+            elif action.location is not None:
+                await self._redirect(action)
+            elif action.kind == _deploy.ACTION_TRANSITION:
+                await self._transition(action)
+            else:
+                if action.kind == _deploy.ACTION_CREATE:
+                    logger.info('Creating key {}...'.format(action.key))
+                await self._upload(action)
+        finally:
+            self._semaphore.release()
+
+    async def submit(self, action):
+        """Schedule the action, waiting while the concurrency limit is hit."""
+        await self._semaphore.acquire()
+        task = asyncio.ensure_future(self._execute(action))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def join(self):
+        """Wait for all scheduled actions and raise the first error."""
+        if len(self._tasks) > 0:
+            await asyncio.gather(*list(self._tasks))
+
+    async def cancel(self):
+        """Cancel all in-flight actions and wait for them to finish."""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        if len(tasks) > 0:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def deploy_async(conf, base_path, force, dry, concurrency=None,
+                       client=None, prefix=''):
+    """Deploy using given configuration with the asyncio engine.
+
+    If client is not given an aiobotocore S3 client is created for the
+    duration of the deploy. If prefix is given, the deploy is scoped to
+    the keys starting with prefix. The bucket lock is held during the
+    deploy if the lock option is enabled. Raises ValueError if the
+    verify_uploads or deduplicate option is enabled.
+    """
+    conf = config.compile_config(conf)
+    if client is None:
+        if 'storage_url' in conf:
+            raise ValueError(
+                'storage_url is not supported by the asyncio engine')
+        async with _create_client_context(conf.get('endpoint_url')) as client:
+            return await deploy_async(
+                conf, base_path, force, dry, concurrency=concurrency,
+                client=client, prefix=prefix)
+
+    for name in ('verify_uploads', 'deduplicate'):
+        if conf.get(name, False):
+            raise ValueError(
+                '{} is not supported by the asyncio engine'.format(name))
+    if concurrency is None:
+        concurrency = conf.get('concurrency', DEFAULT_CONCURRENCY)
+
+    logger.info('Connecting to bucket {}...'.format(conf['s3_bucket']))
+
+    s3_client = _deploy._create_s3_client(conf)
+
+    # The lock is held through blocking requests of the synchronous client
+    loop = asyncio.get_event_loop()
+    bucket_lock = _deploy._bucket_lock(conf, s3_client, dry)
+    deploy_lock = await loop.run_in_executor(None, bucket_lock.__enter__)
+    try:
+        await _sync_site_async(
+            conf, base_path, force, dry, client, s3_client, concurrency,
+            prefix, deploy_lock)
+    except BaseException:
+        await loop.run_in_executor(
+            None, bucket_lock.__exit__, *sys.exc_info())
+        raise
+    await loop.run_in_executor(None, bucket_lock.__exit__, None, None, None)
+
+
+async def _sync_site_async(conf, base_path, force, dry, client, s3_client,
+                           concurrency, prefix, deploy_lock=None):
+    deployer = AsyncDeployer(
+        client, conf['s3_bucket'], conf.get('cache_rules', []), dry,
+        storage_class=_deploy._storage_class_from_config(conf),
+        concurrency=concurrency,
+        bandwidth=_deploy._bandwidth_from_config(conf),
+        precompressed=conf.get('precompressed'),
+        storage_class_rules=conf.get('storage_class_rules', ()))
+
+    priority_rules = conf.get('upload_priority', [])
+    min_priority = _deploy._min_upload_priority(priority_rules)
+    held_back = []
+
+    loop = asyncio.get_event_loop()
+    hasher = _deploy._hasher_from_config(conf, base_path)
+    try:
+        # Listing and stat calls block so the plan is advanced in the
+        # executor.
+        plan = await loop.run_in_executor(None, functools.partial(
+            _deploy.SyncPlan, conf, base_path, force, dry, s3_client,
+            hasher=hasher, prefix=prefix, lock=deploy_lock))
+        actions = iter(plan)
+        while True:
+            action = await loop.run_in_executor(None, next, actions, None)
+            if action is None:
+                break
+
+            priority = min_priority
+            if action.kind != _deploy.ACTION_DELETE:
+                priority = config.resolve_upload_priority(
+                    action.key, priority_rules)
+            if priority <= min_priority:
+                await deployer.submit(action)
+            else:
+                held_back.append((priority, action))
+
+        # Upload held back keys one priority level at a time
+        level = None
+        for priority, action in sorted(held_back, key=lambda a: a[0]):
+            if priority != level:
+                await deployer.join()
+                level = priority
+            await deployer.submit(action)
+
+        await deployer.join()
+    except asyncio.CancelledError:
+        logger.warning('Deploy cancelled, waiting for in-flight requests...')
+        await deployer.cancel()
+        raise
+    except Exception:
+        await deployer.cancel()
+        raise
+    finally:
+        if hasher is not None:
+            await loop.run_in_executor(None, hasher.close)
+
+    await loop.run_in_executor(None, plan.finish)
+
+
+def run_deploy(conf, base_path, force, dry, concurrency=None, prefix=''):
+    """Run the asyncio engine to completion.
+
+    An interrupt (Ctrl-C) cancels the deploy gracefully: no new requests
+    are started and in-flight requests are cancelled before returning.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        with _deploy._recorded_history(conf, base_path, dry):
+            task = loop.create_task(deploy_async(
+                conf, base_path, force, dry, concurrency=concurrency,
+                prefix=prefix))
+            try:
+                loop.add_signal_handler(signal.SIGINT, task.cancel)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Signal handlers are unavailable on Windows and outside
+                # the main thread.
+                pass
+
+            try:
+                loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                raise KeyboardInterrupt()
+            except KeyboardInterrupt:
+                task.cancel()
+                try:
+                    loop.run_until_complete(task)
+                except asyncio.CancelledError:
+                    pass
+                raise
+    finally:
+        try:
+            loop.remove_signal_handler(signal.SIGINT)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass
+        loop.close()
@@ -0,0 +1,113 @@
+"""Compression of uploaded files."""
+
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from six import BytesIO
+
+
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+# Bytes of a file compressed to estimate the compression ratio
+ESTIMATE_SAMPLE_SIZE = 64 * 1024
+
+# File name extensions of pre-compressed sidecar files by Content-Encoding
+SIDECAR_EXTENSIONS = {'gzip': '.gz', 'br': '.br'}
+
+
+def gzip_compress(data):
+    """Compress data with gzip at the highest level.
+
+    The gzip header timestamp is fixed so identical data always gives
+    identical compressed bytes.
+    """
+    compressed = BytesIO()
+    gzip_file = gzip.GzipFile(
+        fileobj=compressed, mode='wb', compresslevel=9, mtime=0)
+    try:
+        gzip_file.write(data)
+    finally:
+        gzip_file.close()
+    return compressed.getvalue()
+
+
+def estimate_compressed_size(path):
+    """Estimate the gzip compressed size of the file at path.
+
+    Only the start of the file is compressed and the compression ratio of
+    that sample is extrapolated to the whole file.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        sample = f.read(ESTIMATE_SAMPLE_SIZE)
+    compressed = len(gzip_compress(sample))
+    if len(sample) >= size:
+        return compressed
+    return int(compressed * float(size) / len(sample))
+
+
+def is_sidecar(name, names, encodings):
+    """Return True if file name is a sidecar of another file in names.
+
+    Sidecars are compressed copies of a file emitted by site generators,
+    e.g. ``app.js.gz`` next to ``app.js``.
+    """
+    for encoding in encodings:
+        ext = SIDECAR_EXTENSIONS[encoding]
+        if name.endswith(ext) and name[:-len(ext)] in names:
+            return True
+    return False
+
+
+def find_sidecar(path, encodings):
+    """Return tuple of path and encoding of the sidecar of path, or None.
+
+    The encodings are tried in order of preference.
+    """
+    for encoding in encodings:
+        sidecar = path + SIDECAR_EXTENSIONS[encoding]
+        if os.path.isfile(sidecar):
+            return sidecar, encoding
+    return None
+
+
+class CompressionCache(object):
+    """Cache of compressed data keyed by a digest of the uncompressed data.
+
+    Identical files, e.g. the same assets in several sites deployed in one
+    run, are only compressed once. The least recently used entries are
+    evicted when the total size of the compressed data exceeds max_bytes.
+    """
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        self._max_bytes = max_bytes
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def compress(self, data):
+        """Return gzip compressed data, from the cache if possible."""
+        key = (len(data), hashlib.md5(data).digest())
+        with self._lock:
+            compressed = self._entries.pop(key, None)
+            if compressed is not None:
+                self._entries[key] = compressed
+                self.hits += 1
+                return compressed
+            self.misses += 1
+
+        compressed = gzip_compress(data)
+
+        with self._lock:
+            if key not in self._entries and len(compressed) <= self._max_bytes:
+                self._entries[key] = compressed
+                self._size += len(compressed)
+                while self._size > self._max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._size -= len(evicted)
+
+        return compressed
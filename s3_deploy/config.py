@@ -1,21 +1,48 @@
 
 import os
 import re
+import copy
 import logging
+from collections import namedtuple
 from datetime import timedelta
 
-import yaml
-from six import integer_types
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
-from .filematch import match_key
+from six import integer_types, string_types
+
+from .compression import SIDECAR_EXTENSIONS
+from .filematch import PatternSet, compile_re, match_key
 
 
 logger = logging.getLogger(__name__)
 
+# Cache-Control of fingerprinted keys, whose contents never change
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+# Parsed configuration files by path, with the file size and mtime they
+# were parsed at.
+_config_cache = {}
+
 
 def _load_config_from_path(path):
+    st = os.stat(path)
+    signature = (st.st_size, st.st_mtime)
+    cached = _config_cache.get(path)
+    if cached is not None and cached[0] == signature:
+        return copy.deepcopy(cached[1])
+
+    # PyYAML is imported on first use to keep startup fast
+    import yaml
+
     with open(path, 'r') as f:
-        return yaml.safe_load(f)
+        config = yaml.safe_load(f)
+
+    _config_cache[path] = signature, copy.deepcopy(config)
+    return config
 
 
 def load_config_file(path):
@@ -67,33 +94,388 @@ def timedelta_from_duration_string(s):
     return timedelta(**td_args)
 
 
+def size_from_string(s):
+    """Convert size string (e.g. ``500 KB``, ``2M``) to number of bytes."""
+    if isinstance(s, integer_types):
+        return s
+
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)(?:i?b)?\s*$', s, re.I)
+    if not m:
+        raise ValueError('Unable to parse size string: {}'.format(s))
+
+    multiplier = {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3}
+    return int(float(m.group(1)) * multiplier[m.group(2).lower()])
+
+
+def scope_prefix(path):
+    """Return the key prefix of the site subdirectory at path.
+
+    The prefix is empty for the whole site and otherwise ends with a
+    slash, e.g. ``docs/`` for ``/docs``. Raises ValueError for paths that
+    leave the site.
+    """
+    parts = [part for part in path.split('/') if part not in ('', '.')]
+    if '..' in parts:
+        raise ValueError('Prefix must not contain ..: {}'.format(path))
+    if len(parts) == 0:
+        return ''
+    return '/'.join(parts) + '/'
+
+
+def _rule_matches(rule, key_name):
+    """Return True if the match or match_regexp pattern of rule matches."""
+    has_match = 'match' in rule
+    has_match_regexp = 'match_regexp' in rule
+    if has_match == has_match_regexp:
+        raise ValueError(
+            'Rule must have either match or match_regexp key'
+        )
+
+    pattern = rule['match'] if has_match else rule['match_regexp']
+
+    return match_key(pattern, key_name, regexp=has_match_regexp)
+
+
+def resolve_upload_priority(key_name, rules):
+    """Returns the upload priority of key after applying rules.
+
+    Keys with lower priority are uploaded first. Keys that do not match
+    any rule have priority 0.
+    """
+    if isinstance(rules, RuleList):
+        rule = rules.first_match(key_name)
+        return 0 if rule is None else rule.priority
+
+    for rule in rules:
+        if isinstance(rule, PriorityRule):
+            if rule.pattern.search(key_name):
+                return rule.priority
+        elif _rule_matches(rule, key_name):
+            return int(rule.get('priority', 0))
+
+    return 0
+
+
+def resolve_storage_class(key_name, rules, default):
+    """Returns the storage class of key after applying compiled rules.
+
+    Keys that do not match any rule use the default storage class.
+    """
+    if len(rules) == 0:
+        return default
+    rule = rules.first_match(key_name)
+    return default if rule is None else rule.storage_class
+
+
+def duration_seconds(value):
+    """Convert number of seconds or duration string to number of seconds."""
+    if isinstance(value, integer_types):
+        return value
+    return int(timedelta_from_duration_string(value).total_seconds())
+
+
+def fingerprint_pattern(conf):
+    """Return compiled fingerprint_regexp of configuration, or None."""
+    pattern = conf.get('fingerprint_regexp')
+    if isinstance(pattern, string_types):
+        return re.compile(pattern)
+    return pattern
+
+
+def _cache_control_from_rule(rule):
+    cache_control = None
+    if 'cache_control' in rule:
+        cache_control = rule['cache_control']
+    if 'maxage' in rule:
+        maxage = duration_seconds(rule['maxage'])
+        if cache_control is None:
+            cache_control = 'max-age={}'.format(maxage)
+        else:
+            cache_control += ', max-age={}'.format(maxage)
+    return cache_control
+
+
 def resolve_cache_rules(key_name, rules):
     """Returns the value of the Cache-Control header after applying rules."""
+    if isinstance(rules, RuleList):
+        rule = rules.first_match(key_name)
+        return None if rule is None else rule.cache_control
 
     for rule in rules:
-        has_match = 'match' in rule
-        has_match_regexp = 'match_regexp' in rule
-        if has_match == has_match_regexp:
-            raise ValueError(
-                'Cache rule must have either match or match_regexp key'
-            )
-
-        pattern = rule['match'] if has_match else rule['match_regexp']
-
-        if match_key(pattern, key_name, regexp=has_match_regexp):
-            cache_control = None
-            if 'cache_control' in rule:
-                cache_control = rule['cache_control']
-            if 'maxage' in rule:
-                if isinstance(rule['maxage'], integer_types):
-                    maxage = rule['maxage']
-                else:
-                    td = timedelta_from_duration_string(rule['maxage'])
-                    maxage = int(td.total_seconds())
-                if cache_control is None:
-                    cache_control = 'max-age={}'.format(maxage)
-                else:
-                    cache_control += ', max-age={}'.format(maxage)
-            return cache_control
+        if isinstance(rule, CacheRule):
+            if rule.pattern.search(key_name):
+                return rule.cache_control
+        elif _rule_matches(rule, key_name):
+            return _cache_control_from_rule(rule)
 
     return None
+
+
+CacheRule = namedtuple('CacheRule', ['pattern', 'cache_control'])
+PriorityRule = namedtuple('PriorityRule', ['pattern', 'priority'])
+StorageClassRule = namedtuple('StorageClassRule', ['pattern', 'storage_class'])
+
+STORAGE_CLASSES = frozenset([
+    'STANDARD', 'REDUCED_REDUNDANCY', 'STANDARD_IA', 'ONEZONE_IA',
+    'INTELLIGENT_TIERING', 'GLACIER', 'GLACIER_IR', 'DEEP_ARCHIVE'])
+
+
+class RuleList(tuple):
+    """Tuple of compiled rules, matched in bulk by a :class:`PatternSet`."""
+    def __new__(cls, rules=()):
+        self = super(RuleList, cls).__new__(cls, rules)
+        self._patterns = PatternSet(rule.pattern for rule in self)
+        return self
+
+    def first_match(self, key_name):
+        """Return the first rule matching key, or None."""
+        i = self._patterns.match(key_name)
+        return None if i is None else self[i]
+
+
+def _compile_rule_pattern(rule, name):
+    if not isinstance(rule, dict):
+        raise ValueError('Each rule in {} must be a mapping'.format(name))
+
+    has_match = 'match' in rule
+    has_match_regexp = 'match_regexp' in rule
+    if has_match == has_match_regexp:
+        raise ValueError(
+            'Rule in {} must have either match or match_regexp key'.format(
+                name))
+
+    pattern = rule['match'] if has_match else rule['match_regexp']
+    if not isinstance(pattern, string_types) or pattern == '':
+        raise ValueError('Invalid pattern in {}: {!r}'.format(name, pattern))
+
+    if has_match:
+        pattern = compile_re(pattern)
+    try:
+        return re.compile(pattern)
+    except re.error as e:
+        raise ValueError('Invalid regular expression in {}: {}'.format(
+            name, e))
+
+
+def _compile_rules(conf, name, compile_rule):
+    rules = conf.get(name)
+    if rules is None:
+        return RuleList()
+    if not isinstance(rules, list):
+        raise ValueError('{} must be a list of rules'.format(name))
+    return RuleList(compile_rule(rule) for rule in rules)
+
+
+def _compile_cache_rule(rule):
+    pattern = _compile_rule_pattern(rule, 'cache_rules')
+    cache_control = rule.get('cache_control')
+    if cache_control is not None and not isinstance(
+            cache_control, string_types):
+        raise ValueError('cache_control must be a string')
+    return CacheRule(pattern, _cache_control_from_rule(rule))
+
+
+def _compile_priority_rule(rule):
+    pattern = _compile_rule_pattern(rule, 'upload_priority')
+    priority = rule.get('priority', 0)
+    if not isinstance(priority, integer_types):
+        raise ValueError('priority must be an integer')
+    return PriorityRule(pattern, priority)
+
+
+def _compile_precompressed(value):
+    if value is True:
+        return ('gzip',)
+    if value is False or value is None:
+        return None
+    if (not isinstance(value, list) or len(value) == 0 or
+            any(encoding not in SIDECAR_EXTENSIONS for encoding in value)):
+        raise ValueError(
+            'precompressed must be a boolean or a list of encodings '
+            '({})'.format(', '.join(sorted(SIDECAR_EXTENSIONS))))
+    return tuple(value)
+
+
+def _compile_redirects(value):
+    """Return tuple of key name and location pairs in key order."""
+    if not isinstance(value, dict):
+        raise ValueError('redirects must be a mapping of paths to locations')
+    redirects = {}
+    for path, location in value.items():
+        if not isinstance(path, string_types) or path.strip('/') == '':
+            raise ValueError('Invalid redirect path: {!r}'.format(path))
+        if not isinstance(location, string_types) or not (
+                location.startswith('/') or
+                location.startswith('http://') or
+                location.startswith('https://')):
+            raise ValueError(
+                'Redirect location of {} must start with /, http:// or '
+                'https://'.format(path))
+        redirects[path.lstrip('/')] = location
+    return tuple(sorted(redirects.items()))
+
+
+def _compile_storage_class_rule(rule):
+    pattern = _compile_rule_pattern(rule, 'storage_class_rules')
+    storage_class = rule.get('storage_class')
+    if storage_class not in STORAGE_CLASSES:
+        raise ValueError('storage_class must be one of {}'.format(
+            ', '.join(sorted(STORAGE_CLASSES))))
+    return StorageClassRule(pattern, storage_class)
+
+
+def _positive_int(conf, name):
+    value = conf[name]
+    if not isinstance(value, integer_types) or value < 1:
+        raise ValueError('{} must be a positive integer'.format(name))
+    return value
+
+
+class CompiledConfig(Mapping):
+    """Validated, read-only configuration.
+
+    Behaves like the configuration dictionary, except that rules are
+    compiled (patterns to regular expressions, durations to Cache-Control
+    values) and sizes are converted to numbers, so no per-key parsing is
+    needed during a deploy.
+    """
+    def __init__(self, values):
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return '<{} {!r}>'.format(self.__class__.__name__, self._values)
+
+
+def expand_targets(conf):
+    """Return list of the configurations of each target site.
+
+    A configuration may list several sites under ``targets``. Each target
+    inherits the top-level options that it does not set itself. A manifest
+    inherited by several targets is kept per target by adding the bucket
+    name to its file name. Raises ValueError if targets share a manifest.
+    A configuration without targets is a single target.
+    """
+    if 'targets' not in conf:
+        return [conf]
+
+    targets = conf['targets']
+    if not isinstance(targets, list) or len(targets) == 0:
+        raise ValueError('targets must be a non-empty list')
+
+    defaults = dict((k, v) for k, v in conf.items() if k != 'targets')
+    expanded = []
+    for target in targets:
+        if not isinstance(target, dict):
+            raise ValueError('Each target must be a mapping')
+        target_conf = dict(defaults)
+        target_conf.update(target)
+        if ('manifest' in defaults and 'manifest' not in target and
+                len(targets) > 1):
+            target_conf['manifest'] = _target_path(
+                defaults['manifest'], target_conf.get('s3_bucket'))
+        expanded.append(target_conf)
+
+    manifests = [t['manifest'] for t in expanded if 'manifest' in t]
+    if len(set(manifests)) != len(manifests):
+        raise ValueError('Each target must have its own manifest')
+
+    return expanded
+
+
+def _target_path(path, bucket_name):
+    """Return path with bucket name added before the extension."""
+    root, ext = os.path.splitext(path)
+    return '{}.{}{}'.format(root, bucket_name, ext)
+
+
+def compile_config(conf):
+    """Validate configuration and return a :class:`CompiledConfig`.
+
+    Raises ValueError describing the first problem found. Compiling an
+    already compiled configuration returns it unchanged.
+    """
+    if isinstance(conf, CompiledConfig):
+        return conf
+    if not isinstance(conf, dict):
+        raise ValueError('Configuration must be a mapping')
+
+    values = dict(conf)
+    for name in ('site', 's3_bucket'):
+        if not isinstance(conf.get(name), string_types) or conf[name] == '':
+            raise ValueError('Missing required option: {}'.format(name))
+
+    for name in ('cloudfront_distribution_id', 'index_document',
+                 'endpoint_url', 'manifest', 'storage_url', 'hash_cache',
+                 'history'):
+        if name in conf and not isinstance(conf[name], string_types):
+            raise ValueError('{} must be a string'.format(name))
+
+    values['cache_rules'] = _compile_rules(
+        conf, 'cache_rules', _compile_cache_rule)
+    if 'fingerprint_regexp' in conf:
+        pattern = conf['fingerprint_regexp']
+        if not isinstance(pattern, string_types) or pattern == '':
+            raise ValueError('fingerprint_regexp must be a non-empty string')
+        try:
+            values['fingerprint_regexp'] = re.compile(pattern)
+        except re.error as e:
+            raise ValueError(
+                'Invalid regular expression in fingerprint_regexp: {}'.format(
+                    e))
+
+        # Fingerprinted keys are cached forever regardless of cache rules
+        values['cache_rules'] = RuleList(
+            (CacheRule(values['fingerprint_regexp'],
+                       IMMUTABLE_CACHE_CONTROL),) +
+            values['cache_rules'])
+
+    for name in ('orphan_grace_period', 'lock_ttl', 'lock_timeout'):
+        if name in conf:
+            values[name] = duration_seconds(conf[name])
+    if values.get('lock_ttl', 1) <= 0:
+        raise ValueError('lock_ttl must be positive')
+
+    values['upload_priority'] = _compile_rules(
+        conf, 'upload_priority', _compile_priority_rule)
+    values['storage_class_rules'] = _compile_rules(
+        conf, 'storage_class_rules', _compile_storage_class_rule)
+
+    if conf.get('max_bandwidth') is not None:
+        values['max_bandwidth'] = size_from_string(conf['max_bandwidth'])
+        if values['max_bandwidth'] <= 0:
+            raise ValueError('max_bandwidth must be positive')
+
+    if conf.get('memory_limit') is not None:
+        values['memory_limit'] = size_from_string(conf['memory_limit'])
+        if values['memory_limit'] <= 0:
+            raise ValueError('memory_limit must be positive')
+
+    for name in ('concurrency', 'list_concurrency', 'site_concurrency',
+                 'hash_workers'):
+        if name in conf:
+            values[name] = _positive_int(conf, name)
+
+    if 'precompressed' in conf:
+        values['precompressed'] = _compile_precompressed(
+            conf['precompressed'])
+
+    if 'redirects' in conf:
+        values['redirects'] = _compile_redirects(conf['redirects'])
+
+    if 'storage_latency' in conf:
+        latency = conf['storage_latency']
+        if (isinstance(latency, bool) or
+                not isinstance(latency, integer_types + (float,)) or
+                latency < 0):
+            raise ValueError('storage_latency must be a non-negative number')
+
+    return CompiledConfig(values)
@@ -0,0 +1,73 @@
+"""Deduplication of uploads with server-side copies.
+
+Identical files are common in generated sites (the same favicon or vendor
+script under several paths). The index maps the MD5 digest of upload
+bodies to a key that already holds the same bytes, either a remote object
+that is left unchanged by the deploy or a key uploaded earlier in the same
+run, so the file can be copied within the bucket instead of uploaded.
+"""
+
+import threading
+
+
+def digest_from_etag(etag):
+    """Return the MD5 hex digest that an ETag represents, or None.
+
+    The ETag of objects uploaded in one part is the MD5 digest of the body.
+    The ETag of multipart uploads is not a digest of the body.
+    """
+    if etag is None:
+        return None
+    etag = etag.strip('"')
+    if '-' in etag or len(etag) != 32:
+        return None
+    return etag.lower()
+
+
+class ContentIndex(object):
+    """Thread-safe index of key names by digest of their contents.
+
+    Transfers of identical bodies are coordinated through :meth:`claim`:
+    the first transfer of a digest uploads the body, concurrent transfers
+    of the same digest wait for it and then copy the uploaded key.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sources = {}
+        self._pending = {}
+
+    def add(self, etag, key_name):
+        """Record remote key with the given ETag as a copy source."""
+        digest = digest_from_etag(etag)
+        if digest is not None:
+            with self._lock:
+                self._sources.setdefault(digest, key_name)
+
+    def claim(self, digest):
+        """Return a key holding the content with digest.
+
+        Return None if no key holds the content yet. The caller is then
+        responsible for uploading it and must call :meth:`release`.
+        """
+        while True:
+            with self._lock:
+                source = self._sources.get(digest)
+                if source is not None:
+                    return source
+                event = self._pending.get(digest)
+                if event is None:
+                    self._pending[digest] = threading.Event()
+                    return None
+            event.wait()
+
+    def release(self, digest, key_name, uploaded):
+        """Finish the upload of a claimed digest.
+
+        If the upload failed, one of the waiting transfers claims the
+        digest next.
+        """
+        with self._lock:
+            event = self._pending.pop(digest)
+            if uploaded:
+                self._sources[digest] = key_name
+        event.set()
@@ -1,19 +1,36 @@
 
 import os
 import re
+import sys
 import argparse
+import contextlib
+import functools
+import hashlib
 import logging
-import gzip
-import shutil
 import mimetypes
+import sqlite3
+import time
+from collections import deque, namedtuple
 from datetime import datetime
 
-import boto3
-
-from six import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
+from . import compression
 from . import config
-from .prefixcovertree import PrefixCoverTree
+from . import dedupe
+from . import hashing
+from . import history
+from . import keystore
+from . import listing
+from . import lock as _lock
+from . import manifest as _manifest
+from . import orphans
+from . import transfer
+from . import shard as _shard
+from . import stats as _stats
+from . import storage
+from . import tracing
+from .prefixcovertree import PrefixCoverTree, cover_sorted
 
 # Support UTC timezone in 2.7
 try:
@@ -41,9 +58,32 @@ COMPRESSED_EXTENSIONS = frozenset([
 _STORAGE_STANDARD = 'STANDARD'
 _STORAGE_REDUCED_REDUDANCY = 'REDUCED_REDUNDANCY'
 
-logger = logging.getLogger(__name__)
+ACTION_CREATE = 'create'
+ACTION_UPDATE = 'update'
+ACTION_DELETE = 'delete'
+ACTION_SKIP = 'skip'
+ACTION_TRANSITION = 'transition'
+
+# Storage classes of objects that must be restored before they are copied
+_ARCHIVE_STORAGE_CLASSES = frozenset(['GLACIER', 'DEEP_ARCHIVE'])
+
+# Actions of redirects have the redirect location and no path
+Action = namedtuple('Action', ['kind', 'key', 'path', 'etag', 'location'])
+Action.__new__.__defaults__ = (None, None)
+
+# Number of actions held back by the planner while files are hashed
+HASH_WINDOW = 256
+
+# Number of sites that are planned concurrently in a multi-site deploy
+DEFAULT_SITE_CONCURRENCY = 4
+
+# Number of functions printed with --profile
+PROFILE_TOP_FUNCTIONS = 30
+
+# Number of deploys reported with --stats
+DEFAULT_STATS_LIMIT = 20
 
-mimetypes.init()
+logger = logging.getLogger(__name__)
 
 
 def key_name_from_path(path):
@@ -60,157 +100,1139 @@ def key_name_from_path(path):
     return '/'.join(reversed(key_parts))
 
 
-def upload_key(obj, path, cache_rules, dry, storage_class=None):
-    """Upload data in path to key."""
+def _prepare_upload(key_name, path, cache_rules, storage_class=None,
+                    compression_cache=None, precompressed=None):
+    """Read and encode the file at path for upload to key.
 
-    mime_guess = mimetypes.guess_type(obj.key)
+    Return tuple of the body to upload and a dictionary of additional
+    arguments for the PUT request. If compression_cache is given, the
+    compressed body is shared with identical files. If precompressed is
+    given as a tuple of encodings, the first sidecar file found for one of
+    them is uploaded instead and no file is compressed locally.
+    """
+    mime_guess = mimetypes.guess_type(key_name)
     if mime_guess is not None:
         content_type = mime_guess[0]
     else:
         content_type = 'application/octet-stream'
 
-    content_file = open(path, 'rb')
-    try:
-        encoding = None
-
-        cache_control = config.resolve_cache_rules(obj.key, cache_rules)
-        if cache_control is not None:
-            logger.debug('Using cache control: {}'.format(cache_control))
-
-        _, ext = os.path.splitext(path)
-        if ext in COMPRESSED_EXTENSIONS:
-            logger.info('Compressing {}...'.format(obj.key))
-            compressed = BytesIO()
-            gzip_file = gzip.GzipFile(
-                fileobj=compressed, mode='wb', compresslevel=9)
-            try:
-                shutil.copyfileobj(content_file, gzip_file)
-            finally:
-                gzip_file.close()
-            compressed.seek(0)
-            content_file, _ = compressed, content_file.close()  # noqa
-            encoding = 'gzip'
-
-        logger.info('Uploading {}...'.format(obj.key))
+    encoding = None
+    if precompressed is not None:
+        sidecar = compression.find_sidecar(path, precompressed)
+        if sidecar is not None:
+            path, encoding = sidecar
+            logger.debug('Using pre-compressed {}'.format(path))
 
-        if not dry:
-            kwargs = {}
-            if content_type is not None:
-                kwargs['ContentType'] = content_type
-            if cache_control is not None:
-                kwargs['CacheControl'] = cache_control
+    with tracing.span('read', key_name):
+        with open(path, 'rb') as content_file:
+            body = content_file.read()
+
+    cache_control = config.resolve_cache_rules(key_name, cache_rules)
+    if cache_control is not None:
+        logger.debug('Using cache control: {}'.format(cache_control))
+
+    _, ext = os.path.splitext(path)
+    if precompressed is None and ext in COMPRESSED_EXTENSIONS:
+        logger.info('Compressing {}...'.format(key_name))
+        with tracing.span('compress', key_name):
+            if compression_cache is not None:
+                body = compression_cache.compress(body)
+            else:
+                body = compression.gzip_compress(body)
+        encoding = 'gzip'
+
+    kwargs = {}
+    if content_type is not None:
+        kwargs['ContentType'] = content_type
+    if cache_control is not None:
+        kwargs['CacheControl'] = cache_control
+
+    if encoding is not None:
+        kwargs['ContentEncoding'] = encoding
+
+    if storage_class is not None:
+        kwargs['StorageClass'] = storage_class
 
-            if encoding is not None:
-                kwargs['ContentEncoding'] = encoding
+    return body, kwargs
 
-            if storage_class is not None:
-                kwargs['StorageClass'] = storage_class
 
-            obj.put(Body=content_file.read(), **kwargs)
+def _create_client(service, endpoint_url=None):
+    """Create boto3 client, importing boto3 only when first needed."""
+    import boto3
+    return boto3.client(service, endpoint_url=endpoint_url)
+
+
+def _backend_from_config(conf):
+    if 'storage_url' in conf:
+        return conf['storage_url'], conf.get('storage_latency')
+    return conf.get('endpoint_url'), conf['s3_bucket']
+
+
+def _create_s3_client(conf):
+    """Create client of the storage backend configured for the site.
+
+    Without storage_url this is the S3 bucket of the site, accessed through
+    a boto3 client.
+    """
+    if 'storage_url' in conf:
+        return storage.create_storage(
+            conf['storage_url'], latency=conf.get('storage_latency'))
+    return storage.S3Storage(
+        _create_client('s3', endpoint_url=conf.get('endpoint_url')),
+        conf['s3_bucket'])
+
+
+def upload_key(client, bucket_name, key_name, path, cache_rules, dry,
+               storage_class=None, bandwidth=None, compression_cache=None,
+               content_index=None, precompressed=None, verify=False):
+    """Upload data in path to key.
+
+    If bandwidth is given as a :class:`transfer.TokenBucket` the upload
+    waits until the size of the body is available. If content_index is
+    given as a :class:`dedupe.ContentIndex`, a key in the bucket that
+    already holds the same body is copied instead of uploading the body.
+    If verify is True, the upload is skipped if the key already holds the
+    same body and headers, e.g. written by a concurrent deploy.
+    """
+    if dry:
+        # Only estimate the size of the body instead of compressing it
+        if _stats.enabled():
+            _stats.record(_stats.PUT, size=estimate_upload_size(
+                path, precompressed=precompressed))
+        logger.info('Uploading {}...'.format(key_name))
+        return
+
+    body, kwargs = _prepare_upload(
+        key_name, path, cache_rules, storage_class=storage_class,
+        compression_cache=compression_cache, precompressed=precompressed)
+
+    if content_index is None and not verify:
+        _put_body(client, bucket_name, key_name, body, kwargs, dry,
+                  bandwidth)
+        return
+
+    with tracing.span('hash', key_name):
+        digest = hashlib.md5(body).hexdigest()
+
+    if verify and _remote_matches(client, bucket_name, key_name, digest,
+                                  kwargs):
+        logger.info('Already up to date, skipping {}.'.format(key_name))
+        return
+
+    if content_index is None:
+        _put_body(client, bucket_name, key_name, body, kwargs, dry,
+                  bandwidth)
+        return
+
+    with tracing.span('dedupe_wait', key_name):
+        source = content_index.claim(digest)
+    if source is not None:
+        if _copy_key(client, bucket_name, source, key_name, kwargs, dry):
+            return
+        _put_body(client, bucket_name, key_name, body, kwargs, dry,
+                  bandwidth)
+        return
+
+    uploaded = False
+    try:
+        _put_body(client, bucket_name, key_name, body, kwargs, dry,
+                  bandwidth)
+        uploaded = True
     finally:
-        content_file.close()
+        content_index.release(digest, key_name, uploaded)
 
 
-def deploy(conf, base_path, force, dry):
-    """Deploy using given configuration."""
-    bucket_name = conf['s3_bucket']
-    cache_rules = conf.get('cache_rules', [])
-    endpoint_url = conf.get('endpoint_url')
+def _unencoded_body_path(path, precompressed=None):
+    """Return path of the file uploaded unchanged as the body for path.
 
-    if conf.get('s3_reduced_redundancy', False):
-        storage_class = _STORAGE_REDUCED_REDUDANCY
-    else:
-        storage_class = _STORAGE_STANDARD
+    Return None if the body is compressed locally.
+    """
+    if precompressed is not None:
+        sidecar = compression.find_sidecar(path, precompressed)
+        if sidecar is not None:
+            return sidecar[0]
+        return path
 
-    logger.info('Connecting to bucket {}...'.format(bucket_name))
+    _, ext = os.path.splitext(path)
+    if ext in COMPRESSED_EXTENSIONS:
+        return None
+    return path
 
-    s3 = boto3.resource('s3', endpoint_url=endpoint_url)
-    bucket = s3.Bucket(bucket_name)
 
-    site_dir = os.path.join(base_path, conf['site'])
+def estimate_upload_size(path, precompressed=None):
+    """Estimate the size of the body uploaded for the file at path."""
+    body_path = _unencoded_body_path(path, precompressed=precompressed)
+    if body_path is None:
+        return compression.estimate_compressed_size(path)
+    return os.path.getsize(body_path)
+
+
+def _remote_matches(client, bucket_name, key_name, digest, kwargs):
+    """Return True if key holds a body with digest and the same headers."""
+    from botocore.exceptions import ClientError
+
+    try:
+        with tracing.span('verify', key_name):
+            head = client.head_object(Bucket=bucket_name, Key=key_name)
+        _stats.record(_stats.HEAD)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in (
+                '404', 'NoSuchKey', 'NotFound'):
+            raise
+        return False
+
+    if dedupe.digest_from_etag(head.get('ETag')) != digest:
+        return False
+    for name in ('ContentType', 'CacheControl', 'ContentEncoding'):
+        if head.get(name) != kwargs.get(name):
+            return False
+    return (head.get('StorageClass', _STORAGE_STANDARD) ==
+            kwargs.get('StorageClass', _STORAGE_STANDARD))
+
+
+def _put_body(client, bucket_name, key_name, body, kwargs, dry, bandwidth):
+    logger.info('Uploading {}...'.format(key_name))
+
+    if not dry:
+        if bandwidth is not None:
+            with tracing.span('throttle', key_name):
+                bandwidth.consume(len(body))
+        with tracing.span('upload', key_name):
+            client.put_object(
+                Bucket=bucket_name, Key=key_name, Body=body, **kwargs)
+        _stats.record(_stats.PUT, size=len(body))
+
+
+def _copy_key(client, bucket_name, source, key_name, kwargs, dry):
+    """Copy source key to key within the bucket, replacing the metadata.
 
-    logger.info('Site: {}'.format(site_dir))
+    Return False if the copy failed, e.g. because the source was removed
+    in the meantime.
+    """
+    from botocore.exceptions import ClientError
 
-    processed_keys = set()
-    updated_keys = set()
+    logger.info('Copying {} from identical {}...'.format(key_name, source))
 
-    for obj in bucket.objects.all():
-        processed_keys.add(obj.key)
-        path = os.path.join(site_dir, obj.key)
+    if not dry:
+        try:
+            with tracing.span('copy', key_name):
+                client.copy_object(
+                    Bucket=bucket_name, Key=key_name,
+                    CopySource=dict(Bucket=bucket_name, Key=source),
+                    MetadataDirective='REPLACE', **kwargs)
+            _stats.record(_stats.COPY)
+        except ClientError:
+            logger.warning('Unable to copy {} from {}, uploading'.format(
+                key_name, source), exc_info=True)
+            return False
 
-        # Delete keys that have been deleted locally
-        if not os.path.isfile(path):
-            logger.info('Deleting {}...'.format(obj.key))
-            if not dry:
-                obj.delete()
-            updated_keys.add(obj.key)
+    return True
+
+
+def iter_site_files(site_dir, precompressed=None, prefix=''):
+    """Iterate over the files of the site in key order.
+
+    Yields tuples of key name and path. Directories are visited so that
+    the keys are produced in the same lexicographic order as S3 lists
+    them. Symbolic links to directories are not followed. If precompressed
+    is given as a tuple of encodings, sidecar files of those encodings are
+    not part of the site. If prefix is given as returned by
+    :func:`config.scope_prefix`, only the subdirectory of the prefix is
+    visited.
+    """
+    def sort_key(entry):
+        name, is_dir = entry
+        return name + '/' if is_dir else name
+
+    def walk(dirpath, key_prefix):
+        entries = []
+        for name in os.listdir(dirpath):
+            path = os.path.join(dirpath, name)
+            if os.path.isdir(path):
+                if not os.path.islink(path):
+                    entries.append((name, True))
+            elif os.path.isfile(path):
+                entries.append((name, False))
+
+        if precompressed is not None:
+            names = frozenset(name for name, is_dir in entries if not is_dir)
+            entries = [
+                (name, is_dir) for name, is_dir in entries
+                if is_dir or not compression.is_sidecar(
+                    name, names, precompressed)]
+
+        for name, is_dir in sorted(entries, key=sort_key):
+            path = os.path.join(dirpath, name)
+            if is_dir:
+                for item in walk(path, key_prefix + name + '/'):
+                    yield item
+            else:
+                yield key_prefix + name, path
+
+    if prefix == '':
+        return walk(site_dir, '')
+
+    scope_dir = os.path.join(site_dir, *prefix.rstrip('/').split('/'))
+    if not os.path.isdir(scope_dir) or os.path.islink(scope_dir):
+        return iter(())
+    return walk(scope_dir, prefix)
+
+
+def iter_local_keys(site_dir, precompressed=None, redirects=(), prefix=''):
+    """Iterate over the files and redirects of the site in key order.
+
+    Yields tuples of key name, path and redirect location, where the
+    location is None for files and the path is None for redirects. The
+    redirects are pairs of key name and location in key order. A redirect
+    replaces a file with the same key. Only keys starting with prefix are
+    included.
+    """
+    redirects = iter([redirect for redirect in redirects
+                      if redirect[0].startswith(prefix)])
+    redirect = next(redirects, None)
+    for key_name, path in iter_site_files(
+            site_dir, precompressed=precompressed, prefix=prefix):
+        while redirect is not None and redirect[0] < key_name:
+            yield redirect[0], None, redirect[1]
+            redirect = next(redirects, None)
+        if redirect is not None and redirect[0] == key_name:
+            logger.warning('Redirect replaces file {}'.format(key_name))
             continue
+        yield key_name, path, None
+
+    while redirect is not None:
+        yield redirect[0], None, redirect[1]
+        redirect = next(redirects, None)
+
+
+def plan_actions(objects, site_dir, force, storage_class, key_filter=None,
+                 immutable=None, precompressed=None, storage_class_rules=(),
+                 hasher=None, redirects=(), prefix=''):
+    """Compare remote objects to the local site and plan actions.
+
+    The objects are the remote objects in key order, listed with prefix
+    if the deploy is scoped to the keys starting with prefix. The remote
+    listing and the local files are merged in key order, so an
+    :class:`Action` is yielded as soon as each key is resolved and neither
+    side has to be held in memory. If key_filter is given, keys for which
+    it returns False are ignored. Keys for which immutable returns True are
+    never updated once present, unless forced. Sidecar files of the
+    precompressed encodings are not planned as keys of their own. Keys
+    that are not modified but have another storage class than
+    storage_class_rules select for them (or storage_class) are planned as
+    transitions.
+
+    The redirects are pairs of key name and location in key order. They are
+    planned with the location in the action and are only updated if the
+    ETag of the remote object differs from :func:`redirect_etag`.
+
+    If hasher is given as a :class:`hashing.Hasher`, keys whose files are
+    newer than the remote objects are only updated if the contents differ
+    from the ETag. Files are hashed in the background and up to
+    ``HASH_WINDOW`` actions are held back while their digests are pending.
+    Files that are compressed locally are not hashed.
+    """
+    def unchanged_action(obj, path):
+        expected = config.resolve_storage_class(
+            obj.key, storage_class_rules, storage_class)
+        if obj.storage_class == expected:
+            return Action(ACTION_SKIP, obj.key, path, obj.etag)
+        if obj.storage_class not in _ARCHIVE_STORAGE_CLASSES:
+            return Action(ACTION_TRANSITION, obj.key, path, obj.etag)
+        return Action(ACTION_UPDATE, obj.key, path, obj.etag)
+
+    def compare_content(obj, path, body_path):
+        future = hasher.submit(body_path)
+
+        def resolve():
+            with tracing.span('hash_wait', obj.key):
+                digest = future.result()
+            if hashing.etag_matches(digest, obj.etag):
+                return unchanged_action(obj, path)
+            return Action(ACTION_UPDATE, obj.key, path, obj.etag)
+        return resolve
+
+    def redirect_action(obj, key_name, location):
+        if obj is None:
+            return Action(ACTION_CREATE, key_name, None, location=location)
+        if not force and hashing.etag_matches(
+                hashing.Digest(redirect_etag(location), None), obj.etag):
+            return Action(ACTION_SKIP, obj.key, None, obj.etag, location)
+        return Action(ACTION_UPDATE, obj.key, None, obj.etag, location)
+
+    def remote_action(obj, path):
+        if path is None:
+            # Delete keys that have been deleted locally
+            return Action(ACTION_DELETE, obj.key, os.path.join(
+                site_dir, obj.key), obj.etag)
+
+        if not force and immutable is not None and immutable(obj.key):
+            return Action(ACTION_SKIP, obj.key, path, obj.etag)
 
         # Skip keys that have not been updated
-        mtime = datetime.fromtimestamp(os.path.getmtime(path), UTC)
-        if not force:
-            if (mtime <= obj.last_modified and
-                    obj.storage_class == storage_class):
-                logger.info('Not modified, skipping {}.'.format(obj.key))
-                continue
-
-        upload_key(obj, path, cache_rules, dry, storage_class=storage_class)
-        updated_keys.add(obj.key)
-
-    for dirpath, dirnames, filenames in os.walk(site_dir):
-        key_base = os.path.relpath(dirpath, site_dir)
-        for name in filenames:
-            path = os.path.join(dirpath, name)
-            key_name = key_name_from_path(os.path.join(key_base, name))
-            if key_name in processed_keys:
-                continue
+        with tracing.span('stat', obj.key):
+            mtime = datetime.fromtimestamp(os.path.getmtime(path), UTC)
+        if not force and mtime <= obj.last_modified:
+            return unchanged_action(obj, path)
 
-            # Create new object
-            obj = bucket.Object(key_name)
+        if not force and hasher is not None:
+            body_path = _unencoded_body_path(path, precompressed=precompressed)
+            if body_path is not None:
+                return compare_content(obj, path, body_path)
 
-            logger.info('Creating key {}...'.format(obj.key))
+        return Action(ACTION_UPDATE, obj.key, path, obj.etag)
 
-            upload_key(
-                obj, path, cache_rules, dry, storage_class=storage_class)
-            updated_keys.add(key_name)
+    def key_action(obj, local_file):
+        if local_file is None:
+            return remote_action(obj, None)
+        key_name, path, location = local_file
+        if location is not None:
+            return redirect_action(obj, key_name, location)
+        if obj is None:
+            return Action(ACTION_CREATE, key_name, path)
+        return remote_action(obj, path)
 
-    logger.info('Bucket update done.')
+    remote = iter(objects)
+    local = iter_local_keys(
+        site_dir, precompressed=precompressed, redirects=redirects,
+        prefix=prefix)
+    obj = next(remote, None)
+    local_file = next(local, None)
 
-    # Invalidate files in cloudfront distribution
-    if 'cloudfront_distribution_id' in conf:
-        logger.info('Connecting to Cloudfront distribution {}...'.format(
-            conf['cloudfront_distribution_id']))
+    # Actions in key order, or functions resolving them once hashed
+    pending = deque()
+
+    while obj is not None or local_file is not None:
+        if local_file is None or (
+                obj is not None and obj.key < local_file[0]):
+            key_name, matched_obj, matched_file = obj.key, obj, None
+            obj = next(remote, None)
+        elif obj is None or local_file[0] < obj.key:
+            key_name, matched_obj, matched_file = (
+                local_file[0], None, local_file)
+            local_file = next(local, None)
+        else:
+            key_name, matched_obj, matched_file = obj.key, obj, local_file
+            obj = next(remote, None)
+            local_file = next(local, None)
+
+        # Keys of other shards are neither stat'ed nor hashed
+        if key_filter is not None and not key_filter(key_name):
+            continue
+
+        action = key_action(matched_obj, matched_file)
+        pending.append(action)
+        while len(pending) > 0 and (not callable(pending[0]) or
+                                    len(pending) > HASH_WINDOW):
+            yield _resolve_action(pending.popleft())
+
+    while len(pending) > 0:
+        yield _resolve_action(pending.popleft())
 
-        index_pattern = None
+
+def _resolve_action(item):
+    return item() if callable(item) else item
+
+
+class InvalidationPlan(object):
+    """Incrementally computes the paths to invalidate in CloudFront.
+
+    Keys are added as they are resolved by the planner. Keys that were
+    updated are included and unchanged keys are excluded from the smallest
+    set of covering path prefixes. Fingerprinted keys are never cached
+    stale, so they are neither included nor excluded.
+
+    With the memory_limit option the paths are spilled to a sorted store on
+    disk instead of building a tree in memory, and the covering prefixes
+    are computed by streaming the sorted paths.
+
+    In a deploy scoped to prefix only keys below the prefix are added, and
+    wildcard paths are narrowed so they do not extend beyond the prefix.
+    """
+    def __init__(self, conf, prefix=''):
+        self._prefix = prefix
+        self._fingerprint = config.fingerprint_pattern(conf)
+        self._index_pattern = None
         if 'index_document' in conf:
             index_doc = conf['index_document']
-            index_pattern = r'(^(?:.*/)?)' + re.escape(index_doc) + '$'
+            self._index_pattern = re.compile(
+                r'(^(?:.*/)?)' + re.escape(index_doc) + '$')
+        self._tree = None
+        self._store = None
+        if conf.get('memory_limit') is not None:
+            self._store = keystore.SortedKeyStore(
+                config.size_from_string(conf['memory_limit']))
+        else:
+            self._tree = PrefixCoverTree()
+
+    def _path_from_key_name(self, key_name):
+        if self._index_pattern is not None:
+            m = self._index_pattern.match(key_name)
+            if m:
+                return m.group(1)
+        return key_name
+
+    def _ignored(self, key_name):
+        return (self._fingerprint is not None and
+                self._fingerprint.search(key_name) is not None)
 
-        def path_from_key_name(key_name):
-            if index_pattern is not None:
-                m = re.match(index_pattern, key_name)
-                if m:
-                    return m.group(1)
-            return key_name
+    def add_updated(self, key_name):
+        """Add key that was updated, created or deleted."""
+        if self._ignored(key_name):
+            return
+        path = self._path_from_key_name(key_name)
+        if self._store is not None:
+            self._store.add(path, True)
+            return
+        try:
+            self._tree.include(path)
+        except ValueError:
+            # Already excluded through another key mapping to the same
+            # path (e.g. an index document). Exclusion takes precedence.
+            pass
 
-        t = PrefixCoverTree()
-        for key_name in updated_keys:
-            t.include(path_from_key_name(key_name))
-        for key_name in processed_keys - updated_keys:
-            t.exclude(path_from_key_name(key_name))
+    def add_unchanged(self, key_name):
+        """Add key that was left unchanged."""
+        if self._ignored(key_name):
+            return
+        path = self._path_from_key_name(key_name)
+        if self._store is not None:
+            self._store.add(path, False)
+        else:
+            self._tree.exclude(path)
+
+    def add_action(self, action):
+        """Add the key of a planned action."""
+        if action.kind in (ACTION_SKIP, ACTION_TRANSITION):
+            self.add_unchanged(action.key)
+        else:
+            self.add_updated(action.key)
+
+    def paths(self):
+        """Return the list of paths to invalidate."""
+        if self._store is not None:
+            matches = cover_sorted(self._store)
+        else:
+            matches = self._tree.matches()
 
         paths = []
-        for prefix, exact in t.matches():
-            path = '/' + prefix + ('' if exact else '*')
-            logger.info('Preparing to invalidate {}...'.format(path))
-            paths.append(path)
+        try:
+            for prefix, exact in matches:
+                if not exact and self._prefix.startswith(prefix):
+                    # Keys outside the scope were not compared
+                    prefix = self._prefix
+                path = '/' + prefix + ('' if exact else '*')
+                logger.info('Preparing to invalidate {}...'.format(path))
+                paths.append(path)
+        finally:
+            if self._store is not None:
+                self._store.close()
+
+        return paths
+
+
+def _storage_class_from_config(conf):
+    if conf.get('s3_reduced_redundancy', False):
+        return _STORAGE_REDUCED_REDUDANCY
+    return _STORAGE_STANDARD
+
+
+def transition_key(client, bucket_name, key_name, storage_class, dry):
+    """Change the storage class of key by copying it onto itself.
+
+    Return False if the copy failed, e.g. because the object is archived.
+    """
+    from botocore.exceptions import ClientError
+
+    logger.info('Changing storage class of {} to {}...'.format(
+        key_name, storage_class))
+    _stats.record(_stats.COPY)
+
+    if not dry:
+        try:
+            with tracing.span('transition', key_name):
+                client.copy_object(
+                    Bucket=bucket_name, Key=key_name,
+                    CopySource=dict(Bucket=bucket_name, Key=key_name),
+                    MetadataDirective='COPY', StorageClass=storage_class)
+        except ClientError:
+            logger.warning('Unable to change storage class of {}'.format(
+                key_name), exc_info=True)
+            return False
+
+    return True
+
+
+def _transition_or_upload(client, bucket_name, key_name, path, cache_rules,
+                          dry, storage_class=None, **kwargs):
+    """Transition key to storage class, uploading it if that fails."""
+    if not transition_key(client, bucket_name, key_name, storage_class, dry):
+        upload_key(client, bucket_name, key_name, path, cache_rules, dry,
+                   storage_class=storage_class, **kwargs)
+
+
+def redirect_body(location):
+    """Return the body of the redirect object to location.
+
+    The body holds the location so that the ETag of the object identifies
+    the redirect and unchanged redirects are found from the listing.
+    """
+    return location.encode('utf-8')
+
+
+def redirect_etag(location):
+    """Return the ETag of the redirect object to location."""
+    return hashlib.md5(redirect_body(location)).hexdigest()
+
+
+def _prepare_redirect(key_name, location, cache_rules):
+    """Return tuple of body and PUT arguments of a redirect object."""
+    kwargs = dict(ContentType='text/plain', WebsiteRedirectLocation=location)
+    cache_control = config.resolve_cache_rules(key_name, cache_rules)
+    if cache_control is not None:
+        kwargs['CacheControl'] = cache_control
+    return redirect_body(location), kwargs
+
+
+def put_redirect(client, bucket_name, key_name, location, cache_rules, dry):
+    """Write object redirecting key to location."""
+    logger.info('Redirecting {} to {}...'.format(key_name, location))
+    body, kwargs = _prepare_redirect(key_name, location, cache_rules)
+    _stats.record(_stats.PUT, size=len(body))
+
+    if not dry:
+        with tracing.span('redirect', key_name):
+            client.put_object(
+                Bucket=bucket_name, Key=key_name, Body=body, **kwargs)
+
+
+def delete_key(client, bucket_name, key_name, dry):
+    """Delete key."""
+    logger.info('Deleting {}...'.format(key_name))
+    _stats.record(_stats.DELETE)
+
+    if not dry:
+        with tracing.span('delete', key_name):
+            client.delete_object(Bucket=bucket_name, Key=key_name)
+
+
+def _bandwidth_from_config(conf):
+    if conf.get('max_bandwidth') is None:
+        return None
+    return transfer.TokenBucket(config.size_from_string(conf['max_bandwidth']))
+
+
+def _hasher_from_config(conf, base_path):
+    """Return :class:`hashing.Hasher` if contents are compared, or None."""
+    if not conf.get('compare_content', False):
+        return None
+
+    cache = None
+    if 'hash_cache' in conf:
+        cache = hashing.DigestCache(
+            os.path.join(base_path, conf['hash_cache']))
+    return hashing.Hasher(
+        cache=cache, workers=conf.get('hash_workers', hashing.DEFAULT_WORKERS))
+
+
+def _immutable_from_config(conf):
+    """Return predicate matching fingerprinted keys, or None."""
+    pattern = config.fingerprint_pattern(conf)
+    if pattern is None:
+        return None
+    return pattern.search
+
+
+def _deferred_deletion(conf, client):
+    """Return :class:`orphans.DeferredDeletion` for the bucket, or None.
+
+    Deletion of all keys is deferred with the defer_deletion option, and
+    deletion of fingerprinted keys is always deferred.
+    """
+    if conf.get('defer_deletion', False):
+        deferred = lambda key_name: True  # noqa: E731
+    else:
+        deferred = _immutable_from_config(conf)
+        if deferred is None:
+            return None
+
+    ledger = orphans.OrphanLedger.load(client, conf['s3_bucket'])
+    return orphans.DeferredDeletion(
+        ledger, deferred,
+        conf.get('orphan_grace_period', orphans.DEFAULT_GRACE_PERIOD))
 
+
+def _min_upload_priority(priority_rules):
+    return min([0] + [rule.priority for rule in priority_rules])
+
+
+def _record_shard_action(result, action):
+    """Record action in the result of a sharded deploy."""
+    if action.kind != ACTION_CREATE:
+        result['processed'].append(action.key)
+    if action.kind == ACTION_DELETE:
+        result['deleted'].append(action.key)
+    elif action.kind not in (ACTION_SKIP, ACTION_TRANSITION):
+        result['updated'].append(action.key)
+
+
+def deploy(conf, base_path, force, dry, shard=None, concurrency=None,
+           prefix=''):
+    """Deploy using given configuration.
+
+    If shard is given as a tuple of shard index and count, only the keys
+    in that shard are processed. Deletions and invalidation are then
+    deferred to :func:`merge_shards` and the shard result is returned.
+    If prefix is given as returned by :func:`config.scope_prefix`, only
+    the keys of that subdirectory are listed, compared and invalidated.
+    """
+    conf = config.compile_config(conf)
+    if concurrency is None:
+        concurrency = conf.get('concurrency', transfer.DEFAULT_CONCURRENCY)
+
+    logger.info('Connecting to bucket {}...'.format(conf['s3_bucket']))
+
+    client = _create_s3_client(conf)
+
+    with _recorded_history(conf, base_path, dry), \
+            transfer.TransferEngine(concurrency) as engine:
+        result = _deploy_site(
+            conf, base_path, force, dry, client, engine.group(),
+            shard=shard, prefix=prefix)
+        engine.join()
+
+    return result
+
+
+def deploy_sites(targets, base_path, force, dry, concurrency=None,
+                 prefix=''):
+    """Deploy several sites in one run.
+
+    The targets are the configurations of each site. All sites share one
+    transfer engine (and so one limit on concurrent requests), one S3
+    client per endpoint and a cache of compressed files so that files
+    shared between sites are compressed once. Raises RuntimeError after
+    all sites were processed if any of them failed.
+    """
+    targets = [config.compile_config(conf) for conf in targets]
+    if len(targets) == 0:
+        return
+
+    if concurrency is None:
+        concurrency = targets[0].get(
+            'concurrency', transfer.DEFAULT_CONCURRENCY)
+    site_concurrency = targets[0].get(
+        'site_concurrency', DEFAULT_SITE_CONCURRENCY)
+
+    clients = {}
+    for conf in targets:
+        backend = _backend_from_config(conf)
+        if backend not in clients:
+            clients[backend] = _create_s3_client(conf)
+
+    # Bandwidth limit and compressed files are shared by all sites
+    bandwidth = _bandwidth_from_config(targets[0])
+    compression_cache = compression.CompressionCache()
+    failed = []
+
+    # The run is recorded once in the history of the first target
+    bucket_label = ', '.join(conf['s3_bucket'] for conf in targets)
+    with _recorded_history(targets[0], base_path, dry, bucket_label):
+        with transfer.TransferEngine(concurrency) as engine:
+            with ThreadPoolExecutor(max_workers=site_concurrency) as executor:
+                futures = []
+                for conf in targets:
+                    logger.info('Connecting to bucket {}...'.format(
+                        conf['s3_bucket']))
+                    futures.append((conf, executor.submit(
+                        _deploy_site, conf, base_path, force, dry,
+                        clients[_backend_from_config(conf)], engine.group(),
+                        compression_cache=compression_cache,
+                        bandwidth=bandwidth, prefix=prefix)))
+
+                for conf, future in futures:
+                    try:
+                        future.result()
+                    except Exception:
+                        logger.exception('Failed to deploy {}'.format(
+                            conf['s3_bucket']))
+                        failed.append(conf['s3_bucket'])
+
+            engine.join()
+
+        logger.debug('Compression cache: {} hits, {} misses'.format(
+            compression_cache.hits, compression_cache.misses))
+
+        if len(failed) > 0:
+            raise RuntimeError(
+                'Failed to deploy: {}'.format(', '.join(failed)))
+
+
+def _deploy_site(conf, base_path, force, dry, client, transfers, shard=None,
+                 compression_cache=None, bandwidth=None, prefix=''):
+    """Deploy one site submitting transfers to the transfer group.
+
+    If bandwidth is not given, a bandwidth limit is created from the
+    configuration of the site. Unless sharded, the site is deployed while
+    holding the lock of the bucket if the lock option is enabled.
+    """
+    with _bucket_lock(conf, client, dry or shard is not None) as deploy_lock:
+        hasher = _hasher_from_config(conf, base_path)
+        try:
+            return _sync_site(
+                conf, base_path, force, dry, client, transfers, shard=shard,
+                compression_cache=compression_cache, bandwidth=bandwidth,
+                hasher=hasher, prefix=prefix, lock=deploy_lock)
+        finally:
+            if hasher is not None:
+                hasher.close()
+
+
+@contextlib.contextmanager
+def _recorded_history(conf, base_path, dry, bucket_label=None):
+    """Append a record of the deploy to the history if it is configured.
+
+    Statistics are collected for the duration of the deploy unless they
+    are already being collected. Failing to write the history does not
+    fail the deploy.
+    """
+    if 'history' not in conf:
+        yield
+        return
+
+    owned = not _stats.enabled()
+    deploy_stats = _stats.start() if owned else _stats.current()
+    started = time.time()
+    status = 'failed'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        if owned:
+            _stats.stop()
+        record = history.make_record(
+            bucket_label or conf['s3_bucket'], started,
+            time.time() - started, deploy_stats, dry=dry, status=status)
+        path = os.path.join(base_path, conf['history'])
+        try:
+            history.append(path, record)
+        except sqlite3.Error as e:
+            logger.warning('Failed to write history {}: {}'.format(path, e))
+
+
+@contextlib.contextmanager
+def _bucket_lock(conf, client, dry):
+    """Hold the lock of the bucket during the block if configured.
+
+    Yields the lock, or None without locking. Raises RuntimeError if the
+    lock was lost before the block finished.
+    """
+    if dry or not conf.get('lock', False):
+        yield None
+        return
+
+    deploy_lock = _lock.DeployLock(
+        client, conf['s3_bucket'],
+        ttl=conf.get('lock_ttl', _lock.DEFAULT_TTL),
+        timeout=conf.get('lock_timeout', _lock.DEFAULT_TIMEOUT))
+    with _stats.phase('lock'):
+        deploy_lock.acquire()
+    try:
+        yield deploy_lock
+        deploy_lock.check()
+    finally:
+        deploy_lock.release()
+
+
+class SyncPlan(object):
+    """Plans the actions of one site and keeps the records of the deploy.
+
+    Iterating yields the actions that require a request, in key order.
+    Every planned action is also recorded in the deferred deletions, the
+    invalidation, the manifest, the shard result and the statistics, so
+    the deploy engines only differ in how they execute the yielded
+    actions. Call :meth:`finish` once all actions were executed.
+
+    If the lock of the bucket is given, the deploy stops with RuntimeError
+    before the next request once the lock was lost.
+    """
+    def __init__(self, conf, base_path, force, dry, client, shard=None,
+                 hasher=None, prefix='', lock=None):
+        self._conf = conf
+        self._lock = lock
+        self._base_path = base_path
+        self._dry = dry
+        self._client = client
+        self._prefix = prefix
+        self._started = None
+
+        bucket_name = conf['s3_bucket']
+        site_dir = os.path.join(base_path, conf['site'])
+        logger.info('Site: {}'.format(site_dir))
+        if prefix != '':
+            logger.info('Scope: {}'.format(prefix))
+
+        key_filter = None
+        self.result = None
+        if shard is not None:
+            logger.info('Processing shard {}/{}'.format(*shard))
+            key_filter = functools.partial(_shard.key_in_shard, shard=shard)
+            self.result = dict(
+                shard=list(shard), processed=[], updated=[], deleted=[])
+
+        self.invalidation = None
+        if shard is None and 'cloudfront_distribution_id' in conf:
+            self.invalidation = InvalidationPlan(conf, prefix=prefix)
+
+        # Unchanged remote keys and keys uploaded in this run are the
+        # sources of server-side copies of identical files.
+        self.content_index = None
+        if conf.get('deduplicate', False):
+            self.content_index = dedupe.ContentIndex()
+
+        self.manifest = None
+        # A scoped deploy does not know the state of the whole site
+        if shard is None and prefix == '' and not dry and 'manifest' in conf:
+            self.manifest = _manifest.ManifestBuilder(
+                bucket_name, precompressed=conf.get('precompressed'))
+
+        # Deletions can be deferred so that old pages referencing the keys
+        # keep working for a grace period.
+        self.deletion = None
+        if shard is None:
+            self.deletion = _deferred_deletion(conf, client)
+
+        objects = _lock.exclude_lock(orphans.exclude_ledger(
+            listing.list_objects(
+                client, bucket_name, prefix=prefix,
+                concurrency=conf.get('list_concurrency',
+                                     listing.DEFAULT_CONCURRENCY))))
+        self._actions = plan_actions(
+            objects, site_dir, force, _storage_class_from_config(conf),
+            key_filter=key_filter, immutable=_immutable_from_config(conf),
+            precompressed=conf.get('precompressed'),
+            storage_class_rules=conf.get('storage_class_rules', ()),
+            hasher=hasher, redirects=conf.get('redirects', ()),
+            prefix=prefix)
+
+    def __iter__(self):
+        self._started = time.time()
+        for action in self._actions:
+            if self._record(action):
+                if self._lock is not None:
+                    self._lock.check()
+                yield action
+
+    def _record(self, action):
+        """Record action and return True if it requires a request."""
+        _stats.record_action(action.kind)
+        postponed = None
+        if self.deletion is not None:
+            if action.kind != ACTION_DELETE:
+                self.deletion.keep(action.key)
+            elif self.deletion.manages(action.key):
+                postponed = self.deletion.postpone(action.key)
+
+        if self.invalidation is not None:
+            if postponed:
+                self.invalidation.add_unchanged(action.key)
+            else:
+                self.invalidation.add_action(action)
+        if self.result is not None:
+            _record_shard_action(self.result, action)
+        if (self.manifest is not None and action.kind != ACTION_DELETE and
+                action.location is None):
+            self.manifest.add(action.key, action.path)
+
+        if action.kind == ACTION_SKIP:
+            logger.info('Not modified, skipping {}.'.format(action.key))
+            if self.content_index is not None and action.location is None:
+                self.content_index.add(action.etag, action.key)
+            return False
+
+        if action.kind == ACTION_DELETE:
+            if self.result is not None:
+                logger.info('Deferring deletion of {}.'.format(action.key))
+                return False
+            if postponed is not None:
+                # Deleted later, or now by the batched collection
+                return False
+        return True
+
+    def finish(self):
+        """Delete expired keys, save the manifest and invalidate.
+
+        Return the shard result in a sharded deploy.
+        """
+        if self._started is not None:
+            _stats.record_phase('sync', time.time() - self._started)
+
+        if self._lock is not None:
+            self._lock.check()
+
+        if self.deletion is not None:
+            with _stats.phase('delete'):
+                self.deletion.collect(
+                    self._client, self._conf['s3_bucket'], self._dry,
+                    prefix=self._prefix)
+
+        logger.info('Bucket update done.')
+
+        if self.manifest is not None:
+            self.manifest.save(_manifest_path(self._conf, self._base_path))
+
+        if self.result is not None:
+            return self.result
+
+        if self.invalidation is not None:
+            _invalidate(self._conf, self.invalidation.paths(), self._dry)
+
+
+def _sync_site(conf, base_path, force, dry, client, transfers, shard=None,
+               compression_cache=None, bandwidth=None, hasher=None,
+               prefix='', lock=None):
+    bucket_name = conf['s3_bucket']
+    cache_rules = conf.get('cache_rules', [])
+    storage_class = _storage_class_from_config(conf)
+    storage_class_rules = conf.get('storage_class_rules', ())
+    if bandwidth is None:
+        bandwidth = _bandwidth_from_config(conf)
+    priority_rules = conf.get('upload_priority', [])
+    precompressed = conf.get('precompressed')
+    verify = conf.get('verify_uploads', False)
+
+    plan = SyncPlan(conf, base_path, force, dry, client, shard=shard,
+                    hasher=hasher, prefix=prefix, lock=lock)
+
+    # Actions are resolved in key order and handed to the transfer engine
+    # immediately, so only the keys in flight are held in memory.
+    scheduler = transfer.PriorityScheduler(
+        transfers, min_priority=_min_upload_priority(priority_rules))
+    for action in plan:
+        if action.kind == ACTION_DELETE:
+            transfers.submit(
+                delete_key, client, bucket_name, action.key, dry)
+        elif action.location is not None:
+            scheduler.submit(
+                config.resolve_upload_priority(action.key, priority_rules),
+                put_redirect, client, bucket_name, action.key,
+                action.location, cache_rules, dry)
+        else:
+            if action.kind == ACTION_CREATE:
+                logger.info('Creating key {}...'.format(action.key))
+            func = upload_key
+            if action.kind == ACTION_TRANSITION:
+                func = _transition_or_upload
+            scheduler.submit(
+                config.resolve_upload_priority(
+                    action.key, priority_rules),
+                func, client, bucket_name, action.key, action.path,
+                cache_rules, dry,
+                storage_class=config.resolve_storage_class(
+                    action.key, storage_class_rules, storage_class),
+                bandwidth=bandwidth, compression_cache=compression_cache,
+                content_index=plan.content_index,
+                precompressed=precompressed, verify=verify)
+
+    scheduler.flush()
+    transfers.wait()
+    return plan.finish()
+
+
+def _manifest_path(conf, base_path):
+    return os.path.join(base_path, conf['manifest'])
+
+
+def check(conf, base_path):
+    """Return list of keys that changed locally since the last deploy.
+
+    The changes are determined from the local manifest only, without
+    contacting S3. Raises ValueError if the manifest is not configured.
+    If the manifest is missing every key is considered changed.
+    """
+    conf = config.compile_config(conf)
+    if 'manifest' not in conf:
+        raise ValueError('The manifest option is required for checking')
+
+    site_dir = os.path.join(base_path, conf['site'])
+    files = _manifest.load_manifest(
+        _manifest_path(conf, base_path), conf['s3_bucket'])
+    if files is None:
+        files = {}
+
+    precompressed = conf.get('precompressed')
+    return list(_manifest.changed_keys(files, iter_site_files(
+        site_dir, precompressed=precompressed), precompressed=precompressed))
+
+
+def merge_shards(conf, results, dry):
+    """Finish a sharded deploy from the results of all shards.
+
+    Deletes the keys that the shards found to be deleted locally and
+    creates one invalidation covering the keys updated by every shard.
+    """
+    conf = config.compile_config(conf)
+    processed_keys, updated_keys, deleted_keys = _shard.merge_results(
+        results)
+
+    bucket_name = conf['s3_bucket']
+    logger.info('Connecting to bucket {}...'.format(bucket_name))
+
+    client = _create_s3_client(conf)
+
+    with _bucket_lock(conf, client, dry):
+        deletion = _deferred_deletion(conf, client)
+        if deletion is None:
+            _shard.delete_keys(client, bucket_name, deleted_keys, dry)
+            updated_keys |= deleted_keys
+        else:
+            for key_name in processed_keys - deleted_keys:
+                deletion.keep(key_name)
+            managed = set(
+                key_name for key_name in deleted_keys
+                if deletion.manages(key_name))
+            postponed = set(
+                key_name for key_name in sorted(managed)
+                if deletion.postpone(key_name))
+            _shard.delete_keys(
+                client, bucket_name, deleted_keys - managed, dry)
+            deletion.collect(client, bucket_name, dry)
+            updated_keys |= deleted_keys - postponed
+
+    logger.info('Bucket update done.')
+
+    if 'cloudfront_distribution_id' in conf:
+        paths = invalidation_paths(conf, processed_keys, updated_keys)
+        _invalidate(conf, paths, dry)
+
+
+def _invalidate(conf, paths, dry):
+    """Invalidate paths in the configured cloudfront distribution."""
+    logger.info('Connecting to Cloudfront distribution {}...'.format(
+        conf['cloudfront_distribution_id']))
+    _stats.record_invalidation(paths)
+    with tracing.span('invalidate'), _stats.phase('invalidate'):
         invalidate_paths(conf['cloudfront_distribution_id'], paths, dry)
 
 
+def invalidation_paths(conf, processed_keys, updated_keys):
+    """Return the smallest list of CloudFront paths covering updated keys.
+
+    Keys that were processed but not updated are excluded from the
+    invalidation.
+    """
+    plan = InvalidationPlan(conf)
+    for key_name in updated_keys:
+        plan.add_updated(key_name)
+    for key_name in processed_keys - updated_keys:
+        plan.add_unchanged(key_name)
+
+    return plan.paths()
+
+
 def invalidate_paths(dist_id, paths, dry):
     """Invalidate CloudFront distribution paths."""
-    cloudfront = boto3.client('cloudfront')
+    cloudfront = _create_client('cloudfront')
     if len(paths) > 0:
         if not dry:
             logger.info('Creating invalidation request...')
@@ -243,12 +1265,191 @@ def main(command_args=None):
     parser.add_argument(
         '-n', '--dry-run', action='store_true', dest='dry',
         help='run without uploading any files')
+    parser.add_argument(
+        '--async', action='store_true', dest='use_async',
+        help='use the asyncio deploy engine (requires aiobotocore)')
+    parser.add_argument(
+        '-j', '--concurrency', type=int, dest='concurrency', default=None,
+        help='maximum number of concurrent requests')
+    parser.add_argument(
+        '--shard', type=_shard.parse_shard, dest='shard', default=None,
+        metavar='I/N',
+        help='only process shard I of N and defer deletions to --merge-shard')
+    parser.add_argument(
+        '--shard-output', dest='shard_output', default=None, metavar='FILE',
+        help='file to write the shard result to (required with --shard)')
+    parser.add_argument(
+        '--merge-shard', action='append', dest='merge_shards', default=None,
+        metavar='FILE',
+        help='merge shard result file (repeat for every shard), then delete '
+             'keys and invalidate in one pass')
+    parser.add_argument(
+        '--prefix', type=config.scope_prefix, dest='prefix', default='',
+        metavar='PATH',
+        help='only deploy the keys below PATH, e.g. /docs/')
+    parser.add_argument(
+        '--check', action='store_true', dest='check',
+        help='only check whether anything changed since the last deploy '
+             'using the local manifest (exit status 1 if so)')
+    parser.add_argument(
+        '--watch', action='store_true', dest='watch',
+        help='after deploying, watch the site directory and continuously '
+             'deploy changes')
+    parser.add_argument(
+        '--trace', dest='trace', default=None, metavar='FILE',
+        help='write spans of every key and phase to FILE in the Chrome '
+             'trace event format')
+    parser.add_argument(
+        '--summary', dest='summary', default=None, metavar='FILE',
+        help='write the request counts, bytes uploaded and estimated cost '
+             'to FILE as JSON (always logged in dry runs)')
+    parser.add_argument(
+        '--profile', action='store_true', dest='profile',
+        help='run under cProfile and print the hottest functions')
+    parser.add_argument(
+        '--stats', action='store_true', dest='stats',
+        help='instead of deploying, report the deploy history and flag '
+             'deploys that were slower or uploaded more than their baseline')
+    parser.add_argument(
+        '--stats-limit', type=int, dest='stats_limit',
+        default=DEFAULT_STATS_LIMIT, metavar='N',
+        help='number of most recent deploys reported by --stats')
+    parser.add_argument(
+        '--stats-window', type=int, dest='stats_window',
+        default=history.DEFAULT_WINDOW, metavar='N',
+        help='number of previous deploys forming the baseline of --stats')
+    parser.add_argument(
+        '--stats-threshold', type=float, dest='stats_threshold',
+        default=history.DEFAULT_THRESHOLD, metavar='FACTOR',
+        help='factor over the baseline flagged as a regression by --stats')
     parser.add_argument(
         'path', help='the .s3_website.yaml configuration file or directory',
         default='.', nargs='?')
     args = parser.parse_args(command_args)
 
+    if args.shard is not None and args.shard_output is None:
+        parser.error('--shard requires --shard-output')
+    if args.shard is not None and args.use_async:
+        parser.error('--shard cannot be used with --async')
+    if args.shard is not None and args.merge_shards is not None:
+        parser.error('--shard cannot be used with --merge-shard')
+    if args.watch and (args.shard is not None or args.use_async or
+                       args.merge_shards is not None or args.check):
+        parser.error('--watch cannot be combined with --shard, --async, '
+                     '--merge-shard or --check')
+    if args.prefix != '' and (args.shard is not None or args.watch or
+                              args.merge_shards is not None or args.check):
+        parser.error('--prefix cannot be combined with --shard, --watch, '
+                     '--merge-shard or --check')
+    if args.stats and (args.shard is not None or args.watch or
+                       args.merge_shards is not None or args.check):
+        parser.error('--stats cannot be combined with --shard, --watch, '
+                     '--merge-shard or --check')
+    if args.stats_limit <= 0 or args.stats_window <= 0 or \
+            args.stats_threshold <= 0:
+        parser.error('--stats-limit, --stats-window and --stats-threshold '
+                     'must be positive')
+
+    if args.stats:
+        return _report_history(parser, args)
+
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.trace is not None:
+        tracing.start(args.trace)
+    if args.dry or args.summary is not None:
+        _stats.start()
+
+    try:
+        return _run(parser, args)
+    finally:
+        if args.trace is not None:
+            tracing.stop()
+            logger.info('Trace written to {}'.format(args.trace))
+        if args.dry or args.summary is not None:
+            _log_summary(_stats.stop(), args.summary)
+        if profiler is not None:
+            profiler.disable()
+            _print_profile(profiler)
+
+
+def _report_history(parser, args):
+    conf, base_path = config.load_config_file(args.path)
+    if 'history' not in conf:
+        parser.error('The configuration does not set the history option')
+
+    records = history.load(os.path.join(base_path, conf['history']))
+    for line in history.report(
+            records, window=args.stats_window,
+            threshold=args.stats_threshold, limit=args.stats_limit):
+        logger.info(line)
+    return 0
+
+
+def _log_summary(deploy_stats, path):
+    for line in deploy_stats.summary():
+        logger.info(line)
+    if path is not None:
+        deploy_stats.save(path)
+        logger.info('Summary written to {}'.format(path))
+
+
+def _print_profile(profiler):
+    import pstats
+
+    stats = pstats.Stats(profiler, stream=sys.stderr)
+    stats.sort_stats('tottime').print_stats(PROFILE_TOP_FUNCTIONS)
+
+
+def _run(parser, args):
     # Open configuration file
     conf, base_path = config.load_config_file(args.path)
 
-    deploy(conf, base_path, args.force, args.dry)
+    if 'targets' in conf and (
+            args.shard is not None or args.merge_shards is not None or
+            args.use_async or args.watch):
+        parser.error('Configurations with multiple targets cannot be used '
+                     'with --shard, --merge-shard, --async or --watch')
+
+    if args.check:
+        changed = []
+        for target in config.expand_targets(conf):
+            changed.extend(check(target, base_path))
+        for key_name in changed:
+            logger.info('Changed: {}'.format(key_name))
+        if len(changed) > 0:
+            logger.info('{} keys to deploy.'.format(len(changed)))
+            return 1
+        logger.info('Nothing to deploy.')
+        return 0
+    elif args.merge_shards is not None:
+        results = [_shard.load_result(path) for path in args.merge_shards]
+        merge_shards(conf, results, args.dry)
+    elif args.shard is not None:
+        result = deploy(
+            conf, base_path, args.force, args.dry, shard=args.shard)
+        _shard.write_result(args.shard_output, result)
+    elif args.watch:
+        from . import watch
+        watcher = watch.SiteWatcher(conf, base_path, args.dry)
+        deploy(conf, base_path, args.force, args.dry,
+               concurrency=args.concurrency)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            logger.info('Stopped watching.')
+    elif args.use_async:
+        from . import aio
+        aio.run_deploy(
+            conf, base_path, args.force, args.dry,
+            concurrency=args.concurrency, prefix=args.prefix)
+    elif 'targets' in conf:
+        deploy_sites(
+            config.expand_targets(conf), base_path, args.force, args.dry,
+            concurrency=args.concurrency, prefix=args.prefix)
+    else:
+        deploy(conf, base_path, args.force, args.dry,
+               concurrency=args.concurrency, prefix=args.prefix)
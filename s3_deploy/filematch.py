@@ -40,3 +40,182 @@ def match_key(pattern, key, regexp=False):
         pattern = compile_re(pattern)
 
     return bool(re.search(pattern, key))
+
+
+# Flags that change how literal characters match
+_LITERAL_FLAGS = re.IGNORECASE | re.MULTILINE | re.VERBOSE
+
+_DEFAULT_FLAGS = re.compile('').flags
+
+_LITERAL, _QUANTIFIER, _OTHER = range(3)
+
+
+def _tokenize(source):
+    """Split regexp into (kind, text, depth) tokens.
+
+    Character classes and escape sequences other than escaped literals are
+    single tokens. Depth is the group nesting depth of the token.
+    """
+    tokens = []
+    depth = 0
+    i = 0
+    n = len(source)
+    while i < n:
+        c = source[i]
+        if c == '\\':
+            escaped = source[i + 1:i + 2]
+            kind = _OTHER if escaped == '' or escaped.isalnum() else _LITERAL
+            tokens.append((kind, escaped, depth))
+            i += 2
+            continue
+        if c == '[':
+            j = i + 1
+            if source[j:j + 1] == '^':
+                j += 1
+            if source[j:j + 1] == ']':
+                j += 1
+            while j < n and source[j] != ']':
+                if source[j] == '\\':
+                    j += 1
+                j += 1
+            tokens.append((_OTHER, source[i:j + 1], depth))
+            i = j + 1
+            continue
+
+        if c == '(':
+            depth += 1
+            kind = _OTHER
+        elif c == ')':
+            depth -= 1
+            kind = _OTHER
+        elif c in '*+?{':
+            kind = _QUANTIFIER
+        elif c in '.^$|}':
+            kind = _OTHER
+        else:
+            kind = _LITERAL
+        tokens.append((kind, c, depth))
+        i += 1
+    return tokens
+
+
+def literal_affixes(regexp):
+    """Return tuple of the literal prefix and suffix of compiled regexp.
+
+    Every key the regexp matches starts with the prefix and ends with the
+    suffix (e.g. ``static/`` for ``^static/`` and ``.html`` for
+    ``\\.html$``). Either is empty if the regexp does not guarantee one.
+    """
+    if regexp.flags & _LITERAL_FLAGS:
+        return '', ''
+    tokens = _tokenize(regexp.pattern)
+    if any(text == '|' and depth == 0 for kind, text, depth in tokens
+           if kind == _OTHER):
+        return '', ''
+
+    prefix = []
+    if len(tokens) > 0 and tokens[0][:2] == (_OTHER, '^'):
+        for i in range(1, len(tokens)):
+            kind, text, depth = tokens[i]
+            if kind != _LITERAL or depth != 0:
+                break
+            if i + 1 < len(tokens) and tokens[i + 1][0] == _QUANTIFIER:
+                break
+            prefix.append(text)
+
+    suffix = []
+    if len(tokens) > 0 and tokens[-1] == (_OTHER, '$', 0):
+        for kind, text, depth in reversed(tokens[:-1]):
+            if kind != _LITERAL or depth != 0:
+                break
+            suffix.append(text)
+    return ''.join(prefix), ''.join(reversed(suffix))
+
+
+def _combinable(regexp):
+    source = regexp.pattern
+    return (regexp.flags == _DEFAULT_FLAGS and '(?P' not in source and
+            re.search(r'\\[1-9]', source) is None)
+
+
+class PatternSet(object):
+    """Classifies keys by the first of several patterns that matches them.
+
+    Patterns are regular expressions (compiled or not), searched like
+    :func:`match_key` does; use :func:`compile_re` for glob patterns.
+    Patterns with a literal suffix or prefix are indexed by it, so only
+    the patterns that can match a key are tried. The candidate patterns of
+    a key are tried in one pass by a combined regular expression, compiled
+    once for each set of candidates.
+    """
+    def __init__(self, patterns):
+        self._patterns = [re.compile(p) if not hasattr(p, 'search') else p
+                          for p in patterns]
+        self._suffixes = {}
+        self._prefixes = {}
+        unindexed = []
+        for i, regexp in enumerate(self._patterns):
+            prefix, suffix = literal_affixes(regexp)
+            if suffix != '':
+                self._suffixes.setdefault(len(suffix), {}).setdefault(
+                    suffix, []).append(i)
+            elif prefix != '':
+                self._prefixes.setdefault(len(prefix), {}).setdefault(
+                    prefix, []).append(i)
+            else:
+                unindexed.append(i)
+        self._unindexed = tuple(unindexed)
+        self._all = tuple(range(len(self._patterns)))
+        self._matchers = {}
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def _candidates(self, key_name):
+        if key_name.endswith('\n'):
+            # $ also matches before a trailing newline
+            return self._all
+        candidates = list(self._unindexed)
+        for length, table in self._suffixes.items():
+            candidates.extend(table.get(key_name[-length:], ()))
+        for length, table in self._prefixes.items():
+            candidates.extend(table.get(key_name[:length], ()))
+        return tuple(sorted(candidates))
+
+    def _matcher(self, candidates):
+        patterns = [(i, self._patterns[i]) for i in candidates]
+        combined = None
+        if len(patterns) > 1 and all(_combinable(p) for _, p in patterns):
+            try:
+                combined = re.compile('|'.join(
+                    r'(?P<p{}>(?=[\s\S]*?(?:{})))'.format(i, p.pattern)
+                    for i, p in patterns))
+            except re.error:
+                pass
+
+        if combined is not None:
+            def match(key_name):
+                m = combined.match(key_name)
+                return None if m is None else int(m.lastgroup[1:])
+        else:
+            def match(key_name):
+                for i, regexp in patterns:
+                    if regexp.search(key_name):
+                        return i
+                return None
+        return match
+
+    def match(self, key_name):
+        """Return index of the first pattern matching key, or None."""
+        candidates = self._candidates(key_name)
+        if len(candidates) == 0:
+            return None
+        matcher = self._matchers.get(candidates)
+        if matcher is None:
+            matcher = self._matchers[candidates] = self._matcher(candidates)
+        return matcher(key_name)
+
+    def classify(self, keys):
+        """Iterate over the index of the first matching pattern of keys."""
+        for key_name in keys:
+            yield self.match(key_name)
@@ -0,0 +1,218 @@
+"""Content digests of local files.
+
+Comparing the contents of local files with the ETags of remote objects
+requires hashing every candidate file, which is expensive for large media
+files. Files are read through a memory map (or large buffers where that is
+unavailable) and hashed in a thread pool, since hashlib releases the GIL
+while hashing. Digests can be cached in a SQLite database keyed on the
+inode, size and modification time of the file, so unchanged files are
+only hashed once.
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+
+import six
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Part size and threshold of multipart uploads by the AWS CLI and boto3
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+DEFAULT_WORKERS = 4
+
+# Size of the slices of the file that are hashed at a time
+READ_BUFFER_SIZE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+# MD5 hex digest of a file and the ETag of a multipart upload of the file,
+# which is None for files that fit in a single part.
+Digest = namedtuple('Digest', ['md5', 'multipart_etag'])
+
+
+def _mtime_ns(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return mtime_ns
+
+
+class _Digester(object):
+    """Incremental MD5 digest of a file and of each of its parts."""
+    def __init__(self, part_size):
+        self._part_size = part_size
+        self._md5 = hashlib.md5()
+        self._part = hashlib.md5()
+        self._part_length = 0
+        self._parts = []
+
+    def update(self, data):
+        self._md5.update(data)
+        while len(data) > 0:
+            length = min(len(data), self._part_size - self._part_length)
+            self._part.update(data[:length])
+            self._part_length += length
+            data = data[length:]
+            if self._part_length == self._part_size:
+                self._parts.append(self._part.digest())
+                self._part = hashlib.md5()
+                self._part_length = 0
+
+    def digest(self):
+        if self._part_length > 0:
+            self._parts.append(self._part.digest())
+        multipart_etag = None
+        if len(self._parts) > 1:
+            multipart_etag = '{}-{}'.format(
+                hashlib.md5(b''.join(self._parts)).hexdigest(),
+                len(self._parts))
+        return Digest(self._md5.hexdigest(), multipart_etag)
+
+
+def _map_file(f):
+    """Return read-only memory map of file, or None if not possible."""
+    if six.PY2:
+        # Memory views of memory maps are not supported by Python 2
+        return None
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # Empty files and some special files cannot be mapped
+        return None
+
+
+def file_digest(path, part_size=DEFAULT_PART_SIZE):
+    """Return the :class:`Digest` of the file at path.
+
+    The multipart ETag is computed as S3 does for an upload in parts of
+    part_size bytes.
+    """
+    digester = _Digester(part_size)
+    with open(path, 'rb') as f:
+        mapped = _map_file(f)
+        if mapped is None:
+            while True:
+                data = f.read(READ_BUFFER_SIZE)
+                if len(data) == 0:
+                    break
+                digester.update(data)
+        else:
+            try:
+                view = memoryview(mapped)
+                for offset in range(0, len(view), READ_BUFFER_SIZE):
+                    with view[offset:offset + READ_BUFFER_SIZE] as data:
+                        digester.update(data)
+                view.release()
+            finally:
+                mapped.close()
+    return digester.digest()
+
+
+def etag_matches(digest, etag):
+    """Return True if the remote ETag is the ETag of a file with digest.
+
+    Both the ETag of an upload in one part and of a multipart upload are
+    recognised.
+    """
+    if etag is None:
+        return False
+    etag = etag.strip('"').lower()
+    return etag == digest.md5 or etag == digest.multipart_etag
+
+
+class DigestCache(object):
+    """Digests of files cached in a SQLite database.
+
+    Entries are keyed on the inode, size and modification time of the file
+    and the part size, so a cached digest is only used while the file is
+    unchanged. The cache can be shared by the threads of a :class:`Hasher`.
+    Every digest is committed as it is written, so deploys running at the
+    same time (e.g. the targets of one configuration) can share the
+    database file.
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS digests ('
+            'inode INTEGER NOT NULL, size INTEGER NOT NULL, '
+            'mtime_ns INTEGER NOT NULL, part_size INTEGER NOT NULL, '
+            'md5 TEXT NOT NULL, multipart_etag TEXT, '
+            'PRIMARY KEY (inode, size, mtime_ns, part_size))')
+        self._db.commit()
+
+    def get(self, st, part_size):
+        """Return the cached :class:`Digest` of a file stat, or None."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT md5, multipart_etag FROM digests WHERE inode = ? AND '
+                'size = ? AND mtime_ns = ? AND part_size = ?',
+                (st.st_ino, st.st_size, _mtime_ns(st), part_size)).fetchone()
+        if row is None:
+            return None
+        return Digest(*row)
+
+    def put(self, st, part_size, digest):
+        """Cache the digest of the file with the given stat."""
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)',
+                (st.st_ino, st.st_size, _mtime_ns(st), part_size,
+                 digest.md5, digest.multipart_etag))
+            self._db.commit()
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self._db.close()
+
+
+class Hasher(object):
+    """Computes digests of files in a thread pool.
+
+    If cache is given as a :class:`DigestCache`, files that are unchanged
+    since they were last hashed are not read again.
+    """
+    def __init__(self, cache=None, workers=DEFAULT_WORKERS,
+                 part_size=DEFAULT_PART_SIZE):
+        self._cache = cache
+        self._part_size = part_size
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def digest(self, path):
+        """Return the :class:`Digest` of the file at path."""
+        st = os.stat(path)
+        if self._cache is not None:
+            digest = self._cache.get(st, self._part_size)
+            if digest is not None:
+                return digest
+
+        logger.debug('Hashing {}...'.format(path))
+        digest = file_digest(path, part_size=self._part_size)
+        # Files modified while they were hashed are not cached
+        if (self._cache is not None and
+                _mtime_ns(os.stat(path)) == _mtime_ns(st)):
+            self._cache.put(st, self._part_size, digest)
+        return digest
+
+    def submit(self, path):
+        """Schedule hashing of the file and return a future of the digest."""
+        return self._executor.submit(self.digest, path)
+
+    def close(self):
+        """Wait for scheduled digests and close the cache."""
+        self._executor.shutdown(wait=True)
+        if self._cache is not None:
+            self._cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,193 @@
+"""Local history of deploys.
+
+Every deploy appends a compact record (time, duration, keys changed, bytes
+uploaded, request counts, phase durations and invalidation paths) to a
+SQLite database, so trends can be reported and deploys that got slower or
+transferred more than usual can be spotted.
+"""
+
+import json
+import logging
+import sqlite3
+import time
+
+
+# Number of previous deploys forming the baseline of a deploy
+DEFAULT_WINDOW = 10
+
+# Factor over the baseline above which a deploy is a regression
+DEFAULT_THRESHOLD = 1.5
+
+# Minimum number of previous deploys needed for a baseline, unless the
+# window is smaller
+MIN_BASELINE = 3
+
+# Metrics compared with the baseline
+METRICS = ('duration', 'bytes_uploaded')
+
+logger = logging.getLogger(__name__)
+
+_COLUMNS = ('started', 'bucket', 'dry', 'status', 'duration', 'keys_changed',
+            'bytes_uploaded', 'invalidation_paths')
+
+
+def _connect(path):
+    db = sqlite3.connect(path)
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS deploys ('
+        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'started REAL NOT NULL, bucket TEXT NOT NULL, dry INTEGER NOT NULL, '
+        'status TEXT NOT NULL, duration REAL NOT NULL, '
+        'keys_changed INTEGER NOT NULL, bytes_uploaded INTEGER NOT NULL, '
+        'invalidation_paths INTEGER NOT NULL, details TEXT NOT NULL)')
+    return db
+
+
+def make_record(bucket_name, started, duration, deploy_stats, dry=False,
+                status='ok'):
+    """Return history record of a deploy from its :class:`DeployStats`."""
+    data = deploy_stats.as_dict()
+    actions = data['actions']
+    return dict(
+        started=started,
+        bucket=bucket_name,
+        dry=dry,
+        status=status,
+        duration=round(duration, 3),
+        keys_changed=sum(count for kind, count in actions.items()
+                         if kind != 'skip'),
+        bytes_uploaded=data['bytes_uploaded'],
+        invalidation_paths=data['invalidation_paths'],
+        requests=data['requests'],
+        actions=actions,
+        phases=data['phases'])
+
+
+def append(path, record):
+    """Append record to the history database at path."""
+    details = dict((name, value) for name, value in record.items()
+                   if name not in _COLUMNS)
+    db = _connect(path)
+    try:
+        with db:
+            db.execute(
+                'INSERT INTO deploys ({}, details) VALUES ({})'.format(
+                    ', '.join(_COLUMNS), ', '.join('?' * (len(_COLUMNS) + 1))),
+                [record[name] for name in _COLUMNS] +
+                [json.dumps(details, sort_keys=True)])
+    finally:
+        db.close()
+
+
+def load(path, bucket_name=None, limit=None):
+    """Return list of the records in the history database, oldest first.
+
+    If limit is given, only the most recent records are returned.
+    """
+    query = 'SELECT {}, details FROM deploys'.format(', '.join(_COLUMNS))
+    params = []
+    if bucket_name is not None:
+        query += ' WHERE bucket = ?'
+        params.append(bucket_name)
+    query += ' ORDER BY id DESC'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+
+    db = _connect(path)
+    try:
+        rows = db.execute(query, params).fetchall()
+    finally:
+        db.close()
+
+    records = []
+    for row in reversed(rows):
+        record = dict(zip(_COLUMNS, row[:-1]))
+        record['dry'] = bool(record['dry'])
+        record.update(json.loads(row[-1]))
+        records.append(record)
+    return records
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def find_regressions(records, window=DEFAULT_WINDOW,
+                     threshold=DEFAULT_THRESHOLD):
+    """Return list of the deploys that regressed against their baseline.
+
+    The baseline of a metric is the median of the previous window
+    successful deploys (dry runs excluded) of the same bucket. Returns
+    tuples of the record, the metric name, its value and the baseline.
+    """
+    min_baseline = min(MIN_BASELINE, window)
+    previous = {}
+    regressions = []
+    for record in records:
+        if record['dry'] or record['status'] != 'ok':
+            continue
+
+        baseline_records = previous.setdefault(record['bucket'], [])
+        if len(baseline_records) >= min_baseline:
+            for metric in METRICS:
+                baseline = _median(r[metric] for r in baseline_records)
+                if baseline > 0 and record[metric] > baseline * threshold:
+                    regressions.append(
+                        (record, metric, record[metric], baseline))
+
+        baseline_records.append(record)
+        del baseline_records[:-window]
+
+    return regressions
+
+
+def _format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def report(records, window=DEFAULT_WINDOW, threshold=DEFAULT_THRESHOLD,
+           limit=None):
+    """Return list of lines reporting the deploys and their regressions.
+
+    All records form the baselines, but if limit is given only the most
+    recent deploys and their regressions are reported.
+    """
+    if len(records) == 0:
+        return ['No deploys recorded.']
+
+    regressions = find_regressions(
+        records, window=window, threshold=threshold)
+    if limit is not None:
+        records = records[-limit:]
+        shown = set(id(record) for record in records)
+        regressions = [regression for regression in regressions
+                       if id(regression[0]) in shown]
+
+    lines = ['{:<19}  {:<20}  {:>8}  {:>6}  {:>12}  {:>5}  {}'.format(
+        'Started', 'Bucket', 'Seconds', 'Keys', 'Bytes', 'Paths', 'Status')]
+    for record in records:
+        status = record['status']
+        if record['dry']:
+            status += ' (dry run)'
+        lines.append(
+            '{:<19}  {:<20}  {:>8.1f}  {:>6}  {:>12}  {:>5}  {}'.format(
+                _format_time(record['started']), record['bucket'],
+                record['duration'], record['keys_changed'],
+                record['bytes_uploaded'], record['invalidation_paths'],
+                status))
+
+    for record, metric, value, baseline in regressions:
+        lines.append('Regression: {} of {} at {} was {:.1f}x the baseline '
+                     '({} vs {})'.format(
+                         metric, record['bucket'],
+                         _format_time(record['started']),
+                         float(value) / baseline, value, baseline))
+    if len(regressions) == 0:
+        lines.append('No regressions against the baseline of the last {} '
+                     'deploys.'.format(window))
+    return lines
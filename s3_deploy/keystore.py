@@ -0,0 +1,102 @@
+"""Sorted store of key flags with a bounded memory footprint.
+
+Keys are buffered in memory and spilled to a temporary SQLite database
+when the estimated size of the buffer exceeds the memory limit. SQLite
+then sorts and merges the spilled keys on disk, so buckets with millions
+of keys can be processed with a small, fixed amount of memory.
+"""
+
+import logging
+import os
+import sqlite3
+import tempfile
+
+
+# Estimated memory used by one buffered key in addition to its length
+_ENTRY_OVERHEAD = 120
+
+# Number of rows fetched from SQLite at a time
+_FETCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class SortedKeyStore(object):
+    """Store of key names with a boolean flag, iterated in key order.
+
+    A key added several times has the flag False if any of the additions
+    had the flag False. Without memory_limit, all keys are kept in memory.
+    """
+    def __init__(self, memory_limit=None, directory=None):
+        self._memory_limit = memory_limit
+        self._directory = directory
+        self._buffer = {}
+        self._buffer_size = 0
+        self._db = None
+        self._db_path = None
+
+    def add(self, key_name, flag):
+        """Add key with flag."""
+        current = self._buffer.get(key_name)
+        if current is None:
+            self._buffer[key_name] = flag
+            self._buffer_size += _ENTRY_OVERHEAD + len(key_name)
+            if (self._memory_limit is not None and
+                    self._buffer_size > self._memory_limit):
+                self._spill()
+        elif current and not flag:
+            self._buffer[key_name] = False
+
+    def _spill(self):
+        if self._db is None:
+            fd, self._db_path = tempfile.mkstemp(
+                prefix='s3-deploy-', suffix='.sqlite', dir=self._directory)
+            os.close(fd)
+            self._db = sqlite3.connect(self._db_path)
+            self._db.execute(
+                'CREATE TABLE keys (key TEXT NOT NULL, flag INTEGER NOT NULL)')
+
+        logger.debug('Spilling {} keys to {}'.format(
+            len(self._buffer), self._db_path))
+        self._db.executemany(
+            'INSERT INTO keys VALUES (?, ?)',
+            ((key_name, int(flag)) for key_name, flag in self._buffer.items()))
+        self._db.commit()
+        self._buffer = {}
+        self._buffer_size = 0
+
+    def __iter__(self):
+        """Iterate over tuples of key name and flag in key order."""
+        if self._db is None:
+            for key_name in sorted(self._buffer):
+                yield key_name, self._buffer[key_name]
+            return
+
+        if len(self._buffer) > 0:
+            self._spill()
+
+        # The binary collation of SQLite orders UTF-8 text by code point,
+        # like Python orders strings.
+        cursor = self._db.execute(
+            'SELECT key, MIN(flag) FROM keys GROUP BY key ORDER BY key')
+        while True:
+            rows = cursor.fetchmany(_FETCH_SIZE)
+            if len(rows) == 0:
+                break
+            for key_name, flag in rows:
+                yield key_name, bool(flag)
+
+    def close(self):
+        """Remove the spilled keys."""
+        self._buffer = {}
+        self._buffer_size = 0
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            os.remove(self._db_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
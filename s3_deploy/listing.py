@@ -0,0 +1,151 @@
+"""Parallel listing of bucket objects partitioned by key prefix."""
+
+import logging
+import threading
+from collections import namedtuple
+
+from concurrent.futures import ThreadPoolExecutor
+from six.moves import queue
+
+from . import stats
+from . import tracing
+
+
+DEFAULT_CONCURRENCY = 8
+
+# Number of listing pages buffered per partition
+_PARTITION_BUFFER_PAGES = 4
+
+logger = logging.getLogger(__name__)
+
+RemoteObject = namedtuple(
+    'RemoteObject', ['key', 'last_modified', 'storage_class', 'size', 'etag'])
+
+_DONE = object()
+
+
+def _remote_object(item):
+    return RemoteObject(
+        key=item['Key'],
+        last_modified=item['LastModified'],
+        storage_class=item.get('StorageClass', 'STANDARD'),
+        size=item.get('Size'),
+        etag=item.get('ETag'))
+
+
+def _iter_pages(client, bucket_name, prefix, delimiter=None):
+    kwargs = dict(Bucket=bucket_name, Prefix=prefix)
+    if delimiter is not None:
+        kwargs['Delimiter'] = delimiter
+
+    while True:
+        with tracing.span('list', prefix):
+            response = client.list_objects_v2(**kwargs)
+        stats.record(stats.LIST)
+        yield response
+        if not response.get('IsTruncated'):
+            break
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def discover_partitions(client, bucket_name, prefix=''):
+    """List the first level below prefix using a delimiter.
+
+    Return tuple of the objects directly below prefix and the list of
+    common prefixes, each in key order.
+    """
+    objects = []
+    prefixes = []
+    for page in _iter_pages(client, bucket_name, prefix, delimiter='/'):
+        objects.extend(_remote_object(item)
+                       for item in page.get('Contents', []))
+        prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+
+    return objects, prefixes
+
+
+class _PartitionLister(object):
+    """Lists one partition in a worker thread into a bounded queue."""
+    def __init__(self, client, bucket_name, prefix, stop):
+        self._client = client
+        self._bucket_name = bucket_name
+        self._prefix = prefix
+        self._stop = stop
+        self.queue = queue.Queue(maxsize=_PARTITION_BUFFER_PAGES)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def run(self):
+        if self._stop.is_set():
+            return
+
+        try:
+            for page in _iter_pages(
+                    self._client, self._bucket_name, self._prefix):
+                objects = [_remote_object(item)
+                           for item in page.get('Contents', [])]
+                if not self._put(objects):
+                    return
+        except Exception as e:
+            self._put(e)
+        else:
+            self._put(_DONE)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            for obj in item:
+                yield obj
+
+
+def list_objects(client, bucket_name, prefix='',
+                 concurrency=DEFAULT_CONCURRENCY):
+    """Iterate over remote objects in key order.
+
+    The top-level prefixes are discovered with a delimiter listing and
+    then listed concurrently. Objects are yielded as soon as the listing
+    of the partition they belong to has reached them, so consumers do not
+    have to wait for the full listing to complete.
+    """
+    if concurrency < 1:
+        raise ValueError('Concurrency must be at least 1')
+
+    objects, prefixes = discover_partitions(client, bucket_name, prefix)
+    logger.debug('Listing {} partitions of bucket {}'.format(
+        len(prefixes), bucket_name))
+
+    stop = threading.Event()
+    listers = [_PartitionLister(client, bucket_name, p, stop)
+               for p in prefixes]
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        # Partitions are started in key order so the partition being
+        # consumed is always running.
+        for lister in listers:
+            executor.submit(lister.run)
+
+        # Merge objects directly below prefix with partitions in key order
+        i = 0
+        for lister, partition_prefix in zip(listers, prefixes):
+            while i < len(objects) and objects[i].key < partition_prefix:
+                yield objects[i]
+                i += 1
+            for obj in lister:
+                yield obj
+        for obj in objects[i:]:
+            yield obj
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
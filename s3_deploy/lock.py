@@ -0,0 +1,171 @@
+"""Lock serialising concurrent deploys of a bucket.
+
+The lock is an object in the bucket holding a random owner token and an
+expiry time. A deploy takes the lock when it is missing or expired, then
+reads it back after a short delay to confirm that no other deploy wrote it
+in the meantime. While the deploy runs the expiry is extended in the
+background, so a deploy that crashes only blocks others until the lock
+expires. The owner is read back before every extension, and a deploy whose
+lock was taken over (e.g. after it stalled past the expiry) stops at the
+next check.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+
+LOCK_KEY = '.s3-deploy-lock.json'
+LOCK_VERSION = 1
+
+DEFAULT_TTL = 15 * 60
+DEFAULT_TIMEOUT = 10 * 60
+
+# Seconds between attempts to take a held lock
+DEFAULT_POLL_INTERVAL = 5
+
+# Seconds to wait for concurrent writers before reading the lock back
+DEFAULT_SETTLE_TIME = 1
+
+logger = logging.getLogger(__name__)
+
+
+def exclude_lock(objects):
+    """Iterate over remote objects except the lock itself."""
+    for obj in objects:
+        if obj.key != LOCK_KEY:
+            yield obj
+
+
+class DeployLock(object):
+    """Lock object in a bucket, used as a context manager."""
+    def __init__(self, client, bucket_name, ttl=DEFAULT_TTL,
+                 timeout=DEFAULT_TIMEOUT, poll_interval=DEFAULT_POLL_INTERVAL,
+                 settle_time=DEFAULT_SETTLE_TIME, clock=time.time,
+                 sleep=time.sleep):
+        self._client = client
+        self._bucket_name = bucket_name
+        self._ttl = ttl
+        self._timeout = timeout
+        self._poll_interval = poll_interval
+        self._settle_time = settle_time
+        self._clock = clock
+        self._sleep = sleep
+        self.owner = '{}:{}:{}'.format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self._stop = threading.Event()
+        self._refresher = None
+        self.lost = False
+
+    def _read(self):
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self._client.get_object(
+                Bucket=self._bucket_name, Key=LOCK_KEY)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in (
+                    'NoSuchKey', '404'):
+                raise
+            return None
+
+        data = json.loads(response['Body'].read().decode('utf-8'))
+        if data.get('version') != LOCK_VERSION:
+            raise ValueError('Unsupported lock version: {}'.format(
+                data.get('version')))
+        return data
+
+    def _write(self):
+        body = json.dumps(dict(
+            version=LOCK_VERSION,
+            owner=self.owner,
+            expires=self._clock() + self._ttl
+        ), sort_keys=True).encode('utf-8')
+        self._client.put_object(
+            Bucket=self._bucket_name, Key=LOCK_KEY, Body=body,
+            ContentType='application/json', CacheControl='no-store')
+
+    def acquire(self):
+        """Take the lock, waiting up to the timeout while it is held.
+
+        Raises RuntimeError if the lock is still held after the timeout.
+        """
+        deadline = self._clock() + self._timeout
+        while True:
+            current = self._read()
+            if (current is None or current['expires'] <= self._clock() or
+                    current['owner'] == self.owner):
+                self._write()
+                if self._settle_time > 0:
+                    self._sleep(self._settle_time)
+                current = self._read()
+                if current is not None and current['owner'] == self.owner:
+                    break
+
+            if current is None:
+                # A competing deploy released the lock it took meanwhile
+                if self._clock() >= deadline:
+                    raise RuntimeError('Bucket {} is contended'.format(
+                        self._bucket_name))
+                continue
+
+            if self._clock() >= deadline:
+                raise RuntimeError('Bucket {} is locked by {}'.format(
+                    self._bucket_name, current['owner']))
+            logger.info('Bucket {} is locked by {}, waiting...'.format(
+                self._bucket_name, current['owner']))
+            self._sleep(self._poll_interval)
+
+        logger.info('Locked bucket {}.'.format(self._bucket_name))
+        self.lost = False
+        self._stop.clear()
+        self._refresher = threading.Thread(
+            target=self._refresh, name='s3-deploy-lock')
+        self._refresher.daemon = True
+        self._refresher.start()
+
+    def _refresh(self):
+        while not self._stop.wait(self._ttl / 3.0):
+            try:
+                current = self._read()
+                if current is None or current['owner'] != self.owner:
+                    self.lost = True
+                    logger.error('Lock of bucket {} was lost'.format(
+                        self._bucket_name))
+                    return
+                self._write()
+            except Exception:
+                logger.warning('Unable to refresh lock of bucket {}'.format(
+                    self._bucket_name), exc_info=True)
+
+    def check(self):
+        """Raise RuntimeError if the lock was lost while it was held."""
+        if self.lost:
+            raise RuntimeError('Lock of bucket {} was lost'.format(
+                self._bucket_name))
+
+    def release(self):
+        """Remove the lock if it is still held by this deploy."""
+        if self._refresher is not None:
+            self._stop.set()
+            self._refresher.join()
+            self._refresher = None
+
+        current = self._read()
+        if current is not None and current['owner'] == self.owner:
+            self._client.delete_object(Bucket=self._bucket_name, Key=LOCK_KEY)
+            logger.info('Unlocked bucket {}.'.format(self._bucket_name))
+        else:
+            logger.warning('Lock of bucket {} was taken over'.format(
+                self._bucket_name))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,113 @@
+"""Local manifest of the files uploaded by the last deploy.
+
+The manifest records the size and modification time of every file of the
+site (and of its precompressed sidecar, which is uploaded in its place)
+after a successful deploy. It allows answering whether there is
+anything to deploy without contacting S3 (or even importing boto3).
+"""
+
+import json
+import logging
+import os
+
+from . import compression
+
+
+MANIFEST_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+def file_signature(path):
+    """Return the size and modification time in nanoseconds of a file."""
+    st = os.stat(path)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return [st.st_size, mtime_ns]
+
+
+def key_signature(path, precompressed=None):
+    """Return the signature of the file deployed from path.
+
+    With precompressed encodings the uploaded body is the sidecar of the
+    file if there is one, which may change on its own, so its signature is
+    appended.
+    """
+    signature = file_signature(path)
+    if precompressed is not None:
+        sidecar = compression.find_sidecar(path, precompressed)
+        if sidecar is not None:
+            signature.extend(file_signature(sidecar[0]))
+    return signature
+
+
+class ManifestBuilder(object):
+    """Collects file signatures of deployed keys."""
+    def __init__(self, bucket_name, precompressed=None):
+        self._bucket_name = bucket_name
+        self._precompressed = precompressed
+        self._files = {}
+
+    def add(self, key_name, path):
+        """Record the current signature of the file deployed to key."""
+        self._files[key_name] = key_signature(path, self._precompressed)
+
+    def save(self, path):
+        """Write manifest to path, replacing any previous manifest."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(
+                version=MANIFEST_VERSION,
+                bucket=self._bucket_name,
+                files=self._files
+            ), f, sort_keys=True)
+        _replace(tmp_path, path)
+
+
+def _replace(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # Python 2.7 on Windows cannot rename over an existing file
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def load_manifest(path, bucket_name):
+    """Load manifest from path.
+
+    Return dictionary of key names to file signatures, or None if the
+    manifest does not exist or was written for another bucket.
+    """
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        logger.debug('Unable to load manifest {}'.format(path),
+                     exc_info=True)
+        return None
+
+    if (data.get('version') != MANIFEST_VERSION or
+            data.get('bucket') != bucket_name):
+        return None
+
+    return data['files']
+
+
+def changed_keys(manifest, site_files, precompressed=None):
+    """Iterate over keys that differ from the manifest.
+
+    The site_files is an iterable of key name and path tuples. Yields the
+    keys that were added, modified or removed since the manifest was
+    written.
+    """
+    remaining = set(manifest)
+    for key_name, path in site_files:
+        remaining.discard(key_name)
+        if manifest.get(key_name) != key_signature(path, precompressed):
+            yield key_name
+
+    for key_name in sorted(remaining):
+        yield key_name
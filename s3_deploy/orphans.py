@@ -0,0 +1,158 @@
+"""Deferred deletion of keys that were removed from the site.
+
+Deleting a key as soon as the local file is gone breaks clients that still
+hold pages referencing it. Orphaned keys are instead recorded with the
+time they were first found to be missing locally in a ledger object stored
+in the bucket itself, so that every machine deploying the site sees the
+same state. A later deploy deletes the keys whose grace period has expired
+in batched requests.
+"""
+
+import json
+import logging
+import time
+
+from . import shard as _shard
+
+
+LEDGER_KEY = '.s3-deploy-orphans.json'
+LEDGER_VERSION = 1
+
+DEFAULT_GRACE_PERIOD = 7 * 24 * 3600
+
+logger = logging.getLogger(__name__)
+
+
+def exclude_ledger(objects):
+    """Iterate over remote objects except the ledger itself."""
+    for obj in objects:
+        if obj.key != LEDGER_KEY:
+            yield obj
+
+
+class OrphanLedger(object):
+    """Orphaned key names with the time they were first orphaned."""
+    def __init__(self, orphans=None):
+        self._orphans = dict(orphans or {})
+        self.changed = False
+
+    @classmethod
+    def load(cls, client, bucket_name):
+        """Load the ledger from the bucket, or return an empty ledger."""
+        from botocore.exceptions import ClientError
+
+        try:
+            response = client.get_object(Bucket=bucket_name, Key=LEDGER_KEY)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in (
+                    'NoSuchKey', '404'):
+                raise
+            return cls()
+
+        data = json.loads(response['Body'].read().decode('utf-8'))
+        if data.get('version') != LEDGER_VERSION:
+            raise ValueError('Unsupported orphan ledger version: {}'.format(
+                data.get('version')))
+        return cls(data['orphans'])
+
+    def save(self, client, bucket_name):
+        """Store the ledger in the bucket."""
+        body = json.dumps(dict(
+            version=LEDGER_VERSION,
+            orphans=self._orphans
+        ), sort_keys=True).encode('utf-8')
+        client.put_object(
+            Bucket=bucket_name, Key=LEDGER_KEY, Body=body,
+            ContentType='application/json', CacheControl='no-store')
+        self.changed = False
+
+    def __contains__(self, key_name):
+        return key_name in self._orphans
+
+    def __len__(self):
+        return len(self._orphans)
+
+    def record(self, key_name, now):
+        """Record key as orphaned unless it already is."""
+        if key_name not in self._orphans:
+            logger.info('Deferring deletion of {}.'.format(key_name))
+            self._orphans[key_name] = now
+            self.changed = True
+
+    def discard(self, key_name):
+        """Forget key, e.g. because it was added to the site again."""
+        if self._orphans.pop(key_name, None) is not None:
+            self.changed = True
+
+    def expired(self, grace_period, now):
+        """Return sorted list of keys orphaned for at least grace_period."""
+        return sorted(key_name for key_name, orphaned in self._orphans.items()
+                      if now - orphaned >= grace_period)
+
+
+def collect(client, bucket_name, ledger, grace_period, dry, now=None,
+            prefix=''):
+    """Delete the expired keys of the ledger and store the ledger.
+
+    Only keys starting with prefix are deleted. Return the list of keys
+    that were deleted.
+    """
+    if now is None:
+        now = time.time()
+
+    expired = [key_name for key_name in ledger.expired(grace_period, now)
+               if key_name.startswith(prefix)]
+    _shard.delete_keys(client, bucket_name, expired, dry)
+    for key_name in expired:
+        ledger.discard(key_name)
+
+    if ledger.changed and not dry:
+        logger.info('Storing {} orphaned keys.'.format(len(ledger)))
+        ledger.save(client, bucket_name)
+
+    return expired
+
+
+class DeferredDeletion(object):
+    """Decides which orphaned keys are deleted now or by the ledger.
+
+    The deferred predicate selects the keys managed by the ledger. Managed
+    keys are recorded when first orphaned and deleted in batches by
+    :meth:`collect` once their grace period has expired.
+    """
+    def __init__(self, ledger, deferred, grace_period, now=None):
+        if now is None:
+            now = time.time()
+        self.ledger = ledger
+        self._deferred = deferred
+        self._grace_period = grace_period
+        self._now = now
+        self._expired = frozenset(ledger.expired(grace_period, now))
+
+    def manages(self, key_name):
+        """Return True if deletion of key is left to the ledger."""
+        return bool(self._deferred(key_name))
+
+    def postpone(self, key_name):
+        """Record orphaned key.
+
+        Return True if the deletion is postponed to a later deploy, or
+        False if the grace period expired and :meth:`collect` deletes it.
+        """
+        if key_name in self._expired:
+            return False
+        self.ledger.record(key_name, self._now)
+        return True
+
+    def keep(self, key_name):
+        """Forget key that is part of the site."""
+        self.ledger.discard(key_name)
+
+    def collect(self, client, bucket_name, dry, prefix=''):
+        """Delete expired keys starting with prefix and store the ledger.
+
+        Keys outside the prefix were not compared with the site, so they
+        may have been added to it again.
+        """
+        return collect(client, bucket_name, self.ledger, self._grace_period,
+                       dry, now=self._now, prefix=prefix)
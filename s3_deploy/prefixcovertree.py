@@ -1,9 +1,9 @@
 
 """Data structure for identifying the smallest set of covering prefixes."""
 
+import bisect
 import logging
-
-from six.moves import zip
+import os
 
 
 logger = logging.getLogger(__name__)
@@ -11,26 +11,31 @@ logger = logging.getLogger(__name__)
 
 def common_prefix(s1, s2):
     """Return the common prefix of strings s1 and s2."""
-    prefix = []
-    for c1, c2 in zip(s1, s2):
-        if c1 != c2:
-            break
-        prefix.append(c1)
-    return ''.join(prefix)
+    return os.path.commonprefix([s1, s2])
 
 
 class _Node(object):
     """Node in the prefix trie.
 
-    When the node value is set to False the value propagates up the chain
-    of ancestors.
+    The node value is True if every key in the subtree of the node is
+    included. When it is set to False the value propagates up the chain of
+    ancestors. The included flag holds the value of the node key itself,
+    which may be included even if keys below it are excluded. The keys of
+    the children are non-empty and start with distinct characters, so the
+    children are indexed by their first character, which is also kept in
+    sorted order.
     """
+    __slots__ = ('key', '_value', 'included', 'leaf', 'parent', 'children',
+                 '_order')
+
     def __init__(self, key, parent=None, leaf=True, value=True):
         self.key = key
         self._value = value
+        self.included = value
         self.leaf = leaf
         self.parent = parent
-        self.children = set()
+        self.children = {}
+        self._order = []
 
         # Propagate value
         self._propagate_value()
@@ -60,6 +65,33 @@ class _Node(object):
         self._value = v
         self._propagate_value()
 
+    def set_key_value(self, v):
+        """Include or exclude the node key itself, making the node a leaf.
+
+        A key that is excluded cannot be included again.
+        """
+        if self.leaf and self.included < v:
+            raise ValueError('Cannot replace node value {}'.format(
+                self.included))
+        self.leaf = True
+        self.included = v
+        if not v:
+            self.value = False
+
+    def child(self, key):
+        """Return the child whose key starts like key, or None."""
+        return self.children.get(key[:1])
+
+    def add_child(self, node):
+        """Add child node with a key starting with a new character."""
+        first = node.key[:1]
+        self.children[first] = node
+        bisect.insort(self._order, first)
+
+    def reversed_children(self):
+        """Return list of the children in reverse key order."""
+        return [self.children[first] for first in reversed(self._order)]
+
     def __str__(self):
         key = []
         node = self
@@ -70,7 +102,7 @@ class _Node(object):
 
     def __repr__(self):
         return '<{} {}, value={}, leaf={}>'.format(
-            self.__class__.__name__, repr(self._key), repr(self._value),
+            self.__class__.__name__, repr(self.key), repr(self._value),
             repr(self.leaf))
 
 
@@ -80,12 +112,17 @@ class PrefixCoverTree(object):
         self._root = _Node('', leaf=False)
 
     def _iter_nodes(self):
-        stack = [self._root]
+        """Iterate over tuples of node and full key in key order.
+
+        The key of each node is built from the key of its parent as the
+        tree is traversed.
+        """
+        stack = [(self._root, '')]
         while len(stack) > 0:
-            node = stack.pop()
-            yield node
-            stack.extend(sorted(
-                node.children, key=lambda n: n.key, reverse=True))
+            node, prefix = stack.pop()
+            key = prefix + node.key
+            yield node, key
+            stack.extend((child, key) for child in node.reversed_children())
 
     def include(self, key):
         """Mark a key for inclusion in the covering set."""
@@ -100,55 +137,174 @@ class PrefixCoverTree(object):
 
         Yields tuples of a prefix and an ``exact`` flag. The exact flag
         indicates whether the prefix matches one exact key (True) or a
-        subtree of keys (False).
+        subtree of keys (False). The matches are produced in key order
+        while the tree is traversed, and subtrees covered by a match are
+        not visited.
         """
         if len(self._root.children) == 0 and not self._root.leaf:
             return
 
-        for node in self._iter_nodes():
-            if node.value and (node.parent is None or not node.parent.value):
-                if len(node.children) > 0:
-                    yield str(node), False
-                else:
-                    yield str(node), True
+        stack = [(self._root, '')]
+        while len(stack) > 0:
+            node, prefix = stack.pop()
+            key = prefix + node.key
+            if node.value:
+                # Every key below an included node is included
+                yield key, len(node.children) == 0
+            else:
+                if node.leaf and node.included:
+                    # The key is included though keys below it are not
+                    yield key, True
+                stack.extend(
+                    (child, key) for child in node.reversed_children())
 
     def _set_value(self, key, value):
         if key == '':
-            self._root.value = value
-            self._root.leaf = True
+            self._root.set_key_value(value)
             return
 
         parent = self._root
         while True:
-            for node in parent.children:
-                prefix = common_prefix(key, node.key)
-                if len(prefix) > 0:
-                    key_tail = key[len(prefix):]
-                    node_tail = node.key[len(prefix):]
-                    if len(key_tail) == 0 and len(node_tail) == 0:
-                        node.value = value
-                        return
-                    elif len(node_tail) == 0:
-                        key = key_tail
-                        parent = node
-                        break
-                    else:
-                        node_1 = _Node(node_tail, parent=node,
-                                       value=node.value, leaf=node.leaf)
-                        for child in node.children:
-                            child.parent = node_1
-                        node_1.children = node.children
-                        node.key = prefix
-                        node.children = {node_1}
-                        node.leaf = False
-                        node.children.add(
-                            _Node(key_tail, parent=node, value=value))
-                        return
+            node = parent.child(key)
+            if node is None:
+                parent.add_child(_Node(key, parent=parent, value=value))
+                return
+
+            if key.startswith(node.key):
+                if len(key) == len(node.key):
+                    node.set_key_value(value)
+                    return
+                key = key[len(node.key):]
+                parent = node
             else:
-                parent.children.add(_Node(key, parent=parent, value=value))
-                break
+                # Split the node at the common prefix
+                prefix = common_prefix(key, node.key)
+                key_tail = key[len(prefix):]
+                node_tail = node.key[len(prefix):]
+                node_1 = _Node(node_tail, parent=node, value=node.value,
+                               leaf=node.leaf)
+                node_1.included = node.included
+                for child in node.children.values():
+                    child.parent = node_1
+                node_1.children = node.children
+                node_1._order = node._order
+                node.key = prefix
+                node.children = {}
+                node._order = []
+                node.leaf = False
+                node.add_child(node_1)
+                if key_tail == '':
+                    # The key is the split node itself
+                    node.set_key_value(value)
+                else:
+                    node.add_child(_Node(key_tail, parent=node, value=value))
+                return
 
     def __iter__(self):
-        for node in self._iter_nodes():
+        for node, key in self._iter_nodes():
             if node.leaf:
-                yield str(node)
+                yield key
+
+
+class _OpenNode(object):
+    """Node on the rightmost path of the trie built by :func:`cover_sorted`.
+
+    The pending list holds the matches of the node key itself and of closed
+    child subtrees that are only reported if the node turns out not to be
+    covered as a whole.
+    """
+    __slots__ = ('prefix', 'value', 'leaf', 'has_children', 'pending')
+
+    def __init__(self, prefix, leaf=False):
+        self.prefix = prefix
+        self.value = True
+        self.leaf = leaf
+        self.has_children = False
+        self.pending = []
+
+
+def cover_sorted(rows):
+    """Iterate over the covering prefix matches of sorted keys.
+
+    The rows are tuples of a key and a flag (True to include, False to
+    exclude) in key order. A key that occurs several times is excluded if
+    any of its rows excludes it. Yields the same matches in the same order
+    as :meth:`PrefixCoverTree.matches` would after adding the keys, but
+    only keeps the path from the root to the current key in memory (plus
+    matches that cannot be reported yet), so the keys can be streamed from
+    a sorted store.
+    """
+    root = _OpenNode('')
+    stack = [root]
+    output = []
+
+    def attach(parent, child):
+        parent.has_children = True
+        if not child.value:
+            parent.value = False
+            return
+        match = child.prefix, not child.has_children
+        if parent.value:
+            parent.pending.append(match)
+        else:
+            output.append(match)
+
+    def exclude():
+        # Nodes that are still included form the top of the stack
+        i = len(stack)
+        while i > 0 and stack[i - 1].value:
+            i -= 1
+        for node in stack[i:]:
+            node.value = False
+            output.extend(node.pending)
+            node.pending = []
+
+    def close_to(depth):
+        # Close the nodes below depth, attaching each to its parent
+        last = None
+        while len(stack[-1].prefix) > depth:
+            node = stack.pop()
+            if last is not None:
+                attach(node, last)
+            last = node
+        return last
+
+    prev = None
+    for key, flag in rows:
+        depth = 0 if prev is None else len(common_prefix(prev, key))
+        last = close_to(depth)
+        if last is not None:
+            if len(stack[-1].prefix) < depth:
+                stack.append(_OpenNode(key[:depth]))
+            attach(stack[-1], last)
+
+        if len(stack[-1].prefix) == len(key):
+            node = stack[-1]
+            if not flag and node.leaf and node.value:
+                # Repeated key that is now excluded
+                node.pending.remove((key, True))
+        else:
+            stack[-1].has_children = True
+            node = _OpenNode(key)
+            stack.append(node)
+
+        if flag and not node.leaf:
+            node.pending.append((key, True))
+        node.leaf = True
+
+        if not flag:
+            exclude()
+
+        prev = key
+        for match in output:
+            yield match
+        del output[:]
+
+    last = close_to(0)
+    if last is not None:
+        attach(root, last)
+    if root.value and (root.has_children or root.leaf):
+        output.append(('', not root.has_children))
+
+    for match in output:
+        yield match
@@ -0,0 +1,127 @@
+"""Deterministic sharding of deploys across processes or CI nodes.
+
+Each shard uploads the slice of keys selected by a stable hash of the key
+name and records what it did in a result file. Deletions are deferred to a
+coordinator step that merges the result files of all shards, deletes the
+orphaned keys in one pass and creates a single CloudFront invalidation.
+"""
+
+import hashlib
+import json
+import logging
+import re
+import struct
+
+from . import stats
+from . import tracing
+
+
+# Maximum number of keys in one DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def parse_shard(s):
+    """Parse a shard specification of the form ``i/N``.
+
+    Return tuple of shard index and shard count.
+    """
+    m = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', s)
+    if not m:
+        raise ValueError('Invalid shard specification: {}'.format(s))
+
+    index, count = int(m.group(1)), int(m.group(2))
+    if count < 1 or index >= count:
+        raise ValueError('Invalid shard specification: {}'.format(s))
+
+    return index, count
+
+
+def shard_of_key(key_name, count):
+    """Return the shard index of key name when split into count shards."""
+    digest = hashlib.md5(key_name.encode('utf-8')).digest()
+    return struct.unpack('>Q', digest[:8])[0] % count
+
+
+def key_in_shard(key_name, shard):
+    """Return True if key name belongs to the given (index, count) shard."""
+    index, count = shard
+    return shard_of_key(key_name, count) == index
+
+
+def write_result(path, result):
+    """Write shard result to the file at path."""
+    with open(path, 'w') as f:
+        json.dump(result, f, sort_keys=True)
+
+
+def load_result(path):
+    """Load shard result from the file at path."""
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def merge_results(results):
+    """Merge the result records of all shards of a deploy.
+
+    Return tuple of processed, updated and deleted key sets. Raises
+    ValueError if the results do not cover every shard exactly once.
+    """
+    count = None
+    seen = set()
+    processed_keys = set()
+    updated_keys = set()
+    deleted_keys = set()
+
+    for result in results:
+        index, shard_count = result['shard']
+        if count is None:
+            count = shard_count
+        elif count != shard_count:
+            raise ValueError('Shard results have different shard counts')
+        if index in seen:
+            raise ValueError('Duplicate result for shard {}/{}'.format(
+                index, count))
+        seen.add(index)
+
+        processed_keys.update(result['processed'])
+        updated_keys.update(result['updated'])
+        deleted_keys.update(result['deleted'])
+
+    if count is None:
+        raise ValueError('No shard results to merge')
+
+    missing = sorted(set(range(count)) - seen)
+    if len(missing) > 0:
+        raise ValueError('Missing results for shards: {}'.format(
+            ', '.join('{}/{}'.format(i, count) for i in missing)))
+
+    return processed_keys, updated_keys, deleted_keys
+
+
+def delete_keys(client, bucket_name, keys, dry):
+    """Delete keys from bucket in batched DeleteObjects requests."""
+    keys = sorted(keys)
+    for key_name in keys:
+        logger.info('Deleting {}...'.format(key_name))
+    stats.record(stats.DELETE, count=(
+        len(keys) + DELETE_BATCH_SIZE - 1) // DELETE_BATCH_SIZE)
+
+    if dry:
+        return
+
+    for i in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[i:i+DELETE_BATCH_SIZE]
+        with tracing.span('delete_batch'):
+            response = client.delete_objects(
+                Bucket=bucket_name,
+                Delete=dict(
+                    Objects=[dict(Key=key_name) for key_name in batch],
+                    Quiet=True
+                )
+            )
+        errors = response.get('Errors', [])
+        if len(errors) > 0:
+            raise RuntimeError('Failed to delete {} keys, first: {}'.format(
+                len(errors), errors[0].get('Key')))
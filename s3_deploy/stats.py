@@ -0,0 +1,180 @@
+"""Counting of the requests and bytes of a deploy.
+
+When collection is started, every request the deploy makes (or in a dry run
+would make) is counted along with the bytes uploaded and the CloudFront
+paths invalidated, so the cost of a deploy can be estimated before running
+it. The planned actions and the time spent in each phase of the deploy are
+collected as well. When no collection is started, :func:`record` does
+nothing.
+"""
+
+import contextlib
+import json
+import threading
+import time
+
+
+PUT = 'put'
+COPY = 'copy'
+DELETE = 'delete'
+LIST = 'list'
+HEAD = 'head'
+
+REQUEST_KINDS = (PUT, COPY, DELETE, LIST, HEAD)
+
+# Prices in USD of S3 Standard requests in us-east-1 and of CloudFront
+# invalidation paths beyond the monthly free paths. Uploads to S3 are not
+# charged for data transfer and DELETE requests are free.
+DEFAULT_PRICES = {
+    PUT: 0.005 / 1000,
+    COPY: 0.005 / 1000,
+    LIST: 0.005 / 1000,
+    HEAD: 0.0004 / 1000,
+    DELETE: 0.0,
+    'invalidation_path': 0.005,
+}
+
+_stats = None
+
+
+class DeployStats(object):
+    """Thread-safe counters of the requests and bytes of a deploy."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = dict((kind, 0) for kind in REQUEST_KINDS)
+        self.bytes_uploaded = 0
+        self.invalidation_paths = 0
+        self.actions = {}
+        self.phases = {}
+
+    def record(self, kind, count=1, size=0):
+        """Count requests of kind, uploading size bytes in total."""
+        with self._lock:
+            self.requests[kind] += count
+            self.bytes_uploaded += size
+
+    def record_invalidation(self, paths):
+        """Count the paths of an invalidation."""
+        with self._lock:
+            self.invalidation_paths += len(paths)
+
+    def record_action(self, kind):
+        """Count a planned action of kind."""
+        with self._lock:
+            self.actions[kind] = self.actions.get(kind, 0) + 1
+
+    def record_phase(self, name, seconds):
+        """Add seconds to the time spent in phase name."""
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def cost(self, prices=DEFAULT_PRICES):
+        """Return the estimated cost in USD.
+
+        Invalidation paths are charged as if the monthly free paths were
+        used up, so the cost is an upper bound.
+        """
+        with self._lock:
+            return (sum(prices[kind] * count
+                        for kind, count in self.requests.items()) +
+                    prices['invalidation_path'] * self.invalidation_paths)
+
+    def as_dict(self):
+        """Return the counters and the estimated cost as a dictionary."""
+        cost = self.cost()
+        with self._lock:
+            return dict(
+                requests=dict(self.requests),
+                bytes_uploaded=self.bytes_uploaded,
+                invalidation_paths=self.invalidation_paths,
+                actions=dict(self.actions),
+                phases=dict((name, round(seconds, 3))
+                            for name, seconds in self.phases.items()),
+                estimated_cost=round(cost, 6))
+
+    def summary(self):
+        """Return list of lines describing the counters."""
+        data = self.as_dict()
+        requests = data['requests']
+        return [
+            'Requests: {}'.format(', '.join(
+                '{} {}'.format(requests[kind], kind.upper())
+                for kind in REQUEST_KINDS)),
+            'Bytes uploaded: {}'.format(data['bytes_uploaded']),
+            'Invalidation paths: {}'.format(data['invalidation_paths']),
+            'Estimated cost: ${:.4f}'.format(data['estimated_cost']),
+        ]
+
+    def save(self, path):
+        """Write the counters to path as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+
+def start():
+    """Start collecting the counters of the deploy."""
+    global _stats
+    if _stats is not None:
+        raise RuntimeError('Statistics already started')
+    _stats = DeployStats()
+    return _stats
+
+
+def stop():
+    """Stop collecting and return the collected :class:`DeployStats`."""
+    global _stats
+    stats, _stats = _stats, None
+    return stats
+
+
+def enabled():
+    """Return True if counters are being collected."""
+    return _stats is not None
+
+
+def current():
+    """Return the :class:`DeployStats` being collected, or None."""
+    return _stats
+
+
+def record(kind, count=1, size=0):
+    """Count requests of kind if collection is started."""
+    stats = _stats
+    if stats is not None:
+        stats.record(kind, count=count, size=size)
+
+
+def record_invalidation(paths):
+    """Count the paths of an invalidation if collection is started."""
+    stats = _stats
+    if stats is not None:
+        stats.record_invalidation(paths)
+
+
+def record_action(kind):
+    """Count a planned action of kind if collection is started."""
+    stats = _stats
+    if stats is not None:
+        stats.record_action(kind)
+
+
+def record_phase(name, seconds):
+    """Add seconds to the time of phase name if collection is started."""
+    stats = _stats
+    if stats is not None:
+        stats.record_phase(name, seconds)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time the block as part of phase name if collection is started."""
+    stats = _stats
+    if stats is None:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        stats.record_phase(name, time.time() - start)
@@ -0,0 +1,545 @@
+"""Pluggable storage backends.
+
+A :class:`Storage` provides the operations a deploy needs (list, head,
+get, put, copy and batched delete) on one bucket. Every backend also
+provides the subset of the boto3 S3 client API that the deploy code uses,
+so a backend can be passed wherever a boto3 client is expected. Deploys
+to S3 go through :class:`S3Storage`, which passes those client calls on to
+a boto3 client. There are also backends storing objects in memory or in a
+local directory, and a wrapper that injects latency, which allow
+benchmarking the planner and the transfer engine at scale without network
+access.
+"""
+
+import abc
+import bisect
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime
+
+import six
+
+from .listing import RemoteObject
+
+
+# Maximum number of keys returned by one list request
+LIST_PAGE_SIZE = 1000
+
+_HEADERS = ('ContentType', 'CacheControl', 'ContentEncoding', 'StorageClass',
+            'WebsiteRedirectLocation')
+
+# Memory storages by name, so that every client of the same URL in one
+# process sees the same objects.
+_memory_storages = {}
+_memory_storages_lock = threading.Lock()
+
+
+def _client_error(code, operation):
+    from botocore.exceptions import ClientError
+    return ClientError(dict(Error=dict(Code=code, Message=code)), operation)
+
+
+def _md5_etag(body):
+    return '"{}"'.format(hashlib.md5(body).hexdigest())
+
+
+def _headers(kwargs):
+    return dict((name, kwargs[name]) for name in _HEADERS if name in kwargs)
+
+
+def _utc_from_timestamp(timestamp):
+    from .deploy import UTC
+    return datetime.fromtimestamp(timestamp, UTC)
+
+
+@six.add_metaclass(abc.ABCMeta)
+class Storage(object):
+    """Interface of a storage backend holding the objects of one bucket.
+
+    Head and get return None for missing keys and copy raises KeyError if
+    the source key is missing.
+    """
+    @abc.abstractmethod
+    def list(self, prefix='', start_after=None, limit=LIST_PAGE_SIZE):
+        """Return list of up to limit :class:`RemoteObject` in key order.
+
+        Only keys starting with prefix and after start_after are listed.
+        """
+
+    @abc.abstractmethod
+    def head(self, key_name):
+        """Return dictionary of the headers of key."""
+
+    @abc.abstractmethod
+    def get(self, key_name):
+        """Return tuple of the body and the headers of key."""
+
+    @abc.abstractmethod
+    def put(self, key_name, body, headers):
+        """Store body with headers (e.g. ContentType) as key."""
+
+    @abc.abstractmethod
+    def copy(self, source, key_name, headers):
+        """Copy body of source key to key, replacing the headers."""
+
+    @abc.abstractmethod
+    def delete_batch(self, keys):
+        """Delete keys. Return list of keys that could not be deleted."""
+
+    # Subset of the boto3 S3 client API
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None,  # noqa: N803
+                        ContinuationToken=None,  # noqa: N803
+                        MaxKeys=LIST_PAGE_SIZE):  # noqa: N803
+        contents = []
+        prefixes = []
+        start_after = last = ContinuationToken
+        # Common prefix whose keys are skipped
+        skip = None
+        if (ContinuationToken is not None and Delimiter and
+                ContinuationToken.endswith(Delimiter) and
+                Delimiter in ContinuationToken[len(Prefix):]):
+            skip = ContinuationToken
+        truncated = False
+        while not truncated:
+            page = self.list(Prefix, start_after=start_after)
+            if len(page) == 0:
+                break
+            for obj in page:
+                start_after = obj.key
+                if skip is not None and obj.key.startswith(skip):
+                    continue
+                if len(contents) + len(prefixes) == MaxKeys:
+                    truncated = True
+                    break
+
+                rest = obj.key[len(Prefix):]
+                if Delimiter and Delimiter in rest:
+                    skip = Prefix + rest[:rest.index(Delimiter) +
+                                         len(Delimiter)]
+                    prefixes.append(skip)
+                    last = skip
+                else:
+                    contents.append(dict(
+                        Key=obj.key, LastModified=obj.last_modified,
+                        StorageClass=obj.storage_class, Size=obj.size,
+                        ETag=obj.etag))
+                    last = obj.key
+
+        response = dict(
+            Contents=contents,
+            CommonPrefixes=[dict(Prefix=p) for p in prefixes],
+            KeyCount=len(contents) + len(prefixes),
+            IsTruncated=truncated)
+        if truncated:
+            response['NextContinuationToken'] = last
+        return response
+
+    def head_object(self, Bucket, Key):  # noqa: N803
+        headers = self.head(Key)
+        if headers is None:
+            raise _client_error('404', 'HeadObject')
+        return headers
+
+    def get_object(self, Bucket, Key):  # noqa: N803
+        result = self.get(Key)
+        if result is None:
+            raise _client_error('NoSuchKey', 'GetObject')
+        body, headers = result
+        response = dict(headers)
+        response['Body'] = _Body(body)
+        return response
+
+    def put_object(self, Bucket, Key, Body, **kwargs):  # noqa: N803
+        body = Body
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.put(Key, body, _headers(kwargs))
+        return dict(ETag=_md5_etag(body))
+
+    def copy_object(self, Bucket, Key, CopySource,  # noqa: N803
+                    MetadataDirective='COPY', **kwargs):  # noqa: N803
+        headers = None
+        if MetadataDirective == 'REPLACE':
+            headers = _headers(kwargs)
+        elif 'StorageClass' in kwargs:
+            # The storage class is set even if the metadata is copied
+            source = self.head(CopySource['Key'])
+            if source is not None:
+                headers = _headers(source)
+                headers['StorageClass'] = kwargs['StorageClass']
+        try:
+            self.copy(CopySource['Key'], Key, headers)
+        except KeyError:
+            raise _client_error('NoSuchKey', 'CopyObject')
+        return {}
+
+    def delete_object(self, Bucket, Key):  # noqa: N803
+        self.delete_batch([Key])
+        return {}
+
+    def delete_objects(self, Bucket, Delete):  # noqa: N803
+        keys = [item['Key'] for item in Delete['Objects']]
+        failed = self.delete_batch(keys)
+        return dict(Errors=[dict(Key=key_name, Code='InternalError')
+                            for key_name in failed])
+
+
+class _Body(object):
+    """Response body with the read method of botocore streaming bodies."""
+    def __init__(self, data):
+        self._data = data
+
+    def read(self):
+        return self._data
+
+
+class MemoryStorage(Storage):
+    """Storage keeping the objects in memory."""
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._keys = []
+        self._objects = {}
+
+    def list(self, prefix='', start_after=None, limit=LIST_PAGE_SIZE):
+        with self._lock:
+            if start_after is not None and start_after >= prefix:
+                i = bisect.bisect_right(self._keys, start_after)
+            else:
+                i = bisect.bisect_left(self._keys, prefix)
+            keys = self._keys[i:i + limit]
+            result = []
+            for key_name in keys:
+                if not key_name.startswith(prefix):
+                    break
+                body, headers, etag, modified = self._objects[key_name]
+                result.append(RemoteObject(
+                    key=key_name,
+                    last_modified=_utc_from_timestamp(modified),
+                    storage_class=headers.get('StorageClass', 'STANDARD'),
+                    size=len(body), etag=etag))
+            return result
+
+    def _info(self, key_name):
+        body, headers, etag, modified = self._objects[key_name]
+        info = dict(headers)
+        info.update(
+            ETag=etag, ContentLength=len(body),
+            LastModified=_utc_from_timestamp(modified))
+        return body, info
+
+    def head(self, key_name):
+        with self._lock:
+            if key_name not in self._objects:
+                return None
+            return self._info(key_name)[1]
+
+    def get(self, key_name):
+        with self._lock:
+            if key_name not in self._objects:
+                return None
+            return self._info(key_name)
+
+    def _store(self, key_name, body, headers, etag):
+        if key_name not in self._objects:
+            bisect.insort(self._keys, key_name)
+        self._objects[key_name] = (body, dict(headers), etag, self._clock())
+
+    def put(self, key_name, body, headers):
+        etag = _md5_etag(body)
+        with self._lock:
+            self._store(key_name, body, headers, etag)
+
+    def copy(self, source, key_name, headers):
+        with self._lock:
+            body, source_headers, etag, _ = self._objects[source]
+            if headers is None:
+                headers = source_headers
+            self._store(key_name, body, headers, etag)
+
+    def delete_batch(self, keys):
+        with self._lock:
+            for key_name in keys:
+                if self._objects.pop(key_name, None) is not None:
+                    i = bisect.bisect_left(self._keys, key_name)
+                    del self._keys[i]
+        return []
+
+
+class LocalStorage(Storage):
+    """Storage keeping the objects as files in a local directory.
+
+    Key names can contain any characters and a key can be a prefix of
+    another key, so every object is stored as a file named by a digest of
+    the key name, next to a JSON file holding the key name and headers.
+    The sorted key names are indexed in memory.
+    """
+    def __init__(self, directory):
+        self._directory = directory
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._keys = []
+        for filename in os.listdir(directory):
+            if filename.endswith('.json'):
+                with open(os.path.join(directory, filename), 'r') as f:
+                    self._keys.append(json.load(f)['key'])
+        self._keys.sort()
+
+    def _path(self, key_name):
+        digest = hashlib.sha1(key_name.encode('utf-8')).hexdigest()
+        return os.path.join(self._directory, digest)
+
+    def _load_meta(self, key_name):
+        try:
+            with open(self._path(key_name) + '.json', 'r') as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return None
+
+    def list(self, prefix='', start_after=None, limit=LIST_PAGE_SIZE):
+        with self._lock:
+            if start_after is not None and start_after >= prefix:
+                i = bisect.bisect_right(self._keys, start_after)
+            else:
+                i = bisect.bisect_left(self._keys, prefix)
+            keys = [key_name for key_name in self._keys[i:i + limit]
+                    if key_name.startswith(prefix)]
+
+        result = []
+        for key_name in keys:
+            meta = self._load_meta(key_name)
+            if meta is None:
+                continue
+            result.append(RemoteObject(
+                key=key_name,
+                last_modified=_utc_from_timestamp(meta['modified']),
+                storage_class=meta['headers'].get('StorageClass', 'STANDARD'),
+                size=meta['size'], etag=meta['etag']))
+        return result
+
+    def head(self, key_name):
+        meta = self._load_meta(key_name)
+        if meta is None:
+            return None
+        info = dict(meta['headers'])
+        info.update(
+            ETag=meta['etag'], ContentLength=meta['size'],
+            LastModified=_utc_from_timestamp(meta['modified']))
+        return info
+
+    def get(self, key_name):
+        info = self.head(key_name)
+        if info is None:
+            return None
+        with open(self._path(key_name), 'rb') as f:
+            return f.read(), info
+
+    def _store(self, key_name, body, headers, etag):
+        path = self._path(key_name)
+        with open(path, 'wb') as f:
+            f.write(body)
+        with open(path + '.json', 'w') as f:
+            json.dump(dict(
+                key=key_name, headers=headers, etag=etag, size=len(body),
+                modified=time.time()), f, sort_keys=True)
+        with self._lock:
+            i = bisect.bisect_left(self._keys, key_name)
+            if i == len(self._keys) or self._keys[i] != key_name:
+                self._keys.insert(i, key_name)
+
+    def put(self, key_name, body, headers):
+        self._store(key_name, body, headers, _md5_etag(body))
+
+    def copy(self, source, key_name, headers):
+        result = self.get(source)
+        if result is None:
+            raise KeyError(source)
+        body, info = result
+        if headers is None:
+            headers = _headers(info)
+        self._store(key_name, body, headers, info['ETag'])
+
+    def delete_batch(self, keys):
+        for key_name in keys:
+            path = self._path(key_name)
+            with self._lock:
+                i = bisect.bisect_left(self._keys, key_name)
+                if i < len(self._keys) and self._keys[i] == key_name:
+                    del self._keys[i]
+            for filename in (path + '.json', path):
+                if os.path.exists(filename):
+                    os.remove(filename)
+        return []
+
+
+class LatencyStorage(Storage):
+    """Wraps a storage, delaying every request.
+
+    Each request is delayed by latency seconds plus a random jitter of up
+    to jitter seconds. The jitter is drawn from a generator seeded with
+    seed, so a sequence of requests is delayed identically on every run.
+    """
+    def __init__(self, storage, latency, jitter=0.0, seed=0,
+                 sleep=time.sleep):
+        self._storage = storage
+        self._latency = latency
+        self._jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sleep = sleep
+
+    def _delay(self):
+        with self._lock:
+            delay = self._latency + self._random.uniform(0, self._jitter)
+        if delay > 0:
+            self._sleep(delay)
+
+    def list(self, prefix='', start_after=None, limit=LIST_PAGE_SIZE):
+        self._delay()
+        return self._storage.list(prefix, start_after, limit)
+
+    def head(self, key_name):
+        self._delay()
+        return self._storage.head(key_name)
+
+    def get(self, key_name):
+        self._delay()
+        return self._storage.get(key_name)
+
+    def put(self, key_name, body, headers):
+        self._delay()
+        self._storage.put(key_name, body, headers)
+
+    def copy(self, source, key_name, headers):
+        self._delay()
+        self._storage.copy(source, key_name, headers)
+
+    def delete_batch(self, keys):
+        self._delay()
+        return self._storage.delete_batch(keys)
+
+
+class S3Storage(Storage):
+    """Storage backed by an S3 bucket through a boto3 client.
+
+    The calls of the boto3 client API are passed on to the client
+    unchanged, so deploys to S3 behave exactly as with the client itself.
+    """
+    def __init__(self, client, bucket_name):
+        self._client = client
+        self._bucket_name = bucket_name
+
+    def _request(self, operation, **kwargs):
+        from botocore.exceptions import ClientError
+        try:
+            return getattr(self._client, operation)(
+                Bucket=self._bucket_name, **kwargs)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in (
+                    '404', 'NoSuchKey'):
+                return None
+            raise
+
+    @staticmethod
+    def _info(response):
+        info = _headers(response)
+        for name in ('ETag', 'ContentLength', 'LastModified'):
+            info[name] = response[name]
+        return info
+
+    def list(self, prefix='', start_after=None, limit=LIST_PAGE_SIZE):
+        kwargs = dict(Prefix=prefix, MaxKeys=limit)
+        if start_after is not None:
+            kwargs['StartAfter'] = start_after
+        response = self._request('list_objects_v2', **kwargs)
+        return [RemoteObject(
+            key=item['Key'], last_modified=item['LastModified'],
+            storage_class=item.get('StorageClass', 'STANDARD'),
+            size=item.get('Size'), etag=item.get('ETag'))
+            for item in response.get('Contents', [])]
+
+    def head(self, key_name):
+        response = self._request('head_object', Key=key_name)
+        if response is None:
+            return None
+        return self._info(response)
+
+    def get(self, key_name):
+        response = self._request('get_object', Key=key_name)
+        if response is None:
+            return None
+        return response['Body'].read(), self._info(response)
+
+    def put(self, key_name, body, headers):
+        self._client.put_object(
+            Bucket=self._bucket_name, Key=key_name, Body=body, **headers)
+
+    def copy(self, source, key_name, headers):
+        kwargs = dict(CopySource=dict(Bucket=self._bucket_name, Key=source))
+        if headers is not None:
+            kwargs.update(headers, MetadataDirective='REPLACE')
+        if self._request('copy_object', Key=key_name, **kwargs) is None:
+            raise KeyError(source)
+
+    def delete_batch(self, keys):
+        failed = []
+        for i in range(0, len(keys), LIST_PAGE_SIZE):
+            response = self._client.delete_objects(
+                Bucket=self._bucket_name,
+                Delete=dict(Objects=[
+                    dict(Key=key_name)
+                    for key_name in keys[i:i + LIST_PAGE_SIZE]]))
+            failed.extend(error['Key'] for error in response.get('Errors', []))
+        return failed
+
+    # The boto3 S3 client API is passed on to the client
+
+    def list_objects_v2(self, **kwargs):
+        return self._client.list_objects_v2(**kwargs)
+
+    def head_object(self, **kwargs):
+        return self._client.head_object(**kwargs)
+
+    def get_object(self, **kwargs):
+        return self._client.get_object(**kwargs)
+
+    def put_object(self, **kwargs):
+        return self._client.put_object(**kwargs)
+
+    def copy_object(self, **kwargs):
+        return self._client.copy_object(**kwargs)
+
+    def delete_object(self, **kwargs):
+        return self._client.delete_object(**kwargs)
+
+    def delete_objects(self, **kwargs):
+        return self._client.delete_objects(**kwargs)
+
+
+def create_storage(url, latency=None):
+    """Create storage from URL.
+
+    Supported URLs are ``memory://name`` and ``file:///path``. If latency
+    is given, requests are delayed by that number of seconds.
+    """
+    if url.startswith('memory://'):
+        name = url[len('memory://'):]
+        with _memory_storages_lock:
+            storage = _memory_storages.get(name)
+            if storage is None:
+                storage = _memory_storages[name] = MemoryStorage()
+    elif url.startswith('file://'):
+        storage = LocalStorage(url[len('file://'):])
+    else:
+        raise ValueError('Unsupported storage URL: {}'.format(url))
+
+    if latency is not None:
+        storage = LatencyStorage(storage, latency)
+    return storage
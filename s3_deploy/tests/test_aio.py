@@ -0,0 +1,190 @@
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import boto3
+from moto import mock_s3
+
+if sys.version_info < (3, 5):
+    raise unittest.SkipTest('asyncio engine requires Python 3.5+')
+
+import asyncio  # noqa: E402
+
+from s3_deploy import aio  # noqa: E402
+from s3_deploy import lock  # noqa: E402
+from s3_deploy import manifest  # noqa: E402
+
+
+class FakeAsyncClient(object):
+    """Asynchronous S3 client stand-in that completes requests later."""
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.puts = {}
+        self.deletes = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _complete_later(self, result=None):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        def done():
+            self.in_flight -= 1
+            if not future.cancelled():
+                future.set_result(result)
+
+        loop.call_later(self.delay, done)
+        return future
+
+    def put_object(self, **kwargs):
+        key = kwargs.pop('Key')
+        body = kwargs.pop('Body')
+        kwargs.pop('Bucket')
+        self.puts[key] = (body, kwargs)
+        return self._complete_later()
+
+    def delete_object(self, **kwargs):
+        self.deletes.append(kwargs['Key'])
+        return self._complete_later()
+
+
+@mock_s3
+class AsyncDeployTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.site_dir = os.path.join(self.tmp_dir, '_site')
+        os.mkdir(self.site_dir)
+
+        for i in range(20):
+            path = os.path.join(self.site_dir, 'file{}.txt'.format(i))
+            with open(path, 'w') as f:
+                f.write('contents {}\n'.format(i))
+
+        self.s3 = boto3.resource('s3', region_name='us-east-1')
+        self.bucket = self.s3.Bucket('test_bucket')
+        self.bucket.create()
+        self.bucket.Object('deleted_file.txt').put(Body='old\n')
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def conf(self):
+        return {'s3_bucket': self.bucket.name, 'site': '_site'}
+
+    def test_deploy_async(self):
+        client = FakeAsyncClient()
+        self.loop.run_until_complete(aio.deploy_async(
+            self.conf(), self.tmp_dir, False, False, concurrency=5,
+            client=client))
+
+        self.assertEqual(
+            set(client.puts),
+            set('file{}.txt'.format(i) for i in range(20)))
+        self.assertEqual(client.deletes, ['deleted_file.txt'])
+        self.assertLessEqual(client.max_in_flight, 5)
+        self.assertEqual(client.in_flight, 0)
+
+        body, kwargs = client.puts['file3.txt']
+        self.assertEqual(kwargs['ContentEncoding'], 'gzip')
+        self.assertEqual(kwargs['StorageClass'], 'STANDARD')
+
+    def test_deploy_async_upload_priority(self):
+        client = FakeAsyncClient()
+        conf = self.conf()
+        conf['upload_priority'] = [{'match': 'file1?.txt', 'priority': 1}]
+        order = []
+        original = client.put_object
+
+        def put_object(**kwargs):
+            order.append((kwargs['Key'], client.in_flight))
+            return original(**kwargs)
+
+        client.put_object = put_object
+        self.loop.run_until_complete(aio.deploy_async(
+            conf, self.tmp_dir, False, False, concurrency=5, client=client))
+
+        held_back = [key_name for key_name, _ in order[-10:]]
+        self.assertEqual(sorted(held_back), [
+            'file1{}.txt'.format(i) for i in range(10)])
+        # Nothing else was in flight when the held back keys started
+        self.assertEqual(order[-10][1], 0)
+
+    def test_deploy_async_dry(self):
+        client = FakeAsyncClient()
+        self.loop.run_until_complete(aio.deploy_async(
+            self.conf(), self.tmp_dir, False, True, concurrency=5,
+            client=client))
+
+        self.assertEqual(client.puts, {})
+        self.assertEqual(client.deletes, [])
+
+    def test_deploy_async_cancel(self):
+        client = FakeAsyncClient(delay=10)
+        task = self.loop.create_task(aio.deploy_async(
+            self.conf(), self.tmp_dir, False, False, concurrency=3,
+            client=client))
+        self.loop.call_later(0.5, task.cancel)
+
+        with self.assertRaises(asyncio.CancelledError):
+            self.loop.run_until_complete(task)
+
+        # Only the first batch of requests was started
+        self.assertEqual(len(client.puts) + len(client.deletes), 3)
+
+    def test_deploy_async_lock(self):
+        client = FakeAsyncClient()
+        conf = self.conf()
+        conf['lock'] = True
+        owners = []
+        original = client.put_object
+
+        def put_object(**kwargs):
+            body = self.bucket.Object(lock.LOCK_KEY).get()['Body'].read()
+            owners.append(json.loads(body.decode('utf-8'))['owner'])
+            return original(**kwargs)
+
+        client.put_object = put_object
+        self.loop.run_until_complete(aio.deploy_async(
+            conf, self.tmp_dir, False, False, concurrency=5, client=client))
+
+        self.assertEqual(len(owners), 20)
+        self.assertEqual(len(set(owners)), 1)
+        self.assertNotIn(
+            lock.LOCK_KEY, [obj.key for obj in self.bucket.objects.all()])
+
+    def test_deploy_async_manifest(self):
+        conf = self.conf()
+        conf['manifest'] = 'manifest.json'
+        self.loop.run_until_complete(aio.deploy_async(
+            conf, self.tmp_dir, False, False, client=FakeAsyncClient()))
+
+        files = manifest.load_manifest(
+            os.path.join(self.tmp_dir, 'manifest.json'), self.bucket.name)
+        self.assertEqual(
+            sorted(files), sorted('file{}.txt'.format(i) for i in range(20)))
+
+    def test_unsupported_options(self):
+        for name in ('verify_uploads', 'deduplicate'):
+            conf = self.conf()
+            conf[name] = True
+            with self.assertRaises(ValueError):
+                self.loop.run_until_complete(aio.deploy_async(
+                    conf, self.tmp_dir, False, False,
+                    client=FakeAsyncClient()))
+
+    def test_invalid_concurrency(self):
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(aio.deploy_async(
+                self.conf(), self.tmp_dir, False, False, concurrency=0,
+                client=FakeAsyncClient()))
@@ -0,0 +1,102 @@
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from six import BytesIO
+
+from s3_deploy import compression
+
+
+def decompress(data):
+    return gzip.GzipFile(fileobj=BytesIO(data), mode='rb').read()
+
+
+class GzipCompressTest(unittest.TestCase):
+    def test_round_trip(self):
+        data = b'contents\n' * 100
+        self.assertEqual(decompress(compression.gzip_compress(data)), data)
+
+    def test_deterministic(self):
+        data = b'contents\n' * 100
+        self.assertEqual(compression.gzip_compress(data),
+                         compression.gzip_compress(data))
+
+
+class CompressionCacheTest(unittest.TestCase):
+    def test_hit(self):
+        cache = compression.CompressionCache()
+        first = cache.compress(b'contents\n')
+        second = cache.compress(b'contents\n')
+        self.assertIs(first, second)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(decompress(first), b'contents\n')
+
+    def test_eviction(self):
+        size = len(compression.gzip_compress(b'a' * 10))
+        cache = compression.CompressionCache(max_bytes=size * 2)
+        cache.compress(b'a' * 10)
+        cache.compress(b'b' * 10)
+        cache.compress(b'c' * 10)
+        cache.compress(b'a' * 10)
+        self.assertEqual((cache.hits, cache.misses), (0, 4))
+        cache.compress(b'c' * 10)
+        self.assertEqual(cache.hits, 1)
+
+
+class SidecarTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_is_sidecar(self):
+        names = frozenset(['app.js', 'app.js.gz', 'app.js.br', 'data.gz'])
+        self.assertTrue(compression.is_sidecar('app.js.gz', names, ('gzip',)))
+        self.assertFalse(compression.is_sidecar('app.js.br', names, ('gzip',)))
+        self.assertFalse(compression.is_sidecar('data.gz', names, ('gzip',)))
+        self.assertFalse(compression.is_sidecar('app.js', names, ('gzip',)))
+
+    def test_find_sidecar_preference(self):
+        path = os.path.join(self.tmp_dir, 'app.js')
+        for ext in ('', '.gz', '.br'):
+            with open(path + ext, 'wb') as f:
+                f.write(b'x')
+
+        self.assertEqual(compression.find_sidecar(path, ('br', 'gzip')),
+                         (path + '.br', 'br'))
+        self.assertEqual(compression.find_sidecar(path, ('gzip',)),
+                         (path + '.gz', 'gzip'))
+        self.assertIsNone(compression.find_sidecar(
+            os.path.join(self.tmp_dir, 'other.js'), ('gzip',)))
+
+
+class EstimateCompressedSizeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, data):
+        path = os.path.join(self.tmp_dir, 'file.html')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_small_file_exact(self):
+        data = b'<p>Hello</p>' * 100
+        path = self._write(data)
+        self.assertEqual(compression.estimate_compressed_size(path),
+                         len(compression.gzip_compress(data)))
+
+    def test_large_file_extrapolated(self):
+        data = os.urandom(compression.ESTIMATE_SAMPLE_SIZE) * 3
+        path = self._write(data)
+        estimate = compression.estimate_compressed_size(path)
+        # Random data does not compress so the estimate is near the size
+        self.assertGreater(estimate, len(data) * 0.95)
+        self.assertLess(estimate, len(data) * 1.05)
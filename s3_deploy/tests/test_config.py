@@ -53,6 +53,61 @@ class DurationConversionTest(unittest.TestCase):
             config.timedelta_from_duration_string('-45 hours')
 
 
+class SizeConversionTest(unittest.TestCase):
+    def test_size_integer(self):
+        self.assertEqual(config.size_from_string(1000), 1000)
+
+    def test_size_numeric_string(self):
+        self.assertEqual(config.size_from_string('1000'), 1000)
+
+    def test_size_kilobytes(self):
+        self.assertEqual(config.size_from_string('500 KB'), 500 * 1024)
+
+    def test_size_megabytes_short(self):
+        self.assertEqual(config.size_from_string('2M'), 2 * 1024**2)
+
+    def test_size_fraction(self):
+        self.assertEqual(config.size_from_string('1.5 GiB'), 3 * 1024**3 // 2)
+
+    def test_size_invalid(self):
+        with self.assertRaises(ValueError):
+            config.size_from_string('fast')
+
+
+class ScopePrefixTest(unittest.TestCase):
+    def test_scope_prefix(self):
+        self.assertEqual(config.scope_prefix('/docs/'), 'docs/')
+        self.assertEqual(config.scope_prefix('docs/api'), 'docs/api/')
+        self.assertEqual(config.scope_prefix('./docs//api/'), 'docs/api/')
+        self.assertEqual(config.scope_prefix('/'), '')
+
+    def test_scope_prefix_outside_site(self):
+        with self.assertRaises(ValueError):
+            config.scope_prefix('docs/../../etc')
+
+
+class ResolveUploadPriorityTest(unittest.TestCase):
+    def test_resolve_empty(self):
+        self.assertEqual(config.resolve_upload_priority('index.html', []), 0)
+
+    def test_resolve_first_match(self):
+        rules = [
+            {'match': '*.html', 'priority': 10},
+            {'match_regexp': r'\.[0-9a-f]{8}\.js$', 'priority': -1},
+            {'match': '*', 'priority': 5},
+        ]
+        self.assertEqual(
+            config.resolve_upload_priority('dir/index.html', rules), 10)
+        self.assertEqual(
+            config.resolve_upload_priority('app.0123abcd.js', rules), -1)
+        self.assertEqual(
+            config.resolve_upload_priority('image.png', rules), 5)
+
+    def test_resolve_no_match_key(self):
+        with self.assertRaises(ValueError):
+            config.resolve_upload_priority('test', [{'priority': 1}])
+
+
 class ResolveCacheRulesTest(unittest.TestCase):
     def test_resolve_empty(self):
         cache = config.resolve_cache_rules('test', [])
@@ -218,3 +273,267 @@ class LoadConfigFileTest(unittest.TestCase):
             call(os.path.join(fake_path, '.s3_website.yaml')),
             call(os.path.join(fake_path, '.s3_website.yml'))
         ])
+
+
+class CompileConfigTest(unittest.TestCase):
+    def compile(self, **options):
+        conf = {'site': '_site', 's3_bucket': 'example.com'}
+        conf.update(options)
+        return config.compile_config(conf)
+
+    def test_compile_minimal(self):
+        conf = self.compile()
+        self.assertEqual(conf['site'], '_site')
+        self.assertEqual(conf['cache_rules'], ())
+        self.assertEqual(conf.get('cloudfront_distribution_id'), None)
+
+    def test_compile_is_idempotent(self):
+        conf = self.compile()
+        self.assertIs(config.compile_config(conf), conf)
+
+    def test_compile_read_only(self):
+        conf = self.compile()
+        with self.assertRaises(TypeError):
+            conf['site'] = 'other'
+
+    def test_compile_missing_site(self):
+        with self.assertRaises(ValueError):
+            config.compile_config({'s3_bucket': 'example.com'})
+
+    def test_compile_missing_bucket(self):
+        with self.assertRaises(ValueError):
+            config.compile_config({'site': '_site'})
+
+    def test_compile_not_mapping(self):
+        with self.assertRaises(ValueError):
+            config.compile_config(['site'])
+
+    def test_compile_cache_rules(self):
+        conf = self.compile(cache_rules=[
+            {'match': '/assets/*', 'maxage': '30 days'},
+            {'match_regexp': r'^img/.*\.png$', 'cache_control': 'public',
+             'maxage': 60},
+            {'match': '*'},
+        ])
+        rules = conf['cache_rules']
+        self.assertEqual(rules[0].cache_control, 'max-age=2592000')
+        self.assertEqual(
+            config.resolve_cache_rules('assets/app.js', rules),
+            'max-age=2592000')
+        self.assertEqual(
+            config.resolve_cache_rules('img/a.png', rules),
+            'public, max-age=60')
+        self.assertIsNone(config.resolve_cache_rules('index.html', rules))
+
+    def test_compile_cache_rules_match_raw_rules(self):
+        raw_rules = [
+            {'match': 'other/*', 'maxage': 100},
+            {'match': 'test', 'maxage': 200},
+            {'match_regexp': 't[es]{2}(t|a)$', 'maxage': '1 hour'},
+        ]
+        rules = self.compile(cache_rules=raw_rules)['cache_rules']
+        for key_name in ['test', 'other/x', 'dir/test', 'tesa', 'none']:
+            self.assertEqual(
+                config.resolve_cache_rules(key_name, rules),
+                config.resolve_cache_rules(key_name, raw_rules))
+
+    def test_compile_cache_rules_with_fingerprint(self):
+        rules = self.compile(
+            fingerprint_regexp=r'\.[0-9a-f]{8}\.js$',
+            cache_rules=[{'match': '*.js', 'maxage': 60}])['cache_rules']
+        self.assertIsInstance(rules, config.RuleList)
+        self.assertEqual(
+            config.resolve_cache_rules('app.0123abcd.js', rules),
+            config.IMMUTABLE_CACHE_CONTROL)
+        self.assertEqual(
+            config.resolve_cache_rules('app.js', rules), 'max-age=60')
+
+    def test_compile_precompressed(self):
+        self.assertEqual(
+            self.compile(precompressed=True)['precompressed'], ('gzip',))
+        self.assertEqual(
+            self.compile(precompressed=['br', 'gzip'])['precompressed'],
+            ('br', 'gzip'))
+        self.assertIsNone(self.compile(precompressed=False)['precompressed'])
+        with self.assertRaises(ValueError):
+            self.compile(precompressed=['zstd'])
+
+    def test_compile_storage_class_rules(self):
+        rules = self.compile(storage_class_rules=[
+            {'match': '*.mp4', 'storage_class': 'INTELLIGENT_TIERING'},
+        ])['storage_class_rules']
+        self.assertEqual(
+            config.resolve_storage_class('a/b.mp4', rules, 'STANDARD'),
+            'INTELLIGENT_TIERING')
+        self.assertEqual(
+            config.resolve_storage_class('index.html', rules, 'STANDARD'),
+            'STANDARD')
+        with self.assertRaises(ValueError):
+            self.compile(storage_class_rules=[
+                {'match': '*', 'storage_class': 'FAST'}])
+
+    def test_compile_redirects(self):
+        self.assertEqual(self.compile(redirects={
+            '/old.html': '/new.html',
+            'blog/index.html': 'https://blog.example.com/',
+        })['redirects'], (
+            ('blog/index.html', 'https://blog.example.com/'),
+            ('old.html', '/new.html'),
+        ))
+        with self.assertRaises(ValueError):
+            self.compile(redirects=['old.html'])
+        with self.assertRaises(ValueError):
+            self.compile(redirects={'old.html': 'new.html'})
+        with self.assertRaises(ValueError):
+            self.compile(redirects={'/': '/new.html'})
+
+    def test_compile_cache_rule_without_pattern(self):
+        with self.assertRaises(ValueError):
+            self.compile(cache_rules=[{'maxage': 100}])
+
+    def test_compile_cache_rule_invalid_duration(self):
+        with self.assertRaises(ValueError):
+            self.compile(cache_rules=[{'match': '*', 'maxage': 'forever'}])
+
+    def test_compile_cache_rule_invalid_regexp(self):
+        with self.assertRaises(ValueError):
+            self.compile(cache_rules=[{'match_regexp': '(', 'maxage': 1}])
+
+    def test_compile_cache_rule_empty_pattern(self):
+        with self.assertRaises(ValueError):
+            self.compile(cache_rules=[{'match': '', 'maxage': 1}])
+
+    def test_compile_cache_rules_not_list(self):
+        with self.assertRaises(ValueError):
+            self.compile(cache_rules={'match': '*'})
+
+    def test_compile_upload_priority(self):
+        rules = self.compile(upload_priority=[
+            {'match': '*.html', 'priority': 5},
+        ])['upload_priority']
+        self.assertEqual(
+            config.resolve_upload_priority('index.html', rules), 5)
+        self.assertEqual(
+            config.resolve_upload_priority('app.js', rules), 0)
+
+    def test_compile_upload_priority_invalid(self):
+        with self.assertRaises(ValueError):
+            self.compile(upload_priority=[{'match': '*', 'priority': 'x'}])
+
+    def test_compile_max_bandwidth(self):
+        conf = self.compile(max_bandwidth='1 MB')
+        self.assertEqual(conf['max_bandwidth'], 1024**2)
+
+    def test_compile_memory_limit(self):
+        conf = self.compile(memory_limit='64 MB')
+        self.assertEqual(conf['memory_limit'], 64 * 1024**2)
+        with self.assertRaises(ValueError):
+            self.compile(memory_limit=0)
+
+    def test_compile_invalid_concurrency(self):
+        with self.assertRaises(ValueError):
+            self.compile(concurrency=0)
+
+    def test_compile_fingerprint(self):
+        conf = self.compile(
+            fingerprint_regexp=r'\.[0-9a-f]{6,}\.(js|css)$',
+            cache_rules=[{'match': '*', 'maxage': 60}],
+            orphan_grace_period='2 days')
+        self.assertEqual(
+            config.resolve_cache_rules('app.3f9a2c.js', conf['cache_rules']),
+            config.IMMUTABLE_CACHE_CONTROL)
+        self.assertEqual(
+            config.resolve_cache_rules('app.js', conf['cache_rules']),
+            'max-age=60')
+        self.assertIs(
+            config.fingerprint_pattern(conf), conf['fingerprint_regexp'])
+        self.assertEqual(conf['orphan_grace_period'], 2 * 24 * 3600)
+
+    def test_compile_fingerprint_invalid(self):
+        with self.assertRaises(ValueError):
+            self.compile(fingerprint_regexp='(')
+
+
+class ExpandTargetsTest(unittest.TestCase):
+    def test_single_target(self):
+        conf = {'site': '_site', 's3_bucket': 'example.com'}
+        self.assertEqual(config.expand_targets(conf), [conf])
+
+    def test_targets_inherit_options(self):
+        conf = {
+            'site': '_site',
+            'cache_rules': [{'match': '*', 'maxage': 60}],
+            'targets': [
+                {'s3_bucket': 'a.example.com'},
+                {'s3_bucket': 'b.example.com', 'site': '_other'},
+            ],
+        }
+        targets = config.expand_targets(conf)
+        self.assertEqual([t['s3_bucket'] for t in targets], [
+            'a.example.com', 'b.example.com'])
+        self.assertEqual([t['site'] for t in targets], ['_site', '_other'])
+        self.assertEqual(targets[1]['cache_rules'], conf['cache_rules'])
+        self.assertNotIn('targets', targets[0])
+
+    def test_targets_manifest_per_target(self):
+        targets = config.expand_targets({
+            'site': '_site',
+            'manifest': 'state/manifest.json',
+            'targets': [
+                {'s3_bucket': 'a.example.com'},
+                {'s3_bucket': 'b.example.com'},
+                {'s3_bucket': 'c.example.com', 'manifest': 'c.json'},
+            ],
+        })
+        self.assertEqual([t['manifest'] for t in targets], [
+            'state/manifest.a.example.com.json',
+            'state/manifest.b.example.com.json',
+            'c.json'])
+
+        targets = config.expand_targets({
+            'manifest': 'manifest.json',
+            'targets': [{'s3_bucket': 'a.example.com'}],
+        })
+        self.assertEqual(targets[0]['manifest'], 'manifest.json')
+
+        with self.assertRaises(ValueError):
+            config.expand_targets({'targets': [
+                {'s3_bucket': 'a.example.com', 'manifest': 'm.json'},
+                {'s3_bucket': 'b.example.com', 'manifest': 'm.json'},
+            ]})
+
+    def test_targets_invalid(self):
+        with self.assertRaises(ValueError):
+            config.expand_targets({'targets': []})
+        with self.assertRaises(ValueError):
+            config.expand_targets({'targets': ['a.example.com']})
+
+
+class ConfigCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, '.s3_website.yaml')
+        with open(self.path, 'w') as f:
+            f.write('site: _site\ns3_bucket: example.com\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parsed_once(self):
+        import yaml
+        with patch.object(yaml, 'safe_load', wraps=yaml.safe_load) as load:
+            conf_1, _ = config.load_config_file(self.path)
+            conf_1['site'] = 'modified'
+            conf_2, _ = config.load_config_file(self.path)
+
+        self.assertEqual(load.call_count, 1)
+        self.assertEqual(conf_2['site'], '_site')
+
+    def test_reparsed_when_changed(self):
+        config.load_config_file(self.path)
+        with open(self.path, 'w') as f:
+            f.write('site: _other_site\ns3_bucket: example.com\n')
+        os.utime(self.path, (0, 0))
+
+        conf, _ = config.load_config_file(self.path)
+        self.assertEqual(conf['site'], '_other_site')
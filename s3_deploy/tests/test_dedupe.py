@@ -0,0 +1,54 @@
+
+import threading
+import unittest
+
+from s3_deploy import dedupe
+
+
+DIGEST = '0123456789abcdef0123456789abcdef'
+
+
+class DigestFromEtagTest(unittest.TestCase):
+    def test_quoted(self):
+        self.assertEqual(
+            dedupe.digest_from_etag('"{}"'.format(DIGEST.upper())), DIGEST)
+
+    def test_multipart(self):
+        self.assertIsNone(dedupe.digest_from_etag('"{}-3"'.format(DIGEST)))
+
+    def test_none(self):
+        self.assertIsNone(dedupe.digest_from_etag(None))
+
+
+class ContentIndexTest(unittest.TestCase):
+    def test_remote_source(self):
+        index = dedupe.ContentIndex()
+        index.add('"{}"'.format(DIGEST), 'a.js')
+        self.assertEqual(index.claim(DIGEST), 'a.js')
+
+    def test_uploaded_source(self):
+        index = dedupe.ContentIndex()
+        self.assertIsNone(index.claim(DIGEST))
+        index.release(DIGEST, 'a.js', True)
+        self.assertEqual(index.claim(DIGEST), 'a.js')
+
+    def test_failed_upload_is_claimed_again(self):
+        index = dedupe.ContentIndex()
+        self.assertIsNone(index.claim(DIGEST))
+        index.release(DIGEST, 'a.js', False)
+        self.assertIsNone(index.claim(DIGEST))
+
+    def test_waits_for_pending_upload(self):
+        index = dedupe.ContentIndex()
+        self.assertIsNone(index.claim(DIGEST))
+
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(index.claim(DIGEST)))
+        thread.start()
+        thread.join(0.05)
+        self.assertEqual(result, [])
+
+        index.release(DIGEST, 'a.js', True)
+        thread.join()
+        self.assertEqual(result, ['a.js'])
@@ -1,17 +1,39 @@
 
+import functools
+import gzip
+import hashlib
+import json
+import mimetypes
 import os
+import random
 import shutil
+import subprocess
+import sys
 import tempfile
 import time
 import unittest
+from datetime import datetime
 
 import boto3
 import mock
 from mock import call
 from mock import patch
 from moto import mock_s3
+from six import BytesIO
 
+from s3_deploy import config
+from s3_deploy import dedupe
+from s3_deploy import hashing
+from s3_deploy import history
 from s3_deploy import deploy
+from s3_deploy import lock
+from s3_deploy import manifest
+from s3_deploy import orphans
+from s3_deploy import shard
+from s3_deploy import stats
+from s3_deploy import storage
+from s3_deploy import tracing
+from s3_deploy.listing import RemoteObject
 
 
 class KeyNameFromPathTest(unittest.TestCase):
@@ -35,6 +57,300 @@ class KeyNameFromPathTest(unittest.TestCase):
         self.assertEqual(key, 'directory/image.png')
 
 
+class PlanActionsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for path in ['a.html', 'a/1.html', 'a/b/2.html', 'a0.txt', 'c.txt']:
+            path = os.path.join(self.tmp_dir, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write('contents\n')
+
+        self.past = datetime.fromtimestamp(0, deploy.UTC)
+        self.future = datetime.fromtimestamp(time.time() + 1000, deploy.UTC)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def remote(self, key_name, last_modified, storage_class='STANDARD'):
+        return RemoteObject(key_name, last_modified, storage_class, 0, None)
+
+    def test_iter_site_files_key_order(self):
+        keys = [key_name for key_name, _ in deploy.iter_site_files(
+            self.tmp_dir)]
+        self.assertEqual(keys, [
+            'a.html', 'a/1.html', 'a/b/2.html', 'a0.txt', 'c.txt'])
+
+    def test_iter_site_files_precompressed(self):
+        for name in ['a.html.gz', 'a.html.br', 'a/b/orphan.gz']:
+            with open(os.path.join(self.tmp_dir, *name.split('/')), 'w') as f:
+                f.write('compressed\n')
+        keys = [key_name for key_name, _ in deploy.iter_site_files(
+            self.tmp_dir, precompressed=('gzip',))]
+        self.assertEqual(keys, [
+            'a.html', 'a.html.br', 'a/1.html', 'a/b/2.html', 'a/b/orphan.gz',
+            'a0.txt', 'c.txt'])
+
+    def test_iter_site_files_prefix(self):
+        keys = [key_name for key_name, _ in deploy.iter_site_files(
+            self.tmp_dir, prefix='a/')]
+        self.assertEqual(keys, ['a/1.html', 'a/b/2.html'])
+        self.assertEqual(list(deploy.iter_site_files(
+            self.tmp_dir, prefix='missing/')), [])
+
+    def test_iter_site_files_paths(self):
+        for key_name, path in deploy.iter_site_files(self.tmp_dir):
+            self.assertEqual(
+                path, os.path.join(self.tmp_dir, *key_name.split('/')))
+
+    def test_plan_actions(self):
+        objects = [
+            self.remote('a/1.html', self.future),
+            self.remote('a/b/2.html', self.past),
+            self.remote('a/c.html', self.future),
+            self.remote('c.txt', self.future, storage_class='GLACIER'),
+            self.remote('d.txt', self.future),
+        ]
+        actions = list(deploy.plan_actions(
+            objects, self.tmp_dir, False, 'STANDARD'))
+        self.assertEqual([(a.kind, a.key) for a in actions], [
+            (deploy.ACTION_CREATE, 'a.html'),
+            (deploy.ACTION_SKIP, 'a/1.html'),
+            (deploy.ACTION_UPDATE, 'a/b/2.html'),
+            (deploy.ACTION_DELETE, 'a/c.html'),
+            (deploy.ACTION_CREATE, 'a0.txt'),
+            (deploy.ACTION_UPDATE, 'c.txt'),
+            (deploy.ACTION_DELETE, 'd.txt'),
+        ])
+
+    def test_plan_actions_storage_class_rules(self):
+        rules = config.compile_config({
+            'site': '_site', 's3_bucket': 'bucket',
+            'storage_class_rules': [
+                {'match': '*.txt', 'storage_class': 'INTELLIGENT_TIERING'}],
+        })['storage_class_rules']
+        objects = [
+            self.remote('a.html', self.future),
+            self.remote('a0.txt', self.future),
+            self.remote('c.txt', self.future, storage_class='GLACIER'),
+        ]
+        actions = list(deploy.plan_actions(
+            objects, self.tmp_dir, False, 'STANDARD',
+            storage_class_rules=rules))
+        self.assertEqual([(a.kind, a.key) for a in actions], [
+            (deploy.ACTION_SKIP, 'a.html'),
+            (deploy.ACTION_CREATE, 'a/1.html'),
+            (deploy.ACTION_CREATE, 'a/b/2.html'),
+            (deploy.ACTION_TRANSITION, 'a0.txt'),
+            (deploy.ACTION_UPDATE, 'c.txt'),
+        ])
+
+    def test_plan_actions_force(self):
+        objects = [self.remote('a/1.html', self.future)]
+        actions = list(deploy.plan_actions(
+            objects, self.tmp_dir, True, 'STANDARD'))
+        self.assertIn(
+            deploy.Action(deploy.ACTION_UPDATE, 'a/1.html',
+                          os.path.join(self.tmp_dir, 'a', '1.html')),
+            actions)
+
+    def test_plan_actions_key_filter(self):
+        objects = [self.remote('a/1.html', self.past),
+                   self.remote('d.txt', self.future)]
+        actions = list(deploy.plan_actions(
+            objects, self.tmp_dir, False, 'STANDARD',
+            key_filter=lambda key_name: key_name.startswith('a/')))
+        self.assertEqual([(a.kind, a.key) for a in actions], [
+            (deploy.ACTION_UPDATE, 'a/1.html'),
+            (deploy.ACTION_CREATE, 'a/b/2.html'),
+        ])
+
+    def test_plan_actions_immutable(self):
+        objects = [self.remote('a/1.html', self.future),
+                   self.remote('a/b/2.html', self.past),
+                   self.remote('c.txt', self.past)]
+        actions = list(deploy.plan_actions(
+            objects, self.tmp_dir, False, 'GLACIER',
+            immutable=lambda key_name: key_name.endswith('.html')))
+        self.assertEqual([(a.kind, a.key) for a in actions], [
+            (deploy.ACTION_CREATE, 'a.html'),
+            (deploy.ACTION_SKIP, 'a/1.html'),
+            (deploy.ACTION_SKIP, 'a/b/2.html'),
+            (deploy.ACTION_CREATE, 'a0.txt'),
+            (deploy.ACTION_UPDATE, 'c.txt'),
+        ])
+
+    def test_plan_actions_compare_content(self):
+        for name in ['x.png', 'y.png']:
+            with open(os.path.join(self.tmp_dir, name), 'wb') as f:
+                f.write(b'image\n')
+        etag = '"{}"'.format(hashlib.md5(b'image\n').hexdigest())
+        objects = [
+            RemoteObject('a.html', self.past, 'STANDARD', 0, etag),
+            RemoteObject('x.png', self.past, 'STANDARD', 0, etag),
+            RemoteObject('y.png', self.past, 'STANDARD', 0, '"other"'),
+        ]
+        with hashing.Hasher() as hasher, \
+                patch.object(hasher, 'submit', wraps=hasher.submit) as submit:
+            actions = list(deploy.plan_actions(
+                objects, self.tmp_dir, False, 'STANDARD',
+                key_filter=lambda key_name: '/' not in key_name,
+                hasher=hasher))
+        self.assertEqual([(a.kind, a.key) for a in actions], [
+            (deploy.ACTION_UPDATE, 'a.html'),
+            (deploy.ACTION_CREATE, 'a0.txt'),
+            (deploy.ACTION_CREATE, 'c.txt'),
+            (deploy.ACTION_SKIP, 'x.png'),
+            (deploy.ACTION_UPDATE, 'y.png'),
+        ])
+        # Files compressed locally are not hashed
+        self.assertEqual(submit.call_count, 2)
+
+    def test_plan_actions_shard_hashes_own_keys(self):
+        names = ['{}.png'.format(i) for i in range(40)]
+        for name in names:
+            with open(os.path.join(self.tmp_dir, name), 'wb') as f:
+                f.write(b'image\n')
+        objects = sorted(
+            (RemoteObject(name, self.past, 'STANDARD', 0, '"other"')
+             for name in names), key=lambda obj: obj.key)
+        key_filter = functools.partial(shard.key_in_shard, shard=(0, 4))
+        with hashing.Hasher() as hasher, \
+                patch.object(hasher, 'submit', wraps=hasher.submit) as submit:
+            actions = list(deploy.plan_actions(
+                objects, self.tmp_dir, False, 'STANDARD',
+                key_filter=key_filter, hasher=hasher))
+
+        owned = [name for name in names if key_filter(name)]
+        self.assertLess(len(owned), len(names))
+        self.assertEqual(
+            sorted(a.key for a in actions if a.key.endswith('.png')),
+            sorted(owned))
+        # Files of keys in other shards are not hashed
+        self.assertEqual(submit.call_count, len(owned))
+
+    def test_plan_actions_redirects(self):
+        redirects = (
+            ('a/0.html', '/a/1.html'),
+            ('a0.txt', '/c.txt'),
+            ('b.html', '/a.html'),
+            ('old.html', 'https://example.com/'),
+        )
+        objects = [
+            RemoteObject('b.html', self.past, 'STANDARD', 0,
+                         '"{}"'.format(deploy.redirect_etag('/a.html'))),
+            RemoteObject('old.html', self.past, 'STANDARD', 0,
+                         '"{}"'.format(deploy.redirect_etag('/other.html'))),
+        ]
+        actions = list(deploy.plan_actions(
+            objects, self.tmp_dir, False, 'STANDARD', redirects=redirects))
+        self.assertEqual(
+            [(a.kind, a.key, a.path is None, a.location) for a in actions], [
+                (deploy.ACTION_CREATE, 'a.html', False, None),
+                (deploy.ACTION_CREATE, 'a/0.html', True, '/a/1.html'),
+                (deploy.ACTION_CREATE, 'a/1.html', False, None),
+                (deploy.ACTION_CREATE, 'a/b/2.html', False, None),
+                (deploy.ACTION_CREATE, 'a0.txt', True, '/c.txt'),
+                (deploy.ACTION_SKIP, 'b.html', True, '/a.html'),
+                (deploy.ACTION_CREATE, 'c.txt', False, None),
+                (deploy.ACTION_UPDATE, 'old.html', True,
+                 'https://example.com/'),
+            ])
+
+
+class InvalidationPlanTest(unittest.TestCase):
+    def test_index_document_excluded(self):
+        plan = deploy.InvalidationPlan({'index_document': 'index.html'})
+        plan.add_unchanged('docs/')
+        plan.add_updated('docs/index.html')
+        plan.add_updated('other.html')
+        self.assertEqual(plan.paths(), ['/other.html'])
+
+    def test_prefix_narrows_wildcards(self):
+        plan = deploy.InvalidationPlan({}, prefix='docs/')
+        plan.add_updated('docs/a.html')
+        plan.add_updated('docs/b.html')
+        self.assertEqual(plan.paths(), ['/docs/*'])
+
+        plan = deploy.InvalidationPlan({}, prefix='docs/')
+        plan.add_updated('docs/api/a.html')
+        plan.add_unchanged('docs/b.html')
+        self.assertEqual(plan.paths(), ['/docs/api/a.html'])
+
+    def test_index_document(self):
+        plan = deploy.InvalidationPlan({'index_document': 'index.html'})
+        plan.add_updated('docs/index.html')
+        plan.add_unchanged('other.html')
+        self.assertEqual(plan.paths(), ['/docs/'])
+
+    def test_memory_limit(self):
+        keys = ['a/{}/{}.html'.format(i, j)
+                for i in range(20) for j in range(20)]
+        plans = [deploy.InvalidationPlan({}),
+                 deploy.InvalidationPlan({'memory_limit': 2000})]
+        for plan in plans:
+            for i, key_name in enumerate(keys):
+                if i % 7 == 0:
+                    plan.add_unchanged(key_name)
+                else:
+                    plan.add_updated(key_name)
+        self.assertEqual(plans[1].paths(), plans[0].paths())
+
+    def test_memory_limit_index_document(self):
+        for conf in ({'index_document': 'index.html'},
+                     {'index_document': 'index.html', 'memory_limit': 2000}):
+            plan = deploy.InvalidationPlan(conf)
+            plan.add_updated('docs/index.html')
+            plan.add_unchanged('docs/page.html')
+            plan.add_unchanged('other.html')
+            self.assertEqual(plan.paths(), ['/docs/'])
+
+    def test_memory_limit_matches_tree(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            rows = []
+            for _ in range(rng.randint(0, 12)):
+                key_name = ''.join(rng.choice(['a', 'b/', 'index.html'])
+                                   for _ in range(rng.randint(1, 4)))
+                rows.append((key_name, rng.random() < 0.7))
+                if rng.random() < 0.2:
+                    # Updated in one shard and unchanged in another
+                    rows.append((key_name, False))
+
+            plans = [
+                deploy.InvalidationPlan({'index_document': 'index.html'}),
+                deploy.InvalidationPlan({'index_document': 'index.html',
+                                         'memory_limit': 2000})]
+            for plan in plans:
+                # The planner adds the keys in key order
+                for key_name, updated in sorted(rows, key=lambda r: r[0]):
+                    if updated:
+                        plan.add_updated(key_name)
+                    else:
+                        plan.add_unchanged(key_name)
+            self.assertEqual(plans[1].paths(), plans[0].paths())
+
+    def test_index_document_updated_then_unchanged(self):
+        for conf in ({}, {'memory_limit': 2000}):
+            conf['index_document'] = 'index.html'
+            plan = deploy.InvalidationPlan(conf)
+            plan.add_updated('docs/a.html')
+            plan.add_updated('docs/index.html')
+            plan.add_unchanged('docs/')
+            self.assertEqual(plan.paths(), ['/docs/a.html'])
+
+    def test_fingerprinted_keys_ignored(self):
+        plan = deploy.InvalidationPlan(
+            {'fingerprint_regexp': r'\.[0-9a-f]{6}\.js$'})
+        plan.add_updated('assets/app.3f9a2c.js')
+        plan.add_updated('assets/main.css')
+        plan.add_updated('assets/style.css')
+        plan.add_unchanged('assets/vendor.0b1c2d.js')
+        plan.add_unchanged('index.html')
+        self.assertEqual(plan.paths(), ['/assets/*'])
+
+
 @mock_s3
 class UploadKeyTest(unittest.TestCase):
     def setUp(self):
@@ -56,12 +372,433 @@ class UploadKeyTest(unittest.TestCase):
 
         obj = self.bucket.Object('some_file')
 
-        deploy.upload_key(obj, file_path, {}, False)
+        deploy.upload_key(
+            self.s3.meta.client, self.bucket.name, 'some_file', file_path,
+            {}, False)
 
         self.assertEqual(obj.content_type, 'text/plain')
         self.assertEqual(
             obj.get()['Body'].read().decode('utf-8'), file_contents)
 
+    @patch('mimetypes.guess_type', return_value=['text/plain'])
+    def test_upload_key_bandwidth(self, mock_mime):
+        file_path = os.path.join(self.tmp_dir, 'some_file')
+        with open(file_path, 'wb') as f:
+            f.write(b'x' * 100)
+
+        bandwidth = mock.Mock(spec=['consume'])
+
+        deploy.upload_key(
+            self.s3.meta.client, self.bucket.name, 'some_file', file_path,
+            {}, False, bandwidth=bandwidth)
+
+        bandwidth.consume.assert_called_once_with(100)
+
+    @patch('mimetypes.guess_type', return_value=['text/plain'])
+    def test_upload_key_copies_identical(self, mock_mime):
+        file_path = os.path.join(self.tmp_dir, 'some_file')
+        with open(file_path, 'w') as f:
+            f.write('file contents\n')
+
+        client = self.s3.meta.client
+        client.put_object(Bucket=self.bucket.name, Key='other_file',
+                          Body=b'file contents\n')
+        etag = client.head_object(
+            Bucket=self.bucket.name, Key='other_file')['ETag']
+
+        content_index = dedupe.ContentIndex()
+        content_index.add(etag, 'other_file')
+        with patch.object(client, 'put_object') as mock_put:
+            deploy.upload_key(
+                client, self.bucket.name, 'some_file', file_path,
+                {}, False, content_index=content_index)
+        mock_put.assert_not_called()
+
+        obj = self.bucket.Object('some_file')
+        self.assertEqual(obj.content_type, 'text/plain')
+        self.assertEqual(obj.get()['Body'].read(), b'file contents\n')
+
+    def test_upload_key_precompressed(self):
+        file_path = os.path.join(self.tmp_dir, 'app.js')
+        with open(file_path, 'w') as f:
+            f.write('var a;\n')
+        with open(file_path + '.gz', 'wb') as f:
+            f.write(b'precompressed')
+
+        deploy.upload_key(
+            self.s3.meta.client, self.bucket.name, 'app.js', file_path,
+            {}, False, precompressed=('br', 'gzip'))
+
+        obj = self.bucket.Object('app.js')
+        self.assertEqual(
+            obj.content_type, mimetypes.guess_type('app.js')[0])
+        self.assertTrue(obj.content_encoding.startswith('gzip'))
+        self.assertEqual(obj.get()['Body'].read(), b'precompressed')
+
+    def test_upload_key_precompressed_without_sidecar(self):
+        file_path = os.path.join(self.tmp_dir, 'app.js')
+        with open(file_path, 'w') as f:
+            f.write('var a;\n')
+
+        deploy.upload_key(
+            self.s3.meta.client, self.bucket.name, 'app.js', file_path,
+            {}, False, precompressed=('gzip',))
+
+        obj = self.bucket.Object('app.js')
+        self.assertEqual(obj.get()['Body'].read(), b'var a;\n')
+
+
+class VerifyUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'a.png')
+        with open(self.path, 'wb') as f:
+            f.write(b'image')
+        self.client = storage.MemoryStorage()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def upload(self):
+        with patch.object(self.client, 'put_object',
+                          wraps=self.client.put_object) as mock_put:
+            deploy.upload_key(
+                self.client, 'bucket', 'a.png', self.path, (), False,
+                verify=True)
+        return mock_put.call_count
+
+    def test_skips_identical(self):
+        self.client.put('a.png', b'image', {'ContentType': 'image/png'})
+        self.assertEqual(self.upload(), 0)
+
+    def test_uploads_missing(self):
+        self.assertEqual(self.upload(), 1)
+        self.assertEqual(self.client.get('a.png')[0], b'image')
+
+    def test_uploads_different_body(self):
+        self.client.put('a.png', b'other', {'ContentType': 'image/png'})
+        self.assertEqual(self.upload(), 1)
+
+    def test_uploads_different_headers(self):
+        self.client.put('a.png', b'image', {
+            'ContentType': 'image/png', 'CacheControl': 'no-cache'})
+        self.assertEqual(self.upload(), 1)
+
+
+class StorageClassTransitionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, '_site'))
+        for name in ['index.html', 'video.mp4']:
+            with open(os.path.join(self.tmp_dir, '_site', name), 'w') as f:
+                f.write('contents\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_transition_by_copy(self):
+        conf = {
+            's3_bucket': 'bucket',
+            'site': '_site',
+            'storage_url': 'memory://transition-test',
+        }
+        deploy.deploy(conf, self.tmp_dir, False, False)
+
+        client = storage.create_storage('memory://transition-test')
+        conf['storage_class_rules'] = [
+            {'match': '*.mp4', 'storage_class': 'INTELLIGENT_TIERING'}]
+        with patch.object(client, 'put_object') as mock_put:
+            deploy.deploy(conf, self.tmp_dir, False, False)
+        mock_put.assert_not_called()
+
+        self.assertEqual(
+            [(obj.key, obj.storage_class) for obj in client.list()], [
+                ('index.html', 'STANDARD'),
+                ('video.mp4', 'INTELLIGENT_TIERING'),
+            ])
+        self.assertEqual(
+            client.head('video.mp4')['ContentType'], 'video/mp4')
+
+    def test_failed_transition_uploads(self):
+        client = storage.MemoryStorage()
+        path = os.path.join(self.tmp_dir, '_site', 'video.mp4')
+        deploy._transition_or_upload(
+            client, 'bucket', 'video.mp4', path, (), False,
+            storage_class='STANDARD_IA')
+        self.assertEqual(
+            client.head('video.mp4')['StorageClass'], 'STANDARD_IA')
+
+
+class LockedDeployTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, '_site'))
+        with open(os.path.join(self.tmp_dir, '_site', 'a.txt'), 'w') as f:
+            f.write('a\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lock_is_held_during_deploy(self):
+        client = storage.create_storage('memory://locked-deploy-test')
+        owners = []
+
+        def upload(client, bucket_name, key_name, *args, **kwargs):
+            body = client.get(lock.LOCK_KEY)[0]
+            owners.append(json.loads(body.decode('utf-8'))['owner'])
+
+        with patch('s3_deploy.deploy.upload_key', side_effect=upload):
+            deploy.deploy({
+                's3_bucket': 'bucket',
+                'site': '_site',
+                'storage_url': 'memory://locked-deploy-test',
+                'lock': True,
+            }, self.tmp_dir, False, False)
+
+        self.assertEqual(len(owners), 1)
+        self.assertIsNone(client.head(lock.LOCK_KEY))
+
+
+class RedirectDeployTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, '_site'))
+        with open(os.path.join(self.tmp_dir, '_site', 'new.html'), 'w') as f:
+            f.write('new\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_redirects_are_diffed(self):
+        conf = {
+            's3_bucket': 'bucket',
+            'site': '_site',
+            'storage_url': 'memory://redirect-test',
+            'redirects': {'/old.html': '/new.html', '/gone.html': '/'},
+            'cache_rules': [{'match': '*', 'maxage': 60}],
+        }
+        deploy.deploy(conf, self.tmp_dir, False, False)
+
+        client = storage.create_storage('memory://redirect-test')
+        self.assertEqual(
+            [obj.key for obj in client.list()],
+            ['gone.html', 'new.html', 'old.html'])
+        headers = client.head('old.html')
+        self.assertEqual(headers['WebsiteRedirectLocation'], '/new.html')
+        self.assertEqual(headers['CacheControl'], 'max-age=60')
+
+        conf['redirects'] = {'/old.html': '/new.html'}
+        with patch.object(client, 'put_object') as mock_put:
+            deploy.deploy(conf, self.tmp_dir, False, False)
+        mock_put.assert_not_called()
+        self.assertEqual(
+            [obj.key for obj in client.list()], ['new.html', 'old.html'])
+
+
+class ScopedDeployTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for name in ['index.html', 'docs/index.html', 'docs/new.html']:
+            path = os.path.join(self.tmp_dir, '_site', *name.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write('contents\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_deploy_prefix(self):
+        client = storage.create_storage('memory://scoped-deploy-test')
+        for key_name in ['about.html', 'docs/old.html']:
+            client.put(key_name, b'old', {})
+
+        with patch('s3_deploy.deploy.invalidate_paths') as mock_invalidate:
+            deploy.deploy({
+                's3_bucket': 'bucket',
+                'site': '_site',
+                'storage_url': 'memory://scoped-deploy-test',
+                'cloudfront_distribution_id': 'ABCDEFGHI',
+            }, self.tmp_dir, False, False, prefix='docs/')
+
+        self.assertEqual([obj.key for obj in client.list()], [
+            'about.html', 'docs/index.html', 'docs/new.html'])
+        mock_invalidate.assert_called_once_with(
+            'ABCDEFGHI', ['/docs/*'], False)
+
+
+class DryRunStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, '_site'))
+        with open(os.path.join(self.tmp_dir, '_site', 'index.html'), 'w') as f:
+            f.write('<p>Hello</p>\n' * 1000)
+        with open(os.path.join(self.tmp_dir, '_site', 'image.png'), 'w') as f:
+            f.write('x' * 100)
+
+    def tearDown(self):
+        stats.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_dry_run_estimate(self):
+        client = storage.create_storage('memory://dry-run-stats-test')
+        client.put('old.html', b'old', {})
+
+        stats.start()
+        with patch('s3_deploy.compression.gzip_compress',
+                   wraps=deploy.compression.gzip_compress) as mock_compress:
+            deploy.deploy({
+                's3_bucket': 'bucket',
+                'site': '_site',
+                'storage_url': 'memory://dry-run-stats-test',
+            }, self.tmp_dir, False, True)
+        deploy_stats = stats.stop()
+
+        # Only a sample is compressed, never through the upload path
+        self.assertEqual(mock_compress.call_count, 1)
+        self.assertEqual(deploy_stats.requests[stats.PUT], 2)
+        self.assertEqual(deploy_stats.requests[stats.DELETE], 1)
+        self.assertEqual(deploy_stats.requests[stats.LIST], 1)
+        self.assertGreater(deploy_stats.bytes_uploaded, 100)
+        self.assertLess(deploy_stats.bytes_uploaded, 13000)
+        self.assertEqual(
+            [obj.key for obj in client.list()], ['old.html'])
+
+
+class SyncPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, '_site'))
+        for name in ['a.html', 'b.html']:
+            with open(os.path.join(self.tmp_dir, '_site', name), 'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_records_actions(self):
+        client = storage.create_storage('memory://sync-plan-test')
+        client.put('b.html', b'b.html', {})
+        client.put('old.html', b'old', {})
+        client.put('old.css', b'old', {})
+        os.utime(os.path.join(self.tmp_dir, '_site', 'b.html'), (0, 0))
+        conf = config.compile_config({
+            's3_bucket': 'bucket',
+            'site': '_site',
+            'storage_url': 'memory://sync-plan-test',
+            'manifest': 'manifest.json',
+            'fingerprint_regexp': r'\.css$',
+            'cloudfront_distribution_id': 'ABCDEFGHI',
+        })
+
+        plan = deploy.SyncPlan(conf, self.tmp_dir, False, False, client)
+        # Unchanged keys and deferred deletions need no request
+        self.assertEqual([(a.kind, a.key) for a in plan], [
+            (deploy.ACTION_CREATE, 'a.html'),
+            (deploy.ACTION_DELETE, 'old.html'),
+        ])
+        with patch('s3_deploy.deploy.invalidate_paths') as mock_invalidate:
+            self.assertIsNone(plan.finish())
+
+        mock_invalidate.assert_called_once_with(
+            'ABCDEFGHI', ['/a.html', '/old.html'], False)
+        self.assertIn('old.css', orphans.OrphanLedger.load(client, 'bucket'))
+        self.assertEqual(sorted(manifest.load_manifest(
+            os.path.join(self.tmp_dir, 'manifest.json'), 'bucket')),
+            ['a.html', 'b.html'])
+
+    def test_stops_when_lock_lost(self):
+        client = storage.MemoryStorage()
+        conf = config.compile_config({'s3_bucket': 'bucket', 'site': '_site'})
+        deploy_lock = mock.Mock(spec=['check'])
+        plan = deploy.SyncPlan(conf, self.tmp_dir, False, False, client,
+                               lock=deploy_lock)
+        actions = iter(plan)
+        self.assertEqual(next(actions).key, 'a.html')
+
+        deploy_lock.check.side_effect = RuntimeError('Lock was lost')
+        with self.assertRaises(RuntimeError):
+            next(actions)
+        with self.assertRaises(RuntimeError):
+            plan.finish()
+
+
+class HistoryDeployTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, '_site'))
+        with open(os.path.join(self.tmp_dir, '_site', 'index.html'), 'w') as f:
+            f.write('<p>Hello</p>\n')
+        self.conf = {
+            's3_bucket': 'bucket',
+            'site': '_site',
+            'storage_url': 'memory://history-test',
+            'history': 'history.db',
+        }
+
+    def tearDown(self):
+        stats.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_deploy_appends_history(self):
+        client = storage.create_storage('memory://history-test')
+        client.put('old.html', b'old', {})
+
+        deploy.deploy(self.conf, self.tmp_dir, False, False)
+        deploy.deploy(self.conf, self.tmp_dir, False, False)
+        self.assertFalse(stats.enabled())
+
+        records = history.load(os.path.join(self.tmp_dir, 'history.db'))
+        self.assertEqual([r['keys_changed'] for r in records], [2, 0])
+        self.assertEqual(records[0]['bucket'], 'bucket')
+        self.assertEqual(records[0]['status'], 'ok')
+        self.assertEqual(records[0]['actions'], {'create': 1, 'delete': 1})
+        self.assertGreater(records[0]['bytes_uploaded'], 0)
+        self.assertIn('sync', records[0]['phases'])
+
+    def test_failed_deploy_is_recorded(self):
+        with patch('s3_deploy.deploy._sync_site',
+                   side_effect=RuntimeError('failed')):
+            with self.assertRaises(RuntimeError):
+                deploy.deploy(self.conf, self.tmp_dir, False, False)
+
+        records = history.load(os.path.join(self.tmp_dir, 'history.db'))
+        self.assertEqual([r['status'] for r in records], ['failed'])
+
+    def test_main_stats(self):
+        with open(os.path.join(self.tmp_dir, '.s3_website.yaml'), 'w') as f:
+            f.write('site: _site\ns3_bucket: bucket\n'
+                    'storage_url: memory://history-test\n'
+                    'history: history.db\n')
+        deploy.main(['-n', self.tmp_dir])
+
+        with patch('s3_deploy.deploy.history.report',
+                   wraps=history.report) as mock_report:
+            self.assertEqual(
+                deploy.main(['--stats', '--stats-limit', '5', self.tmp_dir]),
+                0)
+        records = mock_report.call_args[0][0]
+        self.assertEqual(len(records), 1)
+        self.assertTrue(records[0]['dry'])
+        self.assertEqual(mock_report.call_args[1]['limit'], 5)
+
+    def test_main_deploys_site_named_stats(self):
+        with patch('s3_deploy.config.load_config_file') as mock_load_config, \
+                patch('s3_deploy.deploy.deploy') as mock_deploy:
+            mock_load_config.return_value = {}, 'stats'
+            deploy.main(['stats'])
+
+        mock_load_config.assert_called_once_with('stats')
+        mock_deploy.assert_called_once_with(
+            {}, 'stats', False, False, concurrency=None, prefix='')
+
+    def test_main_stats_without_history(self):
+        with open(os.path.join(self.tmp_dir, '.s3_website.yaml'), 'w') as f:
+            f.write('site: _site\ns3_bucket: bucket\n')
+        with patch('sys.stderr'):
+            with self.assertRaises(SystemExit):
+                deploy.main(['--stats', self.tmp_dir])
+
 
 @mock_s3
 class MainDeployTest(unittest.TestCase):
@@ -110,8 +847,11 @@ class MainDeployTest(unittest.TestCase):
         """Assert that upload_key is called correctly."""
         mock_upload.assert_has_calls([
             call(
-                mock.ANY, os.path.join(self.site_dir, path), [], dry,
-                storage_class=deploy._STORAGE_STANDARD)
+                mock.ANY, self.bucket.name, path,
+                os.path.join(self.site_dir, path), (), dry,
+                storage_class=deploy._STORAGE_STANDARD, bandwidth=None,
+                compression_cache=None, content_index=None,
+                precompressed=None, verify=False)
             for path in ['updated_file.txt', 'new_file.txt']
         ], any_order=True)
 
@@ -156,6 +896,273 @@ class MainDeployTest(unittest.TestCase):
         self.assert_upload_key_called_correctly(mock_upload, dry=True)
         mock_invalidate.assert_not_called()
 
+    @patch('s3_deploy.deploy.upload_key')
+    @patch('s3_deploy.deploy.invalidate_paths')
+    def test_deploy_upload_priority(self, mock_invalidate, mock_upload):
+        deploy.deploy({
+            's3_bucket': self.bucket.name,
+            'site': '_site',
+            'upload_priority': [
+                {'match': 'new_file.txt', 'priority': 1},
+            ],
+            'max_bandwidth': '10 MB',
+        }, self.tmp_dir, False, False, concurrency=1)
+
+        self.assertEqual([c[0][2] for c in mock_upload.call_args_list], [
+            'updated_file.txt',
+            'new_file.txt',
+        ])
+        bandwidth = mock_upload.call_args[1]['bandwidth']
+        self.assertEqual(bandwidth.rate, 10 * 1024**2)
+
+    @patch('s3_deploy.deploy.invalidate_paths')
+    def test_deploy_manifest_check(self, mock_invalidate):
+        conf = {
+            's3_bucket': self.bucket.name,
+            'site': '_site',
+            'manifest': 'manifest.json',
+        }
+        self.assertEqual(deploy.check(conf, self.tmp_dir), [
+            'new_file.txt', 'unchanged_file.txt', 'updated_file.txt'])
+
+        deploy.deploy(conf, self.tmp_dir, False, False)
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.tmp_dir, 'manifest.json')))
+        self.assertEqual(deploy.check(conf, self.tmp_dir), [])
+
+        with open(os.path.join(self.site_dir, 'new_file.txt'), 'a') as f:
+            f.write('more contents\n')
+        self.assertEqual(deploy.check(conf, self.tmp_dir), ['new_file.txt'])
+
+    @patch('s3_deploy.deploy.invalidate_paths')
+    def test_deploy_manifest_check_sidecar(self, mock_invalidate):
+        conf = {
+            's3_bucket': self.bucket.name,
+            'site': '_site',
+            'manifest': 'manifest.json',
+            'precompressed': True,
+        }
+        sidecar = os.path.join(self.site_dir, 'new_file.txt.gz')
+        with open(sidecar, 'wb') as f:
+            f.write(b'compressed')
+        deploy.deploy(conf, self.tmp_dir, False, False)
+        self.assertEqual(deploy.check(conf, self.tmp_dir), [])
+
+        # The sidecar is uploaded in place of the file
+        with open(sidecar, 'ab') as f:
+            f.write(b' again')
+        self.assertEqual(deploy.check(conf, self.tmp_dir), ['new_file.txt'])
+
+    def test_check_without_manifest_option(self):
+        with self.assertRaises(ValueError):
+            deploy.check({'s3_bucket': 'bucket', 'site': '_site'},
+                         self.tmp_dir)
+
+    @patch('s3_deploy.deploy.upload_key')
+    @patch('s3_deploy.deploy.invalidate_paths')
+    def test_deploy_sharded(self, mock_invalidate, mock_upload):
+        conf = {
+            's3_bucket': self.bucket.name,
+            'site': '_site',
+            'cloudfront_distribution_id': 'ABCDEFGHI',
+        }
+        results = [
+            deploy.deploy(conf, self.tmp_dir, False, False, shard=(i, 3))
+            for i in range(3)
+        ]
+
+        self.assert_upload_key_called_correctly(mock_upload, dry=False)
+        self.assertEqual(mock_upload.call_count, 2)
+        mock_invalidate.assert_not_called()
+
+        # Deletion is deferred to the merge
+        self.assertIn('deleted_file.txt', [
+            obj.key for obj in self.bucket.objects.all()])
+
+        deploy.merge_shards(conf, results, False)
+
+        self.assertNotIn('deleted_file.txt', [
+            obj.key for obj in self.bucket.objects.all()])
+        mock_invalidate.assert_called_once_with('ABCDEFGHI', [
+            '/deleted_file.txt',
+            '/new_file.txt',
+            '/updated_file.txt',
+        ], False)
+
+    @patch('s3_deploy.deploy.invalidate_paths')
+    def test_deploy_deduplicate(self, mock_invalidate):
+        # new_file.txt and updated_file.txt have identical contents
+        with patch('s3_deploy.deploy._copy_key',
+                   wraps=deploy._copy_key) as mock_copy:
+            deploy.deploy({
+                's3_bucket': self.bucket.name,
+                'site': '_site',
+                'deduplicate': True,
+            }, self.tmp_dir, False, False)
+
+        self.assertEqual(mock_copy.call_count, 1)
+        for key_name in ['new_file.txt', 'updated_file.txt']:
+            obj = self.bucket.Object(key_name)
+            body = gzip.GzipFile(
+                fileobj=BytesIO(obj.get()['Body'].read())).read()
+            self.assertEqual(body, b'new contents\n')
+            self.assertEqual(obj.content_type, 'text/plain')
+
+    @patch('s3_deploy.deploy.invalidate_paths')
+    def test_deploy_fingerprinted(self, mock_invalidate):
+        with open(os.path.join(self.site_dir, 'app.0a1b2c.js'), 'w') as f:
+            f.write('new app\n')
+        with open(os.path.join(self.site_dir, 'lib.3d4e5f.js'), 'w') as f:
+            f.write('lib\n')
+        self.bucket.Object('lib.3d4e5f.js').put(Body='lib\n')
+        self.bucket.Object('app.9f8e7d.js').put(Body='old app\n')
+
+        conf = {
+            's3_bucket': self.bucket.name,
+            'site': '_site',
+            'cloudfront_distribution_id': 'ABCDEFGHI',
+            'fingerprint_regexp': r'\.[0-9a-f]{6}\.js$',
+        }
+        with patch('s3_deploy.deploy.upload_key',
+                   wraps=deploy.upload_key) as mock_upload:
+            deploy.deploy(conf, self.tmp_dir, False, False)
+
+        # Present fingerprinted keys are never compared
+        self.assertEqual(
+            sorted(c[0][2] for c in mock_upload.call_args_list),
+            ['app.0a1b2c.js', 'new_file.txt', 'updated_file.txt'])
+        self.assertEqual(
+            self.bucket.Object('app.0a1b2c.js').cache_control,
+            'public, max-age=31536000, immutable')
+
+        # The orphaned fingerprinted key is kept for the grace period
+        keys = [obj.key for obj in self.bucket.objects.all()]
+        self.assertIn('app.9f8e7d.js', keys)
+        self.assertNotIn('deleted_file.txt', keys)
+        mock_invalidate.assert_called_once_with('ABCDEFGHI', [
+            '/deleted_file.txt',
+            '/new_file.txt',
+            '/updated_file.txt',
+        ], False)
+
+        conf['orphan_grace_period'] = 0
+        deploy.deploy(conf, self.tmp_dir, False, False)
+        keys = [obj.key for obj in self.bucket.objects.all()]
+        self.assertNotIn('app.9f8e7d.js', keys)
+
+    @patch('s3_deploy.deploy.invalidate_paths')
+    def test_deploy_defer_deletion(self, mock_invalidate):
+        conf = {
+            's3_bucket': self.bucket.name,
+            'site': '_site',
+            'cloudfront_distribution_id': 'ABCDEFGHI',
+            'defer_deletion': True,
+        }
+        deploy.deploy(conf, self.tmp_dir, False, False)
+
+        keys = [obj.key for obj in self.bucket.objects.all()]
+        self.assertIn('deleted_file.txt', keys)
+        self.assertIn('.s3-deploy-orphans.json', keys)
+        mock_invalidate.assert_called_once_with('ABCDEFGHI', [
+            '/new_file.txt',
+            '/updated_file.txt',
+        ], False)
+
+        # Listed modification times are truncated to seconds
+        past = time.time() - 100
+        for name in ['new_file.txt', 'updated_file.txt']:
+            os.utime(os.path.join(self.site_dir, name), (past, past))
+
+        mock_invalidate.reset_mock()
+        conf['orphan_grace_period'] = 0
+        deploy.deploy(conf, self.tmp_dir, False, False)
+
+        keys = [obj.key for obj in self.bucket.objects.all()]
+        self.assertNotIn('deleted_file.txt', keys)
+        mock_invalidate.assert_called_once_with(
+            'ABCDEFGHI', ['/deleted_file.txt'], False)
+
+    @patch('s3_deploy.deploy.invalidate_paths')
+    def test_merge_shards_defer_deletion(self, mock_invalidate):
+        conf = {
+            's3_bucket': self.bucket.name,
+            'site': '_site',
+            'defer_deletion': True,
+        }
+        results = [
+            deploy.deploy(conf, self.tmp_dir, False, False, shard=(i, 2))
+            for i in range(2)
+        ]
+        deploy.merge_shards(conf, results, False)
+
+        keys = [obj.key for obj in self.bucket.objects.all()]
+        self.assertIn('deleted_file.txt', keys)
+
+        conf['orphan_grace_period'] = 0
+        deploy.merge_shards(conf, results, False)
+
+        keys = [obj.key for obj in self.bucket.objects.all()]
+        self.assertNotIn('deleted_file.txt', keys)
+
+    @patch('s3_deploy.deploy.invalidate_paths')
+    def test_deploy_sites(self, mock_invalidate):
+        other_bucket = self.s3.Bucket('other_bucket')
+        other_bucket.create()
+
+        deploy.deploy_sites(deploy.config.expand_targets({
+            'site': '_site',
+            'targets': [
+                {'s3_bucket': self.bucket.name},
+                {'s3_bucket': other_bucket.name,
+                 'cloudfront_distribution_id': 'ABCDEFGHI'},
+            ],
+        }), self.tmp_dir, False, False, concurrency=2)
+
+        expected_keys = ['new_file.txt', 'unchanged_file.txt',
+                         'updated_file.txt']
+        for bucket in (self.bucket, other_bucket):
+            self.assertEqual(
+                sorted(obj.key for obj in bucket.objects.all()),
+                expected_keys)
+        mock_invalidate.assert_called_once_with('ABCDEFGHI', ['/*'], False)
+
+    def test_check_after_deploy_sites(self):
+        other_bucket = self.s3.Bucket('other_bucket')
+        other_bucket.create()
+
+        targets = deploy.config.expand_targets({
+            'site': '_site',
+            'manifest': 'manifest.json',
+            'targets': [
+                {'s3_bucket': self.bucket.name},
+                {'s3_bucket': other_bucket.name},
+            ],
+        })
+        deploy.deploy_sites(targets, self.tmp_dir, False, False)
+
+        for target in targets:
+            self.assertEqual(deploy.check(target, self.tmp_dir), [])
+
+    @patch('s3_deploy.deploy.invalidate_paths')
+    @patch('s3_deploy.deploy.upload_key')
+    def test_deploy_sites_failure(self, mock_upload, mock_invalidate):
+        def upload(client, bucket_name, *args, **kwargs):
+            if bucket_name == 'missing_bucket':
+                raise RuntimeError('upload failed')
+        mock_upload.side_effect = upload
+
+        with self.assertRaises(RuntimeError):
+            deploy.deploy_sites([
+                {'site': '_site', 's3_bucket': 'missing_bucket'},
+                {'site': '_site', 's3_bucket': self.bucket.name},
+            ], self.tmp_dir, False, False)
+
+        # The other site is still deployed
+        self.assertEqual(
+            sorted(c[0][2] for c in mock_upload.call_args_list
+                   if c[0][1] == self.bucket.name),
+            ['new_file.txt', 'updated_file.txt'])
+
 
 class InvalidatePathsTest(unittest.TestCase):
     @patch('boto3.client')
@@ -215,4 +1222,132 @@ class MainTest(unittest.TestCase):
 
         mock_load_config.assert_called_once_with(fake_path)
         mock_deploy.assert_called_once_with(
-            mocked_config_dict, fake_path, False, False)
+            mocked_config_dict, fake_path, False, False, concurrency=None,
+            prefix='')
+
+    @patch('s3_deploy.config.load_config_file')
+    @patch('s3_deploy.aio.run_deploy')
+    def test_main_async(self, mock_run_deploy, mock_load_config):
+        fake_path = os.path.join('path', 'to', 'website')
+        mocked_config_dict = {}
+        mock_load_config.return_value = mocked_config_dict, fake_path
+        deploy.main(['--async', '-j', '50', fake_path])
+
+        mock_run_deploy.assert_called_once_with(
+            mocked_config_dict, fake_path, False, False, concurrency=50,
+            prefix='')
+
+    @patch('s3_deploy.config.load_config_file')
+    @patch('s3_deploy.shard.write_result')
+    @patch('s3_deploy.deploy.deploy')
+    def test_main_shard(self, mock_deploy, mock_write, mock_load_config):
+        fake_path = os.path.join('path', 'to', 'website')
+        mocked_config_dict = {}
+        mock_load_config.return_value = mocked_config_dict, fake_path
+        deploy.main(['--shard', '1/4', '--shard-output', 'out.json',
+                     fake_path])
+
+        mock_deploy.assert_called_once_with(
+            mocked_config_dict, fake_path, False, False, shard=(1, 4))
+        mock_write.assert_called_once_with(
+            'out.json', mock_deploy.return_value)
+
+    @patch('s3_deploy.config.load_config_file')
+    @patch('s3_deploy.shard.load_result')
+    @patch('s3_deploy.deploy.merge_shards')
+    def test_main_merge_shards(self, mock_merge, mock_load_result,
+                               mock_load_config):
+        fake_path = os.path.join('path', 'to', 'website')
+        mocked_config_dict = {}
+        mock_load_config.return_value = mocked_config_dict, fake_path
+        mock_load_result.side_effect = lambda path: path
+        deploy.main(['--merge-shard', 'a.json', '--merge-shard', 'b.json',
+                     fake_path])
+
+        mock_merge.assert_called_once_with(
+            mocked_config_dict, ['a.json', 'b.json'], False)
+
+    @patch('s3_deploy.config.load_config_file')
+    @patch('s3_deploy.deploy.deploy_sites')
+    def test_main_targets(self, mock_deploy_sites, mock_load_config):
+        fake_path = os.path.join('path', 'to', 'website')
+        mocked_config_dict = {'site': '_site', 'targets': [
+            {'s3_bucket': 'a'}, {'s3_bucket': 'b'}]}
+        mock_load_config.return_value = mocked_config_dict, fake_path
+        deploy.main([fake_path])
+
+        mock_deploy_sites.assert_called_once_with([
+            {'site': '_site', 's3_bucket': 'a'},
+            {'site': '_site', 's3_bucket': 'b'},
+        ], fake_path, False, False, concurrency=None, prefix='')
+
+    @patch('s3_deploy.config.load_config_file')
+    @patch('s3_deploy.deploy.check')
+    def test_main_check(self, mock_check, mock_load_config):
+        fake_path = os.path.join('path', 'to', 'website')
+        mocked_config_dict = {}
+        mock_load_config.return_value = mocked_config_dict, fake_path
+
+        mock_check.return_value = ['index.html']
+        self.assertEqual(deploy.main(['--check', fake_path]), 1)
+        mock_check.assert_called_once_with(mocked_config_dict, fake_path)
+
+        mock_check.return_value = []
+        self.assertEqual(deploy.main(['--check', fake_path]), 0)
+
+    @patch('s3_deploy.config.load_config_file')
+    @patch('s3_deploy.deploy.deploy')
+    def test_main_trace(self, mock_deploy, mock_load_config):
+        def fake_deploy(*args, **kwargs):
+            with tracing.span('upload', 'index.html'):
+                pass
+        mock_deploy.side_effect = fake_deploy
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            trace_path = os.path.join(tmp_dir, 'trace.json')
+            mock_load_config.return_value = {}, tmp_dir
+            deploy.main(['--trace', trace_path, tmp_dir])
+
+            with open(trace_path, 'r') as f:
+                events = json.load(f)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertIn('index.html', [e['name'] for e in events])
+        self.assertIsNone(tracing._tracer)
+
+    @patch('s3_deploy.config.load_config_file')
+    @patch('s3_deploy.deploy.deploy')
+    @patch('pstats.Stats')
+    def test_main_profile(self, mock_stats, mock_deploy, mock_load_config):
+        fake_path = os.path.join('path', 'to', 'website')
+        mock_load_config.return_value = {}, fake_path
+        deploy.main(['--profile', fake_path])
+
+        mock_deploy.assert_called_once_with(
+            {}, fake_path, False, False, concurrency=None, prefix='')
+        mock_stats.return_value.sort_stats.assert_called_once_with(
+            'tottime')
+
+    def test_main_check_does_not_import_boto3(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(tmp_dir, '_site'))
+            with open(os.path.join(tmp_dir, '.s3_website.yaml'), 'w') as f:
+                f.write('site: _site\ns3_bucket: test\nmanifest: m.json\n')
+
+            script = '\n'.join([
+                'import sys',
+                'from s3_deploy import deploy',
+                'status = deploy.main(["--check", sys.argv[1]])',
+                'assert "boto3" not in sys.modules',
+                'sys.exit(status)',
+            ])
+            root = os.path.dirname(os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))))
+            status = subprocess.call(
+                [sys.executable, '-c', script, tmp_dir], cwd=root)
+            self.assertEqual(status, 0)
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -1,4 +1,6 @@
 
+import random
+import re
 import unittest
 
 from s3_deploy import filematch
@@ -104,3 +106,67 @@ class FileMatchTest(unittest.TestCase):
     def test_match_regex_caret_and_dollar_fail(self):
         self.assertFalse(filematch.match_key(
             r'^dir\/index\.html$', 'dir/index.htm', regexp=True))
+
+
+class LiteralAffixesTest(unittest.TestCase):
+    def affixes(self, pattern):
+        return filematch.literal_affixes(re.compile(pattern))
+
+    def test_glob(self):
+        self.assertEqual(
+            self.affixes(filematch.compile_re('*.html')), ('', '.html'))
+        self.assertEqual(
+            self.affixes(filematch.compile_re('/static/*')), ('static/', ''))
+
+    def test_regexp(self):
+        self.assertEqual(
+            self.affixes(r'^dir/[0-9]+\.png$'), ('dir/', '.png'))
+
+    def test_quantified_literal(self):
+        self.assertEqual(self.affixes(r'^ab*c+$'), ('a', ''))
+
+    def test_alternation(self):
+        self.assertEqual(self.affixes(r'^a|b$'), ('', ''))
+
+    def test_ignore_case(self):
+        self.assertEqual(self.affixes(r'(?i)\.html$'), ('', ''))
+
+
+class PatternSetTest(unittest.TestCase):
+    PATTERNS = [
+        filematch.compile_re('*.html'),
+        filematch.compile_re('/static/*'),
+        r'\.(js|css)$',
+        r'(?i)\.PNG$',
+        filematch.compile_re('/static/app.js'),
+        r'(a)\1',
+        filematch.compile_re('index.*'),
+    ]
+
+    def test_first_match(self):
+        patterns = filematch.PatternSet(self.PATTERNS)
+        self.assertEqual(patterns.match('dir/index.html'), 0)
+        self.assertEqual(patterns.match('static/app.js'), 1)
+        self.assertEqual(patterns.match('app.js'), 2)
+        self.assertEqual(patterns.match('logo.png'), 3)
+        self.assertEqual(patterns.match('aa'), 5)
+        self.assertEqual(patterns.match('index.txt'), 6)
+        self.assertIsNone(patterns.match('README'))
+
+    def test_same_as_match_key(self):
+        rnd = random.Random(0)
+        parts = ['static', 'index', 'app', 'a', 'dir', '.html', '.js',
+                 '.PNG', '.png', '.txt', '/', '.css']
+        keys = [''.join(rnd.choice(parts) for _ in range(rnd.randint(1, 6)))
+                for _ in range(2000)]
+        patterns = filematch.PatternSet(self.PATTERNS)
+
+        expected = []
+        for key_name in keys:
+            for i, pattern in enumerate(self.PATTERNS):
+                if filematch.match_key(pattern, key_name, regexp=True):
+                    expected.append(i)
+                    break
+            else:
+                expected.append(None)
+        self.assertEqual(list(patterns.classify(keys)), expected)
@@ -0,0 +1,114 @@
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from s3_deploy import hashing
+
+
+class FileDigestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_single_part(self):
+        data = b'contents\n' * 1000
+        digest = hashing.file_digest(self.write('a.bin', data))
+        self.assertEqual(digest, hashing.Digest(
+            hashlib.md5(data).hexdigest(), None))
+
+    def test_empty_file(self):
+        digest = hashing.file_digest(self.write('empty.bin', b''))
+        self.assertEqual(digest.md5, hashlib.md5(b'').hexdigest())
+        self.assertIsNone(digest.multipart_etag)
+
+    def test_multipart_etag(self):
+        data = os.urandom(2500)
+        path = self.write('a.bin', data)
+        with patch('s3_deploy.hashing.READ_BUFFER_SIZE', 700):
+            digest = hashing.file_digest(path, part_size=1000)
+
+        parts = [data[:1000], data[1000:2000], data[2000:]]
+        expected = hashlib.md5(b''.join(
+            hashlib.md5(part).digest() for part in parts)).hexdigest()
+        self.assertEqual(digest.md5, hashlib.md5(data).hexdigest())
+        self.assertEqual(digest.multipart_etag, expected + '-3')
+
+    def test_etag_matches(self):
+        digest = hashing.Digest('0123abcd', '4567cdef-3')
+        self.assertTrue(hashing.etag_matches(digest, '"0123ABCD"'))
+        self.assertTrue(hashing.etag_matches(digest, '"4567cdef-3"'))
+        self.assertFalse(hashing.etag_matches(digest, '"4567cdef-2"'))
+        self.assertFalse(hashing.etag_matches(digest, None))
+
+
+class HasherTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'video.mp4')
+        with open(self.path, 'wb') as f:
+            f.write(b'video\n')
+        self.cache_path = os.path.join(self.tmp_dir, 'hashes.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_submit(self):
+        with hashing.Hasher(workers=2) as hasher:
+            futures = [hasher.submit(self.path) for _ in range(4)]
+            digests = [future.result() for future in futures]
+        self.assertEqual(
+            set(digest.md5 for digest in digests),
+            set([hashlib.md5(b'video\n').hexdigest()]))
+
+    def test_cache(self):
+        with hashing.Hasher(cache=hashing.DigestCache(self.cache_path)) as h:
+            expected = h.digest(self.path)
+
+        with patch('s3_deploy.hashing.file_digest') as mock_digest:
+            with hashing.Hasher(
+                    cache=hashing.DigestCache(self.cache_path)) as hasher:
+                self.assertEqual(hasher.digest(self.path), expected)
+        mock_digest.assert_not_called()
+
+    def test_caches_share_file(self):
+        first = hashing.DigestCache(self.cache_path)
+        second = hashing.DigestCache(self.cache_path)
+        try:
+            st = os.stat(self.path)
+            digest = hashing.file_digest(self.path)
+            first.put(st, hashing.DEFAULT_PART_SIZE, digest)
+            self.assertEqual(
+                second.get(st, hashing.DEFAULT_PART_SIZE), digest)
+
+            other = hashing.file_digest(self.path, part_size=4)
+            second.put(st, 4, other)
+            self.assertEqual(first.get(st, 4), other)
+        finally:
+            first.close()
+            second.close()
+
+    def test_cache_modified_file(self):
+        with hashing.Hasher(cache=hashing.DigestCache(self.cache_path)) as h:
+            h.digest(self.path)
+
+        with open(self.path, 'wb') as f:
+            f.write(b'other\n')
+        st = os.stat(self.path)
+        os.utime(self.path, (st.st_atime, st.st_mtime + 10))
+
+        with hashing.Hasher(cache=hashing.DigestCache(self.cache_path)) as h:
+            self.assertEqual(h.digest(self.path).md5,
+                             hashlib.md5(b'other\n').hexdigest())
@@ -0,0 +1,91 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from s3_deploy import history
+from s3_deploy import stats
+
+
+def _record(bucket='bucket', duration=10.0, bytes_uploaded=1000, dry=False,
+            status='ok', started=0):
+    return dict(
+        started=started, bucket=bucket, dry=dry, status=status,
+        duration=duration, keys_changed=1, bytes_uploaded=bytes_uploaded,
+        invalidation_paths=0)
+
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'history.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_append_and_load(self):
+        deploy_stats = stats.DeployStats()
+        deploy_stats.record(stats.PUT, size=300)
+        deploy_stats.record_action('update')
+        deploy_stats.record_action('update')
+        deploy_stats.record_action('skip')
+        deploy_stats.record_phase('sync', 1.5)
+        history.append(self.path, history.make_record(
+            'first', 1000.0, 2.5, deploy_stats))
+        history.append(self.path, history.make_record(
+            'second', 2000.0, 1.0, stats.DeployStats(), dry=True,
+            status='failed'))
+
+        records = history.load(self.path)
+        self.assertEqual([r['bucket'] for r in records], ['first', 'second'])
+        self.assertEqual(records[0]['keys_changed'], 2)
+        self.assertEqual(records[0]['bytes_uploaded'], 300)
+        self.assertEqual(records[0]['duration'], 2.5)
+        self.assertEqual(records[0]['phases'], {'sync': 1.5})
+        self.assertEqual(records[0]['actions'], {'update': 2, 'skip': 1})
+        self.assertFalse(records[0]['dry'])
+        self.assertTrue(records[1]['dry'])
+        self.assertEqual(records[1]['status'], 'failed')
+
+        self.assertEqual(
+            [r['bucket'] for r in history.load(self.path, limit=1)],
+            ['second'])
+        self.assertEqual(
+            [r['bucket'] for r in history.load(self.path, 'first')],
+            ['first'])
+
+    def test_find_regressions(self):
+        records = [_record(duration=d) for d in (10.0, 12.0, 11.0)]
+        records.append(_record(duration=100.0, dry=True))
+        records.append(_record(duration=100.0, status='failed'))
+        records.append(_record(bucket='other', duration=100.0))
+        records.append(_record(duration=20.0, bytes_uploaded=1400))
+
+        regressions = history.find_regressions(records)
+        self.assertEqual(len(regressions), 1)
+        record, metric, value, baseline = regressions[0]
+        self.assertIs(record, records[-1])
+        self.assertEqual((metric, value, baseline), ('duration', 20.0, 11.0))
+
+    def test_find_regressions_window(self):
+        records = [_record(duration=d) for d in (100.0, 100.0, 10.0, 10.0)]
+        records.append(_record(duration=40.0))
+        self.assertEqual(history.find_regressions(records, window=4), [])
+        self.assertEqual(
+            len(history.find_regressions(records, window=2)), 1)
+
+    def test_report(self):
+        self.assertEqual(history.report([]), ['No deploys recorded.'])
+
+        records = [_record(duration=d) for d in (10.0, 10.0, 10.0, 30.0)]
+        lines = history.report(records)
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[0].startswith('Started'))
+        self.assertIn('Regression: duration of bucket', lines[-1])
+        self.assertIn('3.0x', lines[-1])
+
+        lines = history.report(records[:3] + [_record(dry=True)], limit=2)
+        self.assertEqual(len(lines), 4)
+        self.assertIn('(dry run)', lines[2])
+        self.assertTrue(lines[-1].startswith('No regressions'))
@@ -0,0 +1,40 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from s3_deploy.keystore import SortedKeyStore
+
+
+class SortedKeyStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def fill(self, store):
+        for i in reversed(range(100)):
+            store.add('key{:03d}'.format(i), i % 3 != 0)
+        store.add('key001', False)
+        store.add('key003', True)
+
+    def expected(self):
+        return [('key{:03d}'.format(i), i % 3 != 0 and i != 1)
+                for i in range(100)]
+
+    def test_in_memory(self):
+        with SortedKeyStore(directory=self.tmp_dir) as store:
+            self.fill(store)
+            self.assertEqual(list(store), self.expected())
+            self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_spilled(self):
+        store = SortedKeyStore(memory_limit=1000, directory=self.tmp_dir)
+        self.fill(store)
+        self.assertEqual(len(os.listdir(self.tmp_dir)), 1)
+        self.assertEqual(list(store), self.expected())
+
+        store.close()
+        self.assertEqual(os.listdir(self.tmp_dir), [])
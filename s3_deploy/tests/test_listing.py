@@ -0,0 +1,99 @@
+
+import unittest
+
+import boto3
+import mock
+from moto import mock_s3
+
+from s3_deploy import listing
+
+
+@mock_s3
+class ListObjectsTest(unittest.TestCase):
+    def setUp(self):
+        self.client = boto3.client('s3', region_name='us-east-1')
+        self.client.create_bucket(Bucket='test_bucket')
+
+        self.keys = [
+            'a.html',
+            'a/1.html',
+            'a/2/3.html',
+            'a0.txt',
+            'b/1.txt',
+            'c.txt',
+            'd/e/f.txt',
+            'z',
+        ]
+        for key_name in self.keys:
+            self.client.put_object(
+                Bucket='test_bucket', Key=key_name, Body=b'data')
+
+    def test_list_objects_in_order(self):
+        keys = [obj.key for obj in listing.list_objects(
+            self.client, 'test_bucket', concurrency=3)]
+        self.assertEqual(keys, sorted(self.keys))
+
+    def test_list_objects_single_worker(self):
+        keys = [obj.key for obj in listing.list_objects(
+            self.client, 'test_bucket', concurrency=1)]
+        self.assertEqual(keys, sorted(self.keys))
+
+    def test_list_objects_attributes(self):
+        obj = next(iter(listing.list_objects(self.client, 'test_bucket')))
+        self.assertEqual(obj.key, 'a.html')
+        self.assertEqual(obj.size, 4)
+        self.assertEqual(obj.storage_class, 'STANDARD')
+        self.assertIsNotNone(obj.last_modified.tzinfo)
+
+    def test_list_objects_prefix(self):
+        keys = [obj.key for obj in listing.list_objects(
+            self.client, 'test_bucket', prefix='a/')]
+        self.assertEqual(keys, ['a/1.html', 'a/2/3.html'])
+
+    def test_list_objects_paginated(self):
+        for i in range(30):
+            self.client.put_object(
+                Bucket='test_bucket', Key='p/{:02d}'.format(i), Body=b'')
+
+        original = self.client.list_objects_v2
+
+        def list_small_pages(**kwargs):
+            kwargs['MaxKeys'] = 7
+            return original(**kwargs)
+
+        with mock.patch.object(
+                self.client, 'list_objects_v2', side_effect=list_small_pages):
+            keys = [obj.key for obj in listing.list_objects(
+                self.client, 'test_bucket', concurrency=2)]
+
+        self.assertEqual(len(keys), len(self.keys) + 30)
+        self.assertEqual(keys, sorted(keys))
+
+    def test_list_objects_stop_early(self):
+        objects = listing.list_objects(self.client, 'test_bucket')
+        self.assertEqual(next(objects).key, 'a.html')
+        objects.close()
+
+    def test_list_objects_error(self):
+        objects = listing.list_objects(self.client, 'missing_bucket')
+        with self.assertRaises(Exception):
+            list(objects)
+
+    def test_list_objects_partition_error(self):
+        original = self.client.list_objects_v2
+
+        def fail_partition(**kwargs):
+            if kwargs['Prefix'] == 'b/':
+                raise RuntimeError('listing failed')
+            return original(**kwargs)
+
+        with mock.patch.object(
+                self.client, 'list_objects_v2', side_effect=fail_partition):
+            objects = listing.list_objects(self.client, 'test_bucket')
+            with self.assertRaises(RuntimeError):
+                list(objects)
+
+    def test_invalid_concurrency(self):
+        with self.assertRaises(ValueError):
+            list(listing.list_objects(
+                self.client, 'test_bucket', concurrency=0))
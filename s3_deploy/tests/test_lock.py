@@ -0,0 +1,133 @@
+
+import json
+import time
+import unittest
+
+from s3_deploy import lock
+from s3_deploy.listing import RemoteObject
+from s3_deploy.storage import MemoryStorage
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.on_sleep = None
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        if self.on_sleep is not None:
+            self.on_sleep()
+
+
+class DeployLockTest(unittest.TestCase):
+    def setUp(self):
+        self.client = MemoryStorage()
+        self.clock = FakeClock()
+
+    def create_lock(self, **kwargs):
+        return lock.DeployLock(
+            self.client, 'bucket', clock=self.clock, sleep=self.clock.sleep,
+            **kwargs)
+
+    def put_lock(self, owner, expires):
+        self.client.put(lock.LOCK_KEY, json.dumps(dict(
+            version=lock.LOCK_VERSION, owner=owner,
+            expires=expires)).encode('utf-8'), {})
+
+    def lock_owner(self):
+        result = self.client.get(lock.LOCK_KEY)
+        if result is None:
+            return None
+        return json.loads(result[0].decode('utf-8'))['owner']
+
+    def test_acquire_and_release(self):
+        deploy_lock = self.create_lock()
+        with deploy_lock:
+            self.assertEqual(self.lock_owner(), deploy_lock.owner)
+        self.assertIsNone(self.lock_owner())
+
+    def test_held_lock_times_out(self):
+        self.put_lock('other', self.clock.now + 3600)
+        with self.assertRaises(RuntimeError):
+            self.create_lock(timeout=30).acquire()
+        self.assertEqual(self.lock_owner(), 'other')
+
+    def test_expired_lock_is_taken_over(self):
+        self.put_lock('other', self.clock.now - 1)
+        deploy_lock = self.create_lock()
+        deploy_lock.acquire()
+        self.assertEqual(self.lock_owner(), deploy_lock.owner)
+        deploy_lock.release()
+
+    def test_waits_for_release(self):
+        def release_other():
+            if self.lock_owner() == 'other':
+                self.client.delete_batch([lock.LOCK_KEY])
+        self.put_lock('other', self.clock.now + 3600)
+        self.clock.on_sleep = release_other
+        deploy_lock = self.create_lock()
+        deploy_lock.acquire()
+        self.assertEqual(self.lock_owner(), deploy_lock.owner)
+        deploy_lock.release()
+
+    def test_concurrent_writer_wins(self):
+        def overwrite():
+            if self.lock_owner() != 'other':
+                self.put_lock('other', self.clock.now + 3600)
+        self.clock.on_sleep = overwrite
+        with self.assertRaises(RuntimeError):
+            self.create_lock(timeout=10).acquire()
+        self.assertEqual(self.lock_owner(), 'other')
+
+    def test_competing_lock_released_while_settling(self):
+        def take_and_release():
+            self.clock.on_sleep = None
+            self.put_lock('other', self.clock.now + 3600)
+            self.client.delete_batch([lock.LOCK_KEY])
+        self.clock.on_sleep = take_and_release
+        deploy_lock = self.create_lock(timeout=10)
+        deploy_lock.acquire()
+        self.assertEqual(self.lock_owner(), deploy_lock.owner)
+        deploy_lock.release()
+
+    def test_contended_lock_times_out(self):
+        def release():
+            self.client.delete_batch([lock.LOCK_KEY])
+        self.clock.on_sleep = release
+        with self.assertRaises(RuntimeError):
+            self.create_lock(timeout=10).acquire()
+
+    def test_release_keeps_lock_taken_over(self):
+        deploy_lock = self.create_lock()
+        deploy_lock.acquire()
+        self.put_lock('other', self.clock.now + 3600)
+        deploy_lock.release()
+        self.assertEqual(self.lock_owner(), 'other')
+
+    def test_refresh_detects_lost_lock(self):
+        deploy_lock = self.create_lock(ttl=0.03, settle_time=0)
+        deploy_lock.acquire()
+        self.put_lock('other', self.clock.now + 3600)
+        for _ in range(200):
+            if deploy_lock.lost:
+                break
+            time.sleep(0.01)
+
+        # The lock of the other deploy is not overwritten
+        self.assertTrue(deploy_lock.lost)
+        self.assertEqual(self.lock_owner(), 'other')
+        with self.assertRaises(RuntimeError):
+            deploy_lock.check()
+        deploy_lock.release()
+        self.assertEqual(self.lock_owner(), 'other')
+
+
+class ExcludeLockTest(unittest.TestCase):
+    def test_exclude_lock(self):
+        objects = [RemoteObject(key_name, None, 'STANDARD', 0, None)
+                   for key_name in ['a', lock.LOCK_KEY, 'b']]
+        self.assertEqual(
+            [obj.key for obj in lock.exclude_lock(objects)], ['a', 'b'])
@@ -0,0 +1,84 @@
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from s3_deploy import manifest
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.manifest_path = os.path.join(self.tmp_dir, 'manifest.json')
+        self.files = []
+        for name in ['a.html', 'b.css']:
+            path = os.path.join(self.tmp_dir, name)
+            with open(path, 'w') as f:
+                f.write('contents\n')
+            self.files.append((name, path))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def save(self, bucket_name='bucket'):
+        builder = manifest.ManifestBuilder(bucket_name)
+        for key_name, path in self.files:
+            builder.add(key_name, path)
+        builder.save(self.manifest_path)
+
+    def test_unchanged(self):
+        self.save()
+        files = manifest.load_manifest(self.manifest_path, 'bucket')
+        self.assertEqual(list(manifest.changed_keys(files, self.files)), [])
+
+    def test_modified(self):
+        self.save()
+        path = self.files[1][1]
+        future = time.time() + 100
+        os.utime(path, (future, future))
+
+        files = manifest.load_manifest(self.manifest_path, 'bucket')
+        self.assertEqual(
+            list(manifest.changed_keys(files, self.files)), ['b.css'])
+
+    def test_added_and_removed(self):
+        self.save()
+        files = manifest.load_manifest(self.manifest_path, 'bucket')
+        site_files = [self.files[1], ('c.js', self.files[0][1])]
+        self.assertEqual(
+            list(manifest.changed_keys(files, site_files)),
+            ['c.js', 'a.html'])
+
+    def test_sidecar_modified(self):
+        sidecar = self.files[0][1] + '.gz'
+        with open(sidecar, 'wb') as f:
+            f.write(b'compressed')
+        builder = manifest.ManifestBuilder('bucket', precompressed=['gzip'])
+        for key_name, path in self.files:
+            builder.add(key_name, path)
+        builder.save(self.manifest_path)
+
+        files = manifest.load_manifest(self.manifest_path, 'bucket')
+        self.assertEqual(list(manifest.changed_keys(
+            files, self.files, precompressed=['gzip'])), [])
+        with open(sidecar, 'ab') as f:
+            f.write(b' again')
+        self.assertEqual(list(manifest.changed_keys(
+            files, self.files, precompressed=['gzip'])), ['a.html'])
+
+    def test_other_bucket(self):
+        self.save()
+        self.assertIsNone(manifest.load_manifest(self.manifest_path, 'other'))
+
+    def test_missing(self):
+        self.assertIsNone(manifest.load_manifest(self.manifest_path, 'b'))
+
+    def test_replace(self):
+        self.save()
+        self.files.pop()
+        self.save()
+        files = manifest.load_manifest(self.manifest_path, 'bucket')
+        self.assertEqual(list(files), ['a.html'])
+        self.assertFalse(os.path.exists(self.manifest_path + '.tmp'))
@@ -0,0 +1,114 @@
+
+import json
+import unittest
+
+import boto3
+from moto import mock_s3
+
+from s3_deploy import orphans
+from s3_deploy.listing import RemoteObject
+
+
+class OrphanLedgerTest(unittest.TestCase):
+    def test_record_keeps_first_time(self):
+        ledger = orphans.OrphanLedger()
+        ledger.record('a.js', 100)
+        ledger.record('a.js', 200)
+        self.assertTrue(ledger.changed)
+        self.assertEqual(ledger.expired(50, 150), ['a.js'])
+        self.assertEqual(ledger.expired(60, 150), [])
+
+    def test_discard(self):
+        ledger = orphans.OrphanLedger({'a.js': 100})
+        ledger.discard('b.js')
+        self.assertFalse(ledger.changed)
+        ledger.discard('a.js')
+        self.assertTrue(ledger.changed)
+        self.assertNotIn('a.js', ledger)
+
+    def test_exclude_ledger(self):
+        objects = [RemoteObject(key, None, 'STANDARD', 0, None)
+                   for key in ['.s3-deploy-orphans.json', 'a.js']]
+        self.assertEqual(
+            [obj.key for obj in orphans.exclude_ledger(objects)], ['a.js'])
+
+
+class DeferredDeletionTest(unittest.TestCase):
+    def test_postpone(self):
+        ledger = orphans.OrphanLedger({'old.js': 100})
+        deletion = orphans.DeferredDeletion(
+            ledger, lambda key_name: key_name.endswith('.js'), 500, now=1000)
+
+        self.assertTrue(deletion.manages('a.js'))
+        self.assertFalse(deletion.manages('a.html'))
+        self.assertTrue(deletion.postpone('a.js'))
+        self.assertFalse(deletion.postpone('old.js'))
+        self.assertIn('a.js', ledger)
+
+        deletion.keep('a.js')
+        self.assertNotIn('a.js', ledger)
+
+
+@mock_s3
+class OrphanLedgerStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.client = boto3.client('s3', region_name='us-east-1')
+        self.client.create_bucket(Bucket='test_bucket')
+
+    def keys(self):
+        response = self.client.list_objects_v2(Bucket='test_bucket')
+        return [item['Key'] for item in response.get('Contents', [])]
+
+    def test_load_missing(self):
+        ledger = orphans.OrphanLedger.load(self.client, 'test_bucket')
+        self.assertEqual(len(ledger), 0)
+
+    def test_save_and_load(self):
+        ledger = orphans.OrphanLedger()
+        ledger.record('a.js', 100)
+        ledger.save(self.client, 'test_bucket')
+        self.assertFalse(ledger.changed)
+
+        ledger = orphans.OrphanLedger.load(self.client, 'test_bucket')
+        self.assertIn('a.js', ledger)
+
+    def test_load_unsupported_version(self):
+        self.client.put_object(
+            Bucket='test_bucket', Key=orphans.LEDGER_KEY,
+            Body=json.dumps({'version': 99, 'orphans': {}}))
+        with self.assertRaises(ValueError):
+            orphans.OrphanLedger.load(self.client, 'test_bucket')
+
+    def test_collect(self):
+        for key in ['a.js', 'b.js']:
+            self.client.put_object(Bucket='test_bucket', Key=key, Body=b'x')
+        ledger = orphans.OrphanLedger({'a.js': 100, 'b.js': 900})
+
+        deleted = orphans.collect(
+            self.client, 'test_bucket', ledger, 500, False, now=1000)
+
+        self.assertEqual(deleted, ['a.js'])
+        self.assertEqual(self.keys(), [orphans.LEDGER_KEY, 'b.js'])
+        ledger = orphans.OrphanLedger.load(self.client, 'test_bucket')
+        self.assertEqual(ledger.expired(0, 1000), ['b.js'])
+
+    def test_collect_prefix(self):
+        for key in ['a.js', 'docs/b.js']:
+            self.client.put_object(Bucket='test_bucket', Key=key, Body=b'x')
+        ledger = orphans.OrphanLedger({'a.js': 100, 'docs/b.js': 100})
+
+        deleted = orphans.collect(
+            self.client, 'test_bucket', ledger, 500, False, now=1000,
+            prefix='docs/')
+
+        self.assertEqual(deleted, ['docs/b.js'])
+        self.assertEqual(ledger.expired(0, 1000), ['a.js'])
+
+    def test_collect_dry(self):
+        self.client.put_object(Bucket='test_bucket', Key='a.js', Body=b'x')
+        ledger = orphans.OrphanLedger({'a.js': 100})
+
+        orphans.collect(
+            self.client, 'test_bucket', ledger, 500, True, now=1000)
+
+        self.assertEqual(self.keys(), ['a.js'])
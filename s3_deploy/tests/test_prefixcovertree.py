@@ -1,7 +1,13 @@
 
+import gc
+import os
+import random
+import timeit
 import unittest
 
-from s3_deploy.prefixcovertree import PrefixCoverTree
+from mock import patch
+
+from s3_deploy.prefixcovertree import PrefixCoverTree, _Node, cover_sorted
 
 
 class PrefixCoverTreeTest(unittest.TestCase):
@@ -113,3 +119,176 @@ class PrefixCoverTreeTest(unittest.TestCase):
         self.assertEqual(matches, {
             ('', False)
         })
+
+
+class CoverSortedTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(list(cover_sorted([])), [])
+
+    def test_single(self):
+        self.assertEqual(list(cover_sorted([('/index.html', True)])), [
+            ('', False)])
+
+    def test_cover(self):
+        rows = sorted([
+            ('/index.html', True),
+            ('/assets/favicon.ico', False),
+            ('/assets/image1.png', False),
+            ('/assets/image2.png', True),
+            ('/content/page1.html', True),
+            ('/content/page2.html', True),
+            ('/css/main.css', True),
+        ])
+        self.assertEqual(list(cover_sorted(rows)), [
+            ('/assets/image2.png', True),
+            ('/c', False),
+            ('/index.html', True),
+        ])
+
+    def test_repeated_key_excluded(self):
+        rows = [('/a', True), ('/a', False), ('/b', True)]
+        self.assertEqual(list(cover_sorted(rows)), [('/b', True)])
+
+    def test_prefix_of_excluded_key(self):
+        rows = [('/docs/', True), ('/docs/a', False), ('/docs/b', True)]
+        self.assertEqual(list(cover_sorted(rows)), [
+            ('/docs/', True), ('/docs/b', True)])
+
+    def test_matches_tree(self):
+        rng = random.Random(0)
+        for _ in range(2000):
+            rows = []
+            for _ in range(rng.randint(0, 12)):
+                key = ''.join(rng.choice('ab/')
+                              for _ in range(rng.randint(1, 5)))
+                rows.append((key, rng.random() < 0.7))
+                if rng.random() < 0.2:
+                    # Exclude a key that was just included
+                    rows.append((key, False))
+
+            # The tree gives the same matches in any insertion order
+            if rng.random() < 0.5:
+                rng.shuffle(rows)
+            t = PrefixCoverTree()
+            for key, flag in rows:
+                if flag:
+                    try:
+                        t.include(key)
+                    except ValueError:
+                        pass
+                else:
+                    t.exclude(key)
+
+            self.assertEqual(
+                list(cover_sorted(sorted(rows, key=lambda row: row[0]))),
+                list(t.matches()))
+            self.assertEqual(list(t), sorted(set(key for key, _ in rows)))
+
+    def test_exclude_included_prefix_key(self):
+        t = PrefixCoverTree()
+        t.include('ab')
+        t.include('a')
+        t.exclude('a')
+        self.assertEqual(list(t), ['a', 'ab'])
+        self.assertEqual(list(t.matches()), [('ab', True)])
+        self.assertRaises(ValueError, t.include, 'a')
+
+    def test_prefix_of_excluded_key_in_tree(self):
+        t = PrefixCoverTree()
+        t.include('/docs/')
+        t.exclude('/docs/a')
+        t.include('/docs/b')
+        self.assertEqual(
+            list(t.matches()), [('/docs/', True), ('/docs/b', True)])
+
+
+class PrefixCoverTreeScalingTest(unittest.TestCase):
+    def keys(self, count):
+        # Sections of pages with assets, like a large generated site
+        for i in range(count):
+            yield 'section-{}/page-{}/{}'.format(
+                i // 1000, i // 10 % 100,
+                'index.html' if i % 10 == 0 else 'image-{}.png'.format(i))
+
+    def build(self, count):
+        t = PrefixCoverTree()
+        for i, key in enumerate(self.keys(count)):
+            if i % 7 == 0 and i < count // 2:
+                t.exclude(key)
+            else:
+                t.include(key)
+        return t
+
+    def count_expanded(self, iterable):
+        """Return the number of nodes whose children were visited."""
+        expanded = []
+        original = _Node.reversed_children
+
+        def reversed_children(node):
+            expanded.append(node)
+            return original(node)
+
+        # Keys are never rebuilt from the chain of parents
+        with patch.object(_Node, 'reversed_children', reversed_children), \
+                patch.object(_Node, '__str__', side_effect=AssertionError):
+            for _ in iterable():
+                pass
+        self.assertEqual(len(expanded), len(set(map(id, expanded))))
+        return len(expanded)
+
+    def test_traversal_visits_each_node_once(self):
+        t = self.build(10000)
+        nodes = [node for node, key in t._iter_nodes()]
+        self.assertLess(len(nodes), 2 * 10000)
+
+        self.assertEqual(self.count_expanded(t.__iter__), len(nodes))
+        # Subtrees covered by a match are not visited
+        self.assertEqual(self.count_expanded(t.matches),
+                         sum(1 for node in nodes if not node.value))
+
+    @unittest.skipUnless(os.environ.get('S3_DEPLOY_BENCHMARK'),
+                         'set S3_DEPLOY_BENCHMARK to run benchmarks')
+    def test_linear_scaling(self):
+        def time_per_key(count):
+            keys = list(self.keys(count))
+            best = None
+            for _ in range(3):
+                gc.collect()
+                gc.disable()
+                try:
+                    start = timeit.default_timer()
+                    t = PrefixCoverTree()
+                    for i, key in enumerate(keys):
+                        if i % 7 == 0:
+                            t.exclude(key)
+                        else:
+                            t.include(key)
+                    for _ in t.matches():
+                        pass
+                    for _ in t:
+                        pass
+                    elapsed = timeit.default_timer() - start
+                finally:
+                    gc.enable()
+                if best is None or elapsed < best:
+                    best = elapsed
+            return best / count
+
+        ratio = time_per_key(2000000) / time_per_key(100000)
+        # Time per key stays constant (up to noise) when the keys share
+        # deeper prefixes, instead of growing with the number of keys.
+        self.assertLess(ratio, 3.0)
+
+    def test_matches_streaming(self):
+        t = PrefixCoverTree()
+        for i, key in enumerate(self.keys(1000)):
+            if i % 7 == 0:
+                t.exclude(key)
+            else:
+                t.include(key)
+        matches = t.matches()
+        first = next(matches)
+        self.assertTrue(first[0].startswith('section-0/'))
+        self.assertEqual([first] + list(matches), list(cover_sorted(
+            sorted((key, i % 7 != 0)
+                   for i, key in enumerate(self.keys(1000))))))
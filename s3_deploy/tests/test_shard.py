@@ -0,0 +1,102 @@
+
+import unittest
+
+import mock
+
+from s3_deploy import shard
+
+
+class ParseShardTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(shard.parse_shard('2/5'), (2, 5))
+
+    def test_parse_whitespace(self):
+        self.assertEqual(shard.parse_shard(' 0 / 1 '), (0, 1))
+
+    def test_parse_index_out_of_range(self):
+        with self.assertRaises(ValueError):
+            shard.parse_shard('5/5')
+
+    def test_parse_zero_count(self):
+        with self.assertRaises(ValueError):
+            shard.parse_shard('0/0')
+
+    def test_parse_invalid(self):
+        with self.assertRaises(ValueError):
+            shard.parse_shard('1-5')
+
+
+class KeyInShardTest(unittest.TestCase):
+    def test_each_key_in_exactly_one_shard(self):
+        keys = ['dir/file{}.html'.format(i) for i in range(200)]
+        for key_name in keys:
+            shards = [i for i in range(4) if shard.key_in_shard(
+                key_name, (i, 4))]
+            self.assertEqual(len(shards), 1)
+
+    def test_stable(self):
+        self.assertEqual(
+            shard.shard_of_key('index.html', 7),
+            shard.shard_of_key('index.html', 7))
+
+    def test_distribution(self):
+        counts = [0, 0, 0, 0]
+        for i in range(4000):
+            counts[shard.shard_of_key('key{}'.format(i), 4)] += 1
+        for count in counts:
+            self.assertGreater(count, 800)
+
+
+class MergeResultsTest(unittest.TestCase):
+    def result(self, index, count, processed=(), updated=(), deleted=()):
+        return dict(shard=[index, count], processed=list(processed),
+                    updated=list(updated), deleted=list(deleted))
+
+    def test_merge(self):
+        processed, updated, deleted = shard.merge_results([
+            self.result(0, 2, processed=['a', 'b'], updated=['a']),
+            self.result(1, 2, processed=['c'], deleted=['c']),
+        ])
+        self.assertEqual(processed, {'a', 'b', 'c'})
+        self.assertEqual(updated, {'a'})
+        self.assertEqual(deleted, {'c'})
+
+    def test_merge_missing_shard(self):
+        with self.assertRaises(ValueError):
+            shard.merge_results([self.result(0, 2)])
+
+    def test_merge_duplicate_shard(self):
+        with self.assertRaises(ValueError):
+            shard.merge_results([self.result(0, 1), self.result(0, 1)])
+
+    def test_merge_inconsistent_count(self):
+        with self.assertRaises(ValueError):
+            shard.merge_results([self.result(0, 2), self.result(1, 3)])
+
+    def test_merge_empty(self):
+        with self.assertRaises(ValueError):
+            shard.merge_results([])
+
+
+class DeleteKeysTest(unittest.TestCase):
+    def test_delete_batches(self):
+        client = mock.Mock(spec=['delete_objects'])
+        client.delete_objects.return_value = {}
+        keys = ['key{:04d}'.format(i) for i in range(2500)]
+        shard.delete_keys(client, 'bucket', keys, False)
+
+        self.assertEqual(client.delete_objects.call_count, 3)
+        batch = client.delete_objects.call_args_list[2][1]
+        self.assertEqual(len(batch['Delete']['Objects']), 500)
+
+    def test_delete_dry(self):
+        client = mock.Mock(spec=['delete_objects'])
+        shard.delete_keys(client, 'bucket', ['a', 'b'], True)
+        client.delete_objects.assert_not_called()
+
+    def test_delete_errors(self):
+        client = mock.Mock(spec=['delete_objects'])
+        client.delete_objects.return_value = dict(
+            Errors=[dict(Key='a', Code='AccessDenied')])
+        with self.assertRaises(RuntimeError):
+            shard.delete_keys(client, 'bucket', ['a'], False)
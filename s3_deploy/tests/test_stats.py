@@ -0,0 +1,79 @@
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from s3_deploy import stats
+
+
+class DeployStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        stats.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_record_without_collector(self):
+        stats.record(stats.PUT, size=100)
+        self.assertFalse(stats.enabled())
+        self.assertIsNone(stats.stop())
+
+    def test_collect(self):
+        stats.start()
+        with self.assertRaises(RuntimeError):
+            stats.start()
+        stats.record(stats.PUT, size=100)
+        stats.record(stats.PUT, size=50)
+        stats.record(stats.DELETE, count=3)
+        stats.record(stats.LIST)
+        stats.record_invalidation(['/index.html', '/about/*'])
+        deploy_stats = stats.stop()
+        self.assertFalse(stats.enabled())
+
+        data = deploy_stats.as_dict()
+        self.assertEqual(data['requests'], {
+            'put': 2, 'copy': 0, 'delete': 3, 'list': 1, 'head': 0})
+        self.assertEqual(data['bytes_uploaded'], 150)
+        self.assertEqual(data['invalidation_paths'], 2)
+        self.assertAlmostEqual(
+            deploy_stats.cost(), 3 * 0.005 / 1000 + 2 * 0.005)
+
+    def test_summary_and_save(self):
+        deploy_stats = stats.DeployStats()
+        deploy_stats.record(stats.PUT, size=2048)
+        self.assertEqual(deploy_stats.summary(), [
+            'Requests: 1 PUT, 0 COPY, 0 DELETE, 0 LIST, 0 HEAD',
+            'Bytes uploaded: 2048',
+            'Invalidation paths: 0',
+            'Estimated cost: $0.0000',
+        ])
+
+        path = os.path.join(self.tmp_dir, 'summary.json')
+        deploy_stats.save(path)
+        with open(path, 'r') as f:
+            self.assertEqual(json.load(f), deploy_stats.as_dict())
+
+    def test_actions_and_phases(self):
+        stats.record_action('update')
+        with stats.phase('sync'):
+            pass
+
+        stats.start()
+        stats.record_action('update')
+        stats.record_action('update')
+        stats.record_action('skip')
+        with stats.phase('sync'):
+            pass
+        stats.record_phase('sync', 1.0)
+        with self.assertRaises(ValueError):
+            with stats.phase('delete'):
+                raise ValueError()
+        deploy_stats = stats.stop()
+
+        data = deploy_stats.as_dict()
+        self.assertEqual(data['actions'], {'update': 2, 'skip': 1})
+        self.assertEqual(sorted(data['phases']), ['delete', 'sync'])
+        self.assertGreaterEqual(data['phases']['sync'], 1.0)
@@ -0,0 +1,246 @@
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import boto3
+from botocore.exceptions import ClientError
+from moto import mock_s3
+
+from s3_deploy import deploy
+from s3_deploy import listing
+from s3_deploy import orphans
+from s3_deploy import storage
+
+
+class StorageTestMixin(object):
+    def test_put_head_get(self):
+        self.storage.put('a.html', b'<p>', {'ContentType': 'text/html'})
+        body, info = self.storage.get('a.html')
+        self.assertEqual(body, b'<p>')
+        self.assertEqual(info['ContentType'], 'text/html')
+        self.assertEqual(info['ContentLength'], 3)
+        self.assertEqual(info, self.storage.head('a.html'))
+
+    def test_missing(self):
+        self.assertIsNone(self.storage.head('a.html'))
+        self.assertIsNone(self.storage.get('a.html'))
+
+    def test_list_in_key_order(self):
+        for key_name in ['b', 'a/b', 'a', 'c/d']:
+            self.storage.put(key_name, b'x', {})
+        self.assertEqual(
+            [obj.key for obj in self.storage.list()], ['a', 'a/b', 'b', 'c/d'])
+        self.assertEqual(
+            [obj.key for obj in self.storage.list('a', start_after='a')],
+            ['a/b'])
+        self.assertEqual(
+            [obj.key for obj in self.storage.list(limit=2)], ['a', 'a/b'])
+
+    def test_copy_replaces_headers(self):
+        self.storage.put('a.js', b'x', {'ContentType': 'text/plain'})
+        self.storage.copy('a.js', 'b.js', {'CacheControl': 'max-age=60'})
+        body, info = self.storage.get('b.js')
+        self.assertEqual(body, b'x')
+        self.assertEqual(info['CacheControl'], 'max-age=60')
+        self.assertNotIn('ContentType', info)
+        self.assertEqual(info['ETag'], self.storage.head('a.js')['ETag'])
+
+    def test_copy_missing_source(self):
+        with self.assertRaises(KeyError):
+            self.storage.copy('a.js', 'b.js', {})
+
+    def test_delete_batch(self):
+        for key_name in ['a', 'b', 'c']:
+            self.storage.put(key_name, b'x', {})
+        self.assertEqual(self.storage.delete_batch(['a', 'c', 'd']), [])
+        self.assertEqual([obj.key for obj in self.storage.list()], ['b'])
+
+    def test_client_api_errors(self):
+        with self.assertRaises(ClientError):
+            self.storage.get_object(Bucket='bucket', Key='a')
+        with self.assertRaises(ClientError):
+            self.storage.copy_object(
+                Bucket='bucket', Key='b',
+                CopySource=dict(Bucket='bucket', Key='a'))
+
+    def test_list_objects_v2_pages_and_prefixes(self):
+        for key_name in ['a/1', 'a/2', 'b', 'c/1', 'd']:
+            self.storage.put(key_name, b'x', {})
+
+        response = self.storage.list_objects_v2(
+            Bucket='bucket', Delimiter='/', MaxKeys=2)
+        self.assertEqual(response['CommonPrefixes'], [dict(Prefix='a/')])
+        self.assertEqual([c['Key'] for c in response['Contents']], ['b'])
+        self.assertTrue(response['IsTruncated'])
+
+        response = self.storage.list_objects_v2(
+            Bucket='bucket', Delimiter='/', MaxKeys=2,
+            ContinuationToken=response['NextContinuationToken'])
+        self.assertEqual(response['CommonPrefixes'], [dict(Prefix='c/')])
+        self.assertEqual([c['Key'] for c in response['Contents']], ['d'])
+        self.assertFalse(response['IsTruncated'])
+
+    def test_list_objects(self):
+        keys = ['a/{}'.format(i) for i in range(5)] + ['b', 'c/1']
+        for key_name in keys:
+            self.storage.put(key_name, b'x', {})
+        self.assertEqual(
+            [obj.key for obj in listing.list_objects(self.storage, 'bucket')],
+            sorted(keys))
+
+    def test_orphan_ledger(self):
+        self.assertEqual(
+            len(orphans.OrphanLedger.load(self.storage, 'bucket')), 0)
+        ledger = orphans.OrphanLedger()
+        ledger.record('a.html', 10)
+        ledger.save(self.storage, 'bucket')
+        self.assertIn(
+            'a.html', orphans.OrphanLedger.load(self.storage, 'bucket'))
+
+
+class MemoryStorageTest(StorageTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.storage = storage.MemoryStorage()
+
+
+class LocalStorageTest(StorageTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.storage = storage.LocalStorage(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reopen(self):
+        self.storage.put('a/b', b'x', {'ContentType': 'text/plain'})
+        reopened = storage.LocalStorage(self.tmp_dir)
+        self.assertEqual([obj.key for obj in reopened.list()], ['a/b'])
+        self.assertEqual(reopened.get('a/b')[0], b'x')
+
+
+class S3StorageTest(StorageTestMixin, unittest.TestCase):
+    def setUp(self):
+        # The tests of the mixin are not decorated by mock_s3
+        self.mock = mock_s3()
+        self.mock.start()
+        self.addCleanup(self.mock.stop)
+        self.client = boto3.client('s3', region_name='us-east-1')
+        self.client.create_bucket(Bucket='bucket')
+        self.storage = storage.S3Storage(self.client, 'bucket')
+
+    def test_copy_replaces_headers(self):
+        self.storage.put('a.js', b'x', {'ContentType': 'text/plain'})
+        self.storage.copy('a.js', 'b.js', {'CacheControl': 'max-age=60'})
+        body, info = self.storage.get('b.js')
+        self.assertEqual(body, b'x')
+        self.assertEqual(info['CacheControl'], 'max-age=60')
+        # S3 sets the default content type
+        self.assertEqual(info['ContentType'], 'binary/octet-stream')
+
+    def test_deploy_client(self):
+        s3_client = deploy._create_s3_client({'s3_bucket': 'bucket'})
+        self.assertIsInstance(s3_client, storage.S3Storage)
+        s3_client.put_object(Bucket='bucket', Key='a.html', Body=b'<p>')
+        self.assertEqual(self.storage.get('a.html')[0], b'<p>')
+
+
+class LatencyStorageTest(unittest.TestCase):
+    def test_requests_are_delayed(self):
+        delays = []
+        wrapped = storage.LatencyStorage(
+            storage.MemoryStorage(), 0.5, jitter=0.1, seed=1,
+            sleep=delays.append)
+        wrapped.put('a', b'x', {})
+        wrapped.head('a')
+        wrapped.list()
+        self.assertEqual(len(delays), 3)
+        self.assertTrue(all(0.5 <= delay <= 0.6 for delay in delays))
+
+        replayed = []
+        wrapped = storage.LatencyStorage(
+            storage.MemoryStorage(), 0.5, jitter=0.1, seed=1,
+            sleep=replayed.append)
+        wrapped.put('a', b'x', {})
+        wrapped.head('a')
+        wrapped.list()
+        self.assertEqual(delays, replayed)
+
+
+class StorageInterfaceTest(unittest.TestCase):
+    def test_incomplete_backend(self):
+        class ReadOnlyStorage(storage.Storage):
+            def list(self, prefix='', start_after=None, limit=None):
+                return []
+
+            def head(self, key_name):
+                return None
+
+            def get(self, key_name):
+                return None
+
+        with self.assertRaises(TypeError):
+            ReadOnlyStorage()
+
+
+class CreateStorageTest(unittest.TestCase):
+    def test_memory_storage_is_shared(self):
+        first = storage.create_storage('memory://create-test')
+        self.assertIs(storage.create_storage('memory://create-test'), first)
+
+    def test_latency(self):
+        self.assertIsInstance(
+            storage.create_storage('memory://', latency=0.1),
+            storage.LatencyStorage)
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            storage.create_storage('s3://bucket')
+
+
+class DeployToStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.site_dir = os.path.join(self.tmp_dir, '_site')
+        os.mkdir(self.site_dir)
+        for i in range(20):
+            with open(os.path.join(self.site_dir, '{}.html'.format(i)),
+                      'w') as f:
+                f.write('page {}\n'.format(i))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_deploy_to_local_directory(self):
+        bucket_dir = os.path.join(self.tmp_dir, 'bucket')
+        conf = {
+            's3_bucket': 'bucket',
+            'site': '_site',
+            'storage_url': 'file://' + bucket_dir,
+        }
+        deploy.deploy(conf, self.tmp_dir, False, False)
+        os.remove(os.path.join(self.site_dir, '0.html'))
+        deploy.deploy(conf, self.tmp_dir, False, False)
+
+        local = storage.LocalStorage(bucket_dir)
+        self.assertEqual(len(local.list()), 19)
+        body, info = local.get('1.html')
+        self.assertEqual(info['ContentType'], 'text/html')
+
+    def test_deploy_with_latency(self):
+        # Every upload is delayed, so even with concurrent uploads the
+        # deploy takes at least the latency of listing and one upload.
+        started = time.time()
+        deploy.deploy({
+            's3_bucket': 'bucket',
+            'site': '_site',
+            'storage_url': 'memory://latency-test',
+            'storage_latency': 0.05,
+            'concurrency': 20,
+        }, self.tmp_dir, False, False)
+        self.assertGreaterEqual(time.time() - started, 0.1)
+
+        stored = storage.create_storage('memory://latency-test')
+        self.assertEqual(len(stored.list()), 20)
@@ -0,0 +1,68 @@
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from s3_deploy import tracing
+
+
+class TracingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'trace.json')
+
+    def tearDown(self):
+        tracing.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def load_events(self):
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def test_span_without_tracer(self):
+        with tracing.span('upload', 'index.html'):
+            pass
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_spans(self):
+        tracing.start(self.path)
+        with tracing.span('upload', 'index.html'):
+            pass
+
+        def compress():
+            with tracing.span('compress', 'app.js'):
+                pass
+
+        thread = threading.Thread(target=compress)
+        thread.start()
+        thread.join()
+        with self.assertRaises(RuntimeError):
+            with tracing.span('delete', 'old.html'):
+                raise RuntimeError('failed')
+        tracing.stop()
+
+        events = self.load_events()
+        spans = [e for e in events if e['ph'] == 'X']
+        self.assertEqual([(e['cat'], e['name']) for e in spans], [
+            ('upload', 'index.html'),
+            ('compress', 'app.js'),
+            ('delete', 'old.html'),
+        ])
+        self.assertEqual(spans[2]['args'], {'key': 'old.html', 'error': True})
+        self.assertNotEqual(spans[0]['tid'], spans[1]['tid'])
+
+        thread_names = [e for e in events if e['name'] == 'thread_name']
+        self.assertEqual(len(thread_names), 2)
+
+    def test_start_twice(self):
+        tracing.start(self.path)
+        with self.assertRaises(RuntimeError):
+            tracing.start(self.path)
+
+    def test_empty_trace(self):
+        tracing.start(self.path)
+        tracing.stop()
+        self.assertEqual(len(self.load_events()), 1)
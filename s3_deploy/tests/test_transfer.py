@@ -0,0 +1,171 @@
+
+import threading
+import time
+import unittest
+
+from s3_deploy.transfer import PriorityScheduler
+from s3_deploy.transfer import TokenBucket
+from s3_deploy.transfer import TransferEngine
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+
+    def clock(self):
+        return self.now
+
+    def test_within_capacity(self):
+        bucket = TokenBucket(1000, clock=self.clock)
+        self.assertEqual(bucket.reserve(600), 0)
+        self.assertEqual(bucket.reserve(400), 0)
+
+    def test_wait_when_empty(self):
+        bucket = TokenBucket(1000, clock=self.clock)
+        bucket.reserve(1000)
+        self.assertAlmostEqual(bucket.reserve(500), 0.5)
+        self.assertAlmostEqual(bucket.reserve(500), 1.0)
+
+    def test_refill(self):
+        bucket = TokenBucket(1000, clock=self.clock)
+        bucket.reserve(1000)
+        self.now = 0.25
+        self.assertEqual(bucket.reserve(250), 0)
+        self.assertAlmostEqual(bucket.reserve(250), 0.25)
+
+    def test_refill_capped(self):
+        bucket = TokenBucket(1000, capacity=100, clock=self.clock)
+        self.now = 100
+        self.assertAlmostEqual(bucket.reserve(300), 0.2)
+
+    def test_borrow_large_request(self):
+        bucket = TokenBucket(100, clock=self.clock)
+        self.assertAlmostEqual(bucket.reserve(1100), 10.0)
+
+    def test_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(0)
+
+
+class PrioritySchedulerTest(unittest.TestCase):
+    def test_order(self):
+        done = []
+        with TransferEngine(4) as engine:
+            scheduler = PriorityScheduler(engine)
+            scheduler.submit(10, done.append, 'html')
+            scheduler.submit(0, done.append, 'asset')
+            scheduler.submit(5, done.append, 'css')
+            scheduler.submit(10, done.append, 'html2')
+            engine.wait()
+            self.assertEqual(done, ['asset'])
+            scheduler.flush()
+            engine.join()
+
+        self.assertEqual(done[:2], ['asset', 'css'])
+        self.assertEqual(sorted(done[2:]), ['html', 'html2'])
+
+    def test_levels_do_not_overlap(self):
+        lock = threading.Lock()
+        events = []
+
+        def transfer(name):
+            with lock:
+                events.append(('start', name))
+            time.sleep(0.01)
+            with lock:
+                events.append(('end', name))
+
+        with TransferEngine(4) as engine:
+            scheduler = PriorityScheduler(engine, min_priority=-1)
+            scheduler.submit(0, transfer, 'b')
+            scheduler.submit(-1, transfer, 'a')
+            scheduler.submit(1, transfer, 'c')
+            scheduler.flush()
+            engine.join()
+
+        self.assertEqual([name for kind, name in events], [
+            'a', 'a', 'b', 'b', 'c', 'c'])
+
+
+class TransferEngineTest(unittest.TestCase):
+    def test_runs_all_transfers(self):
+        done = []
+        with TransferEngine(4) as engine:
+            for i in range(20):
+                engine.submit(done.append, i)
+            engine.join()
+        self.assertEqual(sorted(done), list(range(20)))
+
+    def test_concurrency_limit(self):
+        lock = threading.Lock()
+        state = dict(running=0, max_running=0)
+
+        def transfer():
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(
+                    state['max_running'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+
+        with TransferEngine(3) as engine:
+            for _ in range(12):
+                engine.submit(transfer)
+            engine.join()
+
+        self.assertLessEqual(state['max_running'], 3)
+        self.assertEqual(state['running'], 0)
+
+    def test_error_raised_from_join(self):
+        def fail():
+            raise RuntimeError('transfer failed')
+
+        with TransferEngine(2) as engine:
+            engine.submit(fail)
+            with self.assertRaises(RuntimeError):
+                engine.join()
+
+    def test_kwargs(self):
+        result = {}
+
+        def transfer(key, value=None):
+            result[key] = value
+
+        with TransferEngine(1) as engine:
+            engine.submit(transfer, 'a', value=1)
+            engine.join()
+        self.assertEqual(result, {'a': 1})
+
+    def test_invalid_concurrency(self):
+        with self.assertRaises(ValueError):
+            TransferEngine(0)
+
+
+class TransferGroupTest(unittest.TestCase):
+    def test_groups_share_engine(self):
+        done = []
+        with TransferEngine(2) as engine:
+            groups = [engine.group(), engine.group()]
+            for i in range(10):
+                groups[i % 2].submit(done.append, i)
+            for group in groups:
+                group.wait()
+            engine.join()
+        self.assertEqual(sorted(done), list(range(10)))
+
+    def test_error_only_raised_from_own_group(self):
+        def fail():
+            raise RuntimeError('transfer failed')
+
+        done = []
+        with TransferEngine(2) as engine:
+            failing = engine.group()
+            working = engine.group()
+            failing.submit(fail)
+            with self.assertRaises(RuntimeError):
+                failing.wait()
+            working.submit(done.append, 1)
+            working.wait()
+            engine.join()
+        self.assertEqual(done, [1])
@@ -0,0 +1,235 @@
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import boto3
+import mock
+from mock import patch
+from moto import mock_s3
+
+from s3_deploy import deploy
+from s3_deploy import lock
+from s3_deploy import manifest
+from s3_deploy import orphans
+from s3_deploy import watch
+
+
+class FakeNotifier(object):
+    """Notifier that applies scripted changes to the site on each wait."""
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.closed = False
+
+    def wait(self, timeout):
+        if len(self.changes) == 0:
+            return False
+        self.changes.pop(0)()
+        return True
+
+    def close(self):
+        self.closed = True
+
+
+@mock_s3
+class SiteWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.site_dir = os.path.join(self.tmp_dir, '_site')
+        os.mkdir(self.site_dir)
+        self.write('index.html', 'index\n')
+        self.write('old.txt', 'old\n')
+
+        self.client = boto3.client('s3', region_name='us-east-1')
+        self.client.create_bucket(Bucket='test_bucket')
+        for key_name in ['index.html', 'old.txt']:
+            self.client.put_object(
+                Bucket='test_bucket', Key=key_name, Body=b'x')
+
+        self.conf = {'s3_bucket': 'test_bucket', 'site': '_site'}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, contents, offset=0):
+        path = os.path.join(self.site_dir, *name.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+        mtime = time.time() + offset
+        os.utime(path, (mtime, mtime))
+
+    def remove(self, name):
+        os.remove(os.path.join(self.site_dir, name))
+
+    def watcher(self, changes):
+        return watch.SiteWatcher(
+            self.conf, self.tmp_dir, False, client=self.client,
+            notifier=FakeNotifier(changes), poll_interval=0, debounce=0)
+
+    def keys(self):
+        response = self.client.list_objects_v2(Bucket='test_bucket')
+        return sorted(item['Key'] for item in response.get('Contents', []))
+
+    def test_wait_for_changes_debounces(self):
+        watcher = self.watcher([
+            lambda: None,
+            lambda: self.write('a/new.html', 'new\n'),
+            lambda: self.write('a/new.html', 'newer\n', offset=10),
+            lambda: None,
+        ])
+        state = watcher.wait_for_changes()
+        self.assertIn('a/new.html', state)
+        # The burst of writes was merged into one change
+        self.assertEqual(
+            state['a/new.html'][0], len('newer\n'))
+
+    @patch('s3_deploy.deploy.invalidate_paths')
+    def test_sync(self, mock_invalidate):
+        self.conf['cloudfront_distribution_id'] = 'ABCDEFGHI'
+        watcher = self.watcher([])
+        self.write('a/new.html', 'new\n')
+        self.remove('old.txt')
+
+        changed = watcher.sync(watch.scan_site(self.site_dir))
+
+        self.assertEqual(changed, ['a/new.html', 'old.txt'])
+        self.assertEqual(self.keys(), ['a/new.html', 'index.html'])
+        mock_invalidate.assert_called_once_with(
+            'ABCDEFGHI', ['/a/new.html', '/old.txt'], False)
+
+        # Nothing changed since the last sync
+        self.assertEqual(watcher.sync(watch.scan_site(self.site_dir)), [])
+
+    @patch('s3_deploy.deploy.invalidate_paths')
+    def test_sync_defer_deletion(self, mock_invalidate):
+        self.conf['cloudfront_distribution_id'] = 'ABCDEFGHI'
+        self.conf['defer_deletion'] = True
+        watcher = self.watcher([])
+        self.write('a/new.html', 'new\n')
+        self.remove('old.txt')
+
+        changed = watcher.sync(watch.scan_site(self.site_dir))
+
+        self.assertEqual(changed, ['a/new.html'])
+        self.assertEqual(self.keys(), [
+            orphans.LEDGER_KEY, 'a/new.html', 'index.html', 'old.txt'])
+        ledger = orphans.OrphanLedger.load(self.client, 'test_bucket')
+        self.assertIn('old.txt', ledger)
+        mock_invalidate.assert_called_once_with(
+            'ABCDEFGHI', ['/a/new.html'], False)
+
+    def test_sync_collects_expired_orphans(self):
+        self.conf['defer_deletion'] = True
+        self.conf['orphan_grace_period'] = 0
+        watcher = self.watcher([])
+        self.remove('old.txt')
+
+        changed = watcher.sync(watch.scan_site(self.site_dir))
+
+        self.assertEqual(changed, ['old.txt'])
+        self.assertEqual(self.keys(), [orphans.LEDGER_KEY, 'index.html'])
+
+    def test_sync_keeps_redirect(self):
+        self.conf.update(
+            defer_deletion=True, orphan_grace_period=0,
+            redirects={'/old.txt': '/index.html'})
+        deploy.put_redirect(
+            self.client, 'test_bucket', 'old.txt', '/index.html', [], False)
+        watcher = self.watcher([
+            lambda: self.write('old.txt', 'changed\n', offset=10),
+            lambda: self.write('a/new.html', 'new\n'),
+        ])
+
+        self.assertEqual(watcher.sync(watcher.wait_for_changes()),
+                         ['a/new.html'])
+        self.remove('old.txt')
+        self.assertEqual(watcher.sync(watcher.wait_for_changes()), [])
+
+        self.assertIn('old.txt', self.keys())
+        response = self.client.head_object(Bucket='test_bucket', Key='old.txt')
+        self.assertEqual(response['WebsiteRedirectLocation'], '/index.html')
+
+    def test_sync_holds_lock(self):
+        self.conf['lock'] = True
+        watcher = self.watcher([])
+        self.write('a/new.html', 'new\n')
+        owners = []
+
+        def upload(client, bucket_name, key_name, *args, **kwargs):
+            response = client.get_object(Bucket=bucket_name, Key=lock.LOCK_KEY)
+            body = response['Body'].read().decode('utf-8')
+            owners.append(json.loads(body)['owner'])
+
+        with patch('s3_deploy.deploy.upload_key', side_effect=upload):
+            watcher.sync(watch.scan_site(self.site_dir))
+
+        self.assertEqual(len(owners), 1)
+        self.assertNotIn(lock.LOCK_KEY, self.keys())
+
+    def test_sync_upload_options_and_manifest(self):
+        self.conf.update(
+            manifest='manifest.json', verify_uploads=True, deduplicate=True,
+            upload_priority=[{'match': 'index.html', 'priority': 1}])
+        watcher = self.watcher([])
+        self.write('a/new.html', 'new\n')
+        self.write('index.html', 'changed\n', offset=10)
+        order = []
+
+        def upload(client, bucket_name, key_name, *args, **kwargs):
+            order.append(key_name)
+            self.assertTrue(kwargs['verify'])
+            self.assertIsNotNone(kwargs['content_index'])
+
+        with patch('s3_deploy.deploy.upload_key', side_effect=upload):
+            watcher.sync(watch.scan_site(self.site_dir))
+
+        # Keys with a higher priority are uploaded last
+        self.assertEqual(order, ['a/new.html', 'index.html'])
+        self.assertEqual(list(manifest.changed_keys(
+            manifest.load_manifest(
+                os.path.join(self.tmp_dir, 'manifest.json'), 'test_bucket'),
+            deploy.iter_site_files(self.site_dir))), [])
+
+    def test_run_cycles(self):
+        watcher = self.watcher([
+            lambda: self.write('index.html', 'changed index\n', offset=10),
+            lambda: None,
+        ])
+        with patch('s3_deploy.deploy.upload_key') as mock_upload:
+            watcher.run(max_cycles=1)
+
+        mock_upload.assert_called_once_with(
+            self.client, 'test_bucket', 'index.html',
+            os.path.join(self.site_dir, 'index.html'), (), False,
+            storage_class='STANDARD', bandwidth=None, content_index=None,
+            precompressed=None, verify=False)
+        self.assertTrue(watcher._notifier.closed)
+
+    def test_run_keeps_state_on_error(self):
+        watcher = self.watcher([
+            lambda: self.write('index.html', 'changed index\n', offset=10),
+            lambda: None,
+        ])
+        state = watcher.state
+        with patch('s3_deploy.deploy.upload_key',
+                   side_effect=RuntimeError('network error')):
+            watcher.run(max_cycles=1)
+        self.assertEqual(watcher.state, state)
+
+
+class CreateNotifierTest(unittest.TestCase):
+    @patch.object(watch, 'InotifyNotifier', side_effect=ImportError)
+    def test_polling_fallback(self, mock_inotify):
+        notifier = watch.create_notifier('.')
+        self.assertIsInstance(notifier, watch.PollingNotifier)
+
+    def test_polling_notifier(self):
+        sleep = mock.Mock()
+        notifier = watch.PollingNotifier(sleep=sleep)
+        self.assertTrue(notifier.wait(2.5))
+        sleep.assert_called_once_with(2.5)
@@ -0,0 +1,119 @@
+"""Opt-in tracing of the phases of a deploy.
+
+When a tracer is started, spans for each key and phase (listing, stat,
+read, compress, upload, ...) are written to a file in the Chrome trace
+event format, which can be opened in ``chrome://tracing`` or Perfetto.
+Events are written as they complete, so tracing a large deploy does not
+hold the events in memory. When no tracer is started, :func:`span` returns
+a shared no-op context manager.
+"""
+
+import json
+import os
+import threading
+import time
+
+
+_tracer = None
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, tracer, phase, key_name):
+        self._tracer = tracer
+        self._phase = phase
+        self._key_name = key_name
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._tracer.add(self._phase, self._key_name, self._start,
+                         time.time(), error=exc_type is not None)
+        return False
+
+
+class Tracer(object):
+    """Writes trace events to a file in the Chrome trace event format."""
+    def __init__(self, path):
+        self._file = open(path, 'w')
+        self._file.write('[')
+        self._first = True
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._threads = set()
+
+    def _write(self, event):
+        self._file.write('\n' if self._first else ',\n')
+        self._file.write(json.dumps(event, sort_keys=True))
+        self._first = False
+
+    def add(self, phase, key_name, start, end, error=False):
+        """Record a complete span of phase with start and end times."""
+        thread = threading.current_thread()
+        tid = thread.ident
+        args = {}
+        if key_name is not None:
+            args['key'] = key_name
+        if error:
+            args['error'] = True
+
+        with self._lock:
+            if tid not in self._threads:
+                self._threads.add(tid)
+                self._write(dict(
+                    name='thread_name', ph='M', pid=self._pid, tid=tid,
+                    args=dict(name=thread.name)))
+            self._write(dict(
+                name=phase if key_name is None else key_name, cat=phase,
+                ph='X', pid=self._pid, tid=tid, ts=int(start * 1e6),
+                dur=int((end - start) * 1e6), args=args))
+
+    def span(self, phase, key_name=None):
+        """Return context manager recording a span of phase."""
+        return _Span(self, phase, key_name)
+
+    def close(self):
+        """Finish the trace file."""
+        with self._lock:
+            self._write(dict(
+                name='process_name', ph='M', pid=self._pid,
+                args=dict(name='s3-deploy-website')))
+            self._file.write('\n]\n')
+            self._file.close()
+
+
+def start(path):
+    """Start tracing to the file at path."""
+    global _tracer
+    if _tracer is not None:
+        raise RuntimeError('Tracing already started')
+    _tracer = Tracer(path)
+    return _tracer
+
+
+def stop():
+    """Stop tracing and finish the trace file."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.close()
+
+
+def span(phase, key_name=None):
+    """Return context manager recording a span if tracing is started."""
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return tracer.span(phase, key_name)
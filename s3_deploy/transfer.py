@@ -0,0 +1,205 @@
+"""Thread pool transfer engine for the default deploy engine."""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_CONCURRENCY = 8
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """Token bucket limiting the rate of transferred bytes.
+
+    The bucket is shared by all concurrent transfers. A transfer larger
+    than the bucket capacity is allowed to borrow tokens, so the limit is
+    kept on average without splitting request bodies.
+    """
+    def __init__(self, rate, capacity=None, clock=time.time):
+        if rate <= 0:
+            raise ValueError('Rate must be positive')
+
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._clock = clock
+        self._tokens = self.capacity
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, n):
+        """Take n tokens and return the number of seconds to wait."""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def consume(self, n):
+        """Take n tokens, sleeping until they are available."""
+        delay = self.reserve(n)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class TransferEngine(object):
+    """Run transfers in a pool of worker threads.
+
+    Submitting blocks while ``concurrency`` transfers are already queued or
+    running, so a producer that is faster than the network does not build
+    up an unbounded backlog. The first error raised by a transfer is
+    re-raised from :meth:`wait` or :meth:`join` and stops further
+    transfers from starting.
+    """
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        if concurrency < 1:
+            raise ValueError('Concurrency must be at least 1')
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._idle = threading.Condition()
+        self._pending = 0
+        self._error = None
+
+    def _run(self, func, args, kwargs):
+        try:
+            if self._error is None:
+                func(*args, **kwargs)
+        except Exception as e:
+            with self._idle:
+                if self._error is None:
+                    self._error = e
+        finally:
+            self._slots.release()
+            with self._idle:
+                self._pending -= 1
+                self._idle.notify_all()
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule func to be called with the given arguments."""
+        self._raise_error()
+        self._slots.acquire()
+        with self._idle:
+            self._pending += 1
+        self._executor.submit(self._run, func, args, kwargs)
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def wait(self):
+        """Wait for the scheduled transfers and raise the first error."""
+        with self._idle:
+            while self._pending > 0:
+                self._idle.wait()
+        self._raise_error()
+
+    def join(self):
+        """Wait for all scheduled transfers, then stop the worker threads."""
+        self.wait()
+        self._executor.shutdown(wait=True)
+
+    def group(self):
+        """Return a :class:`TransferGroup` sharing the worker threads."""
+        return TransferGroup(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._executor.shutdown(wait=True)
+
+
+class TransferGroup(object):
+    """Set of transfers submitted through a shared transfer engine.
+
+    Several groups (e.g. one per site) share the concurrency limit of the
+    engine, but each group is waited on separately and only sees the
+    errors of its own transfers.
+    """
+    def __init__(self, engine):
+        self._engine = engine
+        self._idle = threading.Condition()
+        self._pending = 0
+        self._error = None
+
+    def _run(self, func, args, kwargs):
+        try:
+            if self._error is None:
+                func(*args, **kwargs)
+        except Exception as e:
+            with self._idle:
+                if self._error is None:
+                    self._error = e
+        finally:
+            with self._idle:
+                self._pending -= 1
+                self._idle.notify_all()
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule func to be called with the given arguments."""
+        self._raise_error()
+        with self._idle:
+            self._pending += 1
+        try:
+            self._engine.submit(self._run, func, args, kwargs)
+        except Exception:
+            with self._idle:
+                self._pending -= 1
+            raise
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def wait(self):
+        """Wait for the transfers of the group and raise the first error."""
+        with self._idle:
+            while self._pending > 0:
+                self._idle.wait()
+        self._raise_error()
+
+
+class PriorityScheduler(object):
+    """Orders transfers by priority on top of a transfer engine.
+
+    Transfers with the lowest priority that can occur are passed to the
+    engine immediately. Other transfers are held back until :meth:`flush`
+    and then run one priority level at a time, so every transfer of a
+    level has completed before the next level starts.
+    """
+    def __init__(self, engine, min_priority=0):
+        self._engine = engine
+        self._min_priority = min_priority
+        self._queue = []
+        self._counter = itertools.count()
+
+    def submit(self, priority, func, *args, **kwargs):
+        """Schedule func to be called with the given priority."""
+        if priority <= self._min_priority:
+            self._engine.submit(func, *args, **kwargs)
+        else:
+            heapq.heappush(
+                self._queue, (priority, next(self._counter), func, args,
+                              kwargs))
+
+    def flush(self):
+        """Run held back transfers in priority order."""
+        level = None
+        while len(self._queue) > 0:
+            priority, _, func, args, kwargs = heapq.heappop(self._queue)
+            if priority != level:
+                self._engine.wait()
+                level = priority
+                logger.debug('Starting transfers of priority {}'.format(
+                    priority))
+            self._engine.submit(func, *args, **kwargs)
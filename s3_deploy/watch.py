@@ -0,0 +1,271 @@
+"""Watch the site directory and continuously deploy changes.
+
+After an initial full deploy the watcher keeps the state of the deployed
+files in memory. Each change cycle only uploads the changed keys, deletes
+the removed keys, updates the manifest and creates one invalidation for the
+batch, reusing the same S3 client (and connection pool) for every cycle.
+"""
+
+import logging
+import os
+import time
+
+from . import config
+from . import dedupe
+from . import deploy as _deploy
+from . import manifest as _manifest
+from . import transfer
+
+
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_DEBOUNCE = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+class PollingNotifier(object):
+    """Notifier that wakes up at a fixed interval."""
+    def __init__(self, sleep=time.sleep):
+        self._sleep = sleep
+
+    def wait(self, timeout):
+        """Wait for timeout seconds. Return True as changes may exist."""
+        self._sleep(timeout)
+        return True
+
+    def close(self):
+        pass
+
+
+class InotifyNotifier(object):
+    """Notifier using inotify through the optional inotify_simple package."""
+    def __init__(self, site_dir):
+        from inotify_simple import INotify, flags
+
+        self._site_dir = site_dir
+        self._inotify = INotify()
+        self._mask = (
+            flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.DELETE |
+            flags.MOVED_FROM | flags.MOVED_TO | flags.ATTRIB)
+        self._add_watches()
+
+    def _add_watches(self):
+        for dirpath, dirnames, filenames in os.walk(self._site_dir):
+            # Adding a watch for a directory that is already watched only
+            # updates the existing watch.
+            self._inotify.add_watch(dirpath, self._mask)
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds. Return True if events occurred."""
+        events = self._inotify.read(timeout=int(timeout * 1000))
+        if len(events) == 0:
+            return False
+
+        # Watch directories created since the last wait
+        self._add_watches()
+        return True
+
+    def close(self):
+        self._inotify.close()
+
+
+def create_notifier(site_dir):
+    """Create inotify notifier where available or fall back to polling."""
+    try:
+        notifier = InotifyNotifier(site_dir)
+    except (ImportError, OSError):
+        logger.debug('inotify unavailable, polling for changes',
+                     exc_info=True)
+        return PollingNotifier()
+
+    logger.debug('Watching for changes with inotify')
+    return notifier
+
+
+def scan_site(site_dir, precompressed=None, redirects=()):
+    """Return dictionary of key names to file signatures of the site.
+
+    Files replaced by redirects are left out, so the redirect objects
+    written by a full deploy are neither overwritten nor deleted.
+    """
+    redirected = set(key_name for key_name, _ in redirects)
+    return dict((key_name, _manifest.key_signature(path, precompressed))
+                for key_name, path in _deploy.iter_site_files(
+                    site_dir, precompressed=precompressed)
+                if key_name not in redirected)
+
+
+class SiteWatcher(object):
+    """Deploy changes of the site directory as they happen."""
+    def __init__(self, conf, base_path, dry, client=None, notifier=None,
+                 poll_interval=None, debounce=None):
+        conf = config.compile_config(conf)
+        self._conf = conf
+        self._dry = dry
+        self._bucket_name = conf['s3_bucket']
+        self._cache_rules = conf.get('cache_rules', [])
+        self._storage_class = _deploy._storage_class_from_config(conf)
+        self._storage_class_rules = conf.get('storage_class_rules', ())
+        self._bandwidth = _deploy._bandwidth_from_config(conf)
+        self._precompressed = conf.get('precompressed')
+        self._redirects = conf.get('redirects', ())
+        self._priority_rules = conf.get('upload_priority', [])
+        self._concurrency = conf.get(
+            'concurrency', transfer.DEFAULT_CONCURRENCY)
+        self._base_path = base_path
+        self.site_dir = os.path.join(base_path, conf['site'])
+
+        if poll_interval is None:
+            poll_interval = conf.get(
+                'watch_poll_interval', DEFAULT_POLL_INTERVAL)
+        if debounce is None:
+            debounce = conf.get('watch_debounce', DEFAULT_DEBOUNCE)
+        self._poll_interval = poll_interval
+        self._debounce = debounce
+
+        if client is None:
+            client = _deploy._create_s3_client(conf)
+        self._client = client
+
+        if notifier is None:
+            notifier = create_notifier(self.site_dir)
+        self._notifier = notifier
+
+        self.state = self._scan()
+
+    def _scan(self):
+        return scan_site(self.site_dir, self._precompressed, self._redirects)
+
+    def wait_for_changes(self):
+        """Wait until the site changed and then settled.
+
+        Return the new state once no further changes were seen for the
+        debounce period.
+        """
+        while True:
+            if self._notifier.wait(self._poll_interval):
+                current = self._scan()
+                if current != self.state:
+                    break
+
+        while self._notifier.wait(self._debounce):
+            latest = self._scan()
+            if latest == current:
+                break
+            current = latest
+
+        return current
+
+    def _path(self, key_name):
+        return os.path.join(self.site_dir, *key_name.split('/'))
+
+    def sync(self, new_state):
+        """Deploy the difference between the known state and new_state.
+
+        Return list of keys that were uploaded or deleted. Keys whose
+        deletion is deferred are recorded in the orphan ledger instead.
+        The bucket lock is held during the sync if the lock option is
+        enabled.
+        """
+        with _deploy._bucket_lock(
+                self._conf, self._client, self._dry) as deploy_lock:
+            return self._sync(new_state, deploy_lock)
+
+    def _sync(self, new_state, deploy_lock=None):
+        updated = sorted(
+            key_name for key_name, signature in new_state.items()
+            if self.state.get(key_name) != signature)
+        deleted = sorted(set(self.state) - set(new_state))
+
+        # Removed keys are left to the orphan ledger like in a full deploy
+        deletion = _deploy._deferred_deletion(self._conf, self._client)
+        if deletion is not None:
+            for key_name in new_state:
+                deletion.keep(key_name)
+            for key_name, _ in self._redirects:
+                deletion.keep(key_name)
+        postponed = set()
+
+        # Keys uploaded in this cycle are the sources of server-side copies
+        content_index = None
+        if self._conf.get('deduplicate', False):
+            content_index = dedupe.ContentIndex()
+
+        with transfer.TransferEngine(self._concurrency) as engine:
+            scheduler = transfer.PriorityScheduler(
+                engine, min_priority=_deploy._min_upload_priority(
+                    self._priority_rules))
+            for key_name in updated:
+                scheduler.submit(
+                    config.resolve_upload_priority(
+                        key_name, self._priority_rules),
+                    _deploy.upload_key, self._client, self._bucket_name,
+                    key_name, self._path(key_name), self._cache_rules,
+                    self._dry,
+                    storage_class=config.resolve_storage_class(
+                        key_name, self._storage_class_rules,
+                        self._storage_class),
+                    bandwidth=self._bandwidth, content_index=content_index,
+                    precompressed=self._precompressed,
+                    verify=self._conf.get('verify_uploads', False))
+            for key_name in deleted:
+                if deletion is not None and deletion.manages(key_name):
+                    # Expired keys are deleted by the batched collection
+                    if deletion.postpone(key_name):
+                        postponed.add(key_name)
+                    continue
+                engine.submit(
+                    _deploy.delete_key, self._client, self._bucket_name,
+                    key_name, self._dry)
+            scheduler.flush()
+            engine.join()
+
+        if deploy_lock is not None:
+            deploy_lock.check()
+
+        if deletion is not None:
+            postponed.difference_update(deletion.collect(
+                self._client, self._bucket_name, self._dry))
+
+        if 'manifest' in self._conf and not self._dry:
+            manifest = _manifest.ManifestBuilder(
+                self._bucket_name, precompressed=self._precompressed)
+            for key_name in new_state:
+                manifest.add(key_name, self._path(key_name))
+            manifest.save(_deploy._manifest_path(
+                self._conf, self._base_path))
+
+        self.state = new_state
+        changed = updated + [key_name for key_name in deleted
+                             if key_name not in postponed]
+
+        if 'cloudfront_distribution_id' in self._conf and len(changed) > 0:
+            changed_set = set(changed)
+            invalidation = _deploy.InvalidationPlan(self._conf)
+            for key_name in changed:
+                invalidation.add_updated(key_name)
+            for key_name in sorted(set(new_state) | postponed):
+                if key_name not in changed_set:
+                    invalidation.add_unchanged(key_name)
+            _deploy._invalidate(self._conf, invalidation.paths(), self._dry)
+
+        return changed
+
+    def run(self, max_cycles=None):
+        """Watch and deploy changes until interrupted."""
+        logger.info('Watching {} for changes...'.format(self.site_dir))
+        cycles = 0
+        try:
+            while max_cycles is None or cycles < max_cycles:
+                new_state = self.wait_for_changes()
+                cycles += 1
+                try:
+                    changed = self.sync(new_state)
+                except Exception:
+                    # The known state is kept so the keys are retried on
+                    # the next change.
+                    logger.exception('Failed to deploy changes')
+                    continue
+                logger.info('Deployed {} changed keys.'.format(len(changed)))
+        finally:
+            self._notifier.close()
@@ -41,7 +41,12 @@ setup(
         'boto3>=1.7,<1.8',
         'PyYAML~=3.11',
         'six~=1.10',
+        'futures~=3.2; python_version < "3"',
     ],
+    extras_require={
+        'async': ['aiobotocore'],
+        'watch': ['inotify_simple'],
+    },
     test_suite='s3_deploy.tests',
     tests_require=[
         'mock~=2.0',